@@ -0,0 +1,83 @@
+import argparse
+import json
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+from imageprep.src.quality.brisque import BRISQUE_TOLERANCE, NumpyBRISQUE
+from imageprep.src.quality.cv_quality import BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH
+
+# example run:
+# python -m imageprep.src.bench.bench_brisque --sizes 128 256 512 1024 --n_images 16
+
+
+def synthetic_images(size: int, n_images: int, seed: int = 0) -> tp.List[np.ndarray]:
+    # noise at different blur levels and JPEG qualities so the scores spread out
+    rng = np.random.default_rng(seed)
+    imgs = []
+    for i in range(n_images):
+        img = (rng.random((size, size, 3)) * 255).astype(np.uint8)
+        img = cv2.GaussianBlur(img, (0, 0), 0.5 + i % 4)
+        _, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 10 + (i * 17) % 90])
+        imgs.append(cv2.imdecode(buf, cv2.IMREAD_COLOR))
+    return imgs
+
+
+def time_scores(fn: tp.Callable[[], tp.Sequence[float]], repeats: int) -> tp.Tuple[float, np.ndarray]:
+    best = float('inf')
+    scores = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scores = np.asarray(fn(), dtype=np.float64)
+        best = min(best, time.perf_counter() - start)
+    return best, scores
+
+
+def bench_size(size: int, n_images: int, repeats: int, numpy_brisque: NumpyBRISQUE) -> dict:
+    imgs = synthetic_images(size, n_images)
+    opencv_brisque = cv2.quality.QualityBRISQUE_create(BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH)
+    methods = {
+        # what CVQuality did before: static compute, model files parsed on every call
+        'opencv_per_call': lambda: [
+            cv2.quality.QualityBRISQUE_compute(img, BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH)[0] for img in imgs
+        ],
+        'opencv_loaded_once': lambda: [opencv_brisque.compute(img)[0] for img in imgs],
+        'numpy_single': lambda: [numpy_brisque.score(img) for img in imgs],
+    }
+    timings = {name: time_scores(fn, repeats) for name, fn in methods.items()}
+    reference = timings['opencv_per_call'][1]
+    result = {'size': size, 'n_images': n_images, 'methods': {}}
+    for name, (seconds, scores) in timings.items():
+        result['methods'][name] = {
+            'images_per_s': n_images / seconds,
+            'speedup': timings['opencv_per_call'][0] / seconds,
+            'max_abs_diff': float(np.abs(scores - reference).max()),
+        }
+    return result
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512, 1024])
+    args.add_argument('--n_images', type=int, default=16)
+    args.add_argument('--repeats', type=int, default=3)
+    args.add_argument('--threads', type=int, default=1, help='cv2.setNumThreads, 1 for a per-core comparison')
+    args.add_argument('--output', type=str, required=False, default=None, help='write results as json')
+    args = args.parse_args()
+    cv2.setNumThreads(args.threads)
+    numpy_brisque = NumpyBRISQUE()
+    results = []
+    for size in args.sizes:
+        result = bench_size(size, args.n_images, args.repeats, numpy_brisque)
+        results.append(result)
+        for name, stats in result['methods'].items():
+            within = 'ok' if stats['max_abs_diff'] <= BRISQUE_TOLERANCE else 'OUT OF TOLERANCE'
+            print(
+                f"{size}x{size} {name:20s} {stats['images_per_s']:8.1f} img/s "
+                f"x{stats['speedup']:5.2f}  max diff {stats['max_abs_diff']:.4f} ({within})"
+            )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import time
+import typing as tp
+
+from imageprep.src.collection.extract import extract_adonis_imgs, extract_lpsg_urls
+
+# example run (writes synthetic fixtures on the first run, drop saved pages into the same folders to use real ones):
+# python -m imageprep.src.bench.bench_extract --fixtures data/fixtures/html
+
+# what LPSG read through WebDriver per page before: get_attachments once, get_pintwimg_imgs six times
+LEGACY_LPSG_PAGE_SOURCE_READS = 7
+
+
+def legacy_lpsg_urls(html: str) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    # LPSG.get_attachments and LPSG.get_pintwimg_imgs before the single-pass extractor
+    attachments = set(re.findall(r'https://www.lpsg.com/attachments/.*?(?=")', html))
+    others = set(re.findall(r'https://i.pinimg.com/.*?(?=")', html))
+    others.update(set(re.findall(r'https://pbs.twimg.com/.*?(?=")', html)))
+    others.update(set(re.findall(r'https://.*?\.jpg.*?(?=")', html)))
+    others.update(set(re.findall(r'https://.*?\.jpeg.*?(?=")', html)))
+    others.update(set(re.findall(r'https://.*?\.png.*?(?=")', html)))
+    return sorted(attachments), sorted(others)
+
+
+def legacy_adonis_imgs(html: str) -> tp.List[tp.Tuple[str, int, int]]:
+    # Adonis.parse_page and Adonis.parse_tags before the single-pass extractor
+    imgs = []
+    for tag in re.findall(r'<img[^>]*src="//cdngallery\.adonismale\.com[^>]*>', html):
+        width_search = re.search(r'width="([^"]+)"', tag)
+        height_search = re.search(r'height="([^"]+)"', tag)
+        src_search = re.search(r'src="([^"]+)"', tag)
+        if width_search and height_search and src_search:
+            imgs.append((src_search.group(1)[2:], int(width_search.group(1)), int(height_search.group(1))))
+    return imgs
+
+
+def synthetic_lpsg_page(n_posts: int, rng: random.Random) -> str:
+    # xenforo-ish thread page: attachments with thumbnails, avatars, embeds and a pile of markup
+    parts = ['<html><head><script>var config = {"url": "https://www.lpsg.com/", "ver": 2};</script></head><body>']
+    for i in range(n_posts):
+        user = rng.randint(1, 10**6)
+        parts.append(
+            f'<article class="message" data-author="user{user}">'
+            f'<a href="/members/user{user}.{user}/" class="avatar">'
+            f'<img src="https://www.lpsg.com/data/avatars/m/{user // 1000}/{user}.jpg?{rng.randint(10**9, 2*10**9)}" '
+            f'alt="user{user}" width="96" height="96" loading="lazy"></a>'
+            '<div class="bbWrapper">' + 'lorem ipsum dolor sit amet ' * rng.randint(5, 40)
+        )
+        for _ in range(rng.randint(0, 4)):
+            att = rng.randint(10**6, 10**7)
+            ext = rng.choice(['jpg', 'jpeg', 'png', 'webp'])
+            parts.append(
+                f'<a href="https://www.lpsg.com/attachments/img_{att}-{ext}.{att}/" target="_blank">'
+                f'<img src="https://www.lpsg.com/data/attachments/{att // 1000}/{att}-thumb.{ext}" '
+                f'alt="img_{att}.{ext}" class="bbImage" width="250" height="250"></a>'
+            )
+        if rng.random() < 0.2:
+            parts.append(f'<img src="https://i.pinimg.com/originals/{rng.randint(10, 99)}/ab/{rng.getrandbits(64):x}.jpg" class="bbImage">')
+        if rng.random() < 0.2:
+            parts.append(f'<img src="https://pbs.twimg.com/media/{rng.getrandbits(48):x}?format=jpg&amp;name=large" class="bbImage">')
+        if rng.random() < 0.1:
+            parts.append(f'<a href="https://imgur.com/{rng.getrandbits(32):x}" rel="nofollow">https://imgur.com/{rng.getrandbits(32):x}</a>')
+        parts.append('</div></article>\n')
+    parts.append('<nav><a href="/threads/synthetic.1/page-2" class="pageNav-jump--next">Next</a></nav></body></html>')
+    return ''.join(parts)
+
+
+def synthetic_adonis_page(n_imgs: int, rng: random.Random) -> str:
+    # invision gallery page: cdn thumbnails with their attributes in varying order, plus other images
+    parts = ['<html><body><div class="ipsGrid">']
+    for _ in range(n_imgs):
+        w, h = rng.choice([(800, 1200), (1200, 1800), (1600, 1067), (400, 600)])
+        src = f'//cdngallery.adonismale.com/monthly_2023_{rng.randint(1, 12):02d}/large.{rng.getrandbits(64):x}.jpg'
+        attrs = [f'width="{w}"', f'height="{h}"', f'src="{src}"', 'alt=""', 'loading="lazy"', 'class="ipsImage"']
+        rng.shuffle(attrs)
+        parts.append(f'<li class="ipsGrid_span3"><a href="https://www.adonismale.com/gallery/image/{rng.randint(1, 10**6)}/">'
+                     f'<img {" ".join(attrs)}></a></li>\n')
+        if rng.random() < 0.3:
+            parts.append(f'<img src="https://www.adonismale.com/uploads/emoticons/{rng.getrandbits(16):x}.png" width="20" height="20">')
+    parts.append('</div><a class="ipsPagination_next" href="?page=2">Next</a></body></html>')
+    return ''.join(parts)
+
+
+def write_synthetic_fixtures(fixtures_dir: str, n_pages: int = 8, seed: int = 0):
+    rng = random.Random(seed)
+    for site, make_page, size in (('lpsg', synthetic_lpsg_page, 40), ('adonis', synthetic_adonis_page, 120)):
+        site_dir = os.path.join(fixtures_dir, site)
+        os.makedirs(site_dir, exist_ok=True)
+        for i in range(n_pages):
+            with open(os.path.join(site_dir, f'synthetic_{i}.html'), 'w') as f:
+                f.write(make_page(size, rng))
+
+
+def best_time(fn: tp.Callable[[], tp.Any], repeats: int) -> tp.Tuple[float, tp.Any]:
+    best = float('inf')
+    out = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def bench_site(pages: tp.List[str], new_fn: tp.Callable, legacy_fn: tp.Callable, repeats: int) -> dict:
+    new_s, new_out = best_time(lambda: [new_fn(html) for html in pages], repeats)
+    legacy_s, legacy_out = best_time(lambda: [legacy_fn(html) for html in pages], repeats)
+    n_bytes = sum(len(html) for html in pages)
+    return {
+        'n_pages': len(pages),
+        'mb': n_bytes / 2**20,
+        'legacy_ms_per_page': 1000 * legacy_s / len(pages),
+        'single_pass_ms_per_page': 1000 * new_s / len(pages),
+        'speedup': legacy_s / new_s,
+        'pages_differing': sum(a != b for a, b in zip(new_out, legacy_out)),
+    }
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--fixtures', type=str, required=False, default='data/fixtures/html',
+                      help='folder with lpsg/*.html and adonis/*.html saved pages')
+    args.add_argument('--repeats', type=int, default=5)
+    args.add_argument('--output', type=str, required=False, default=None, help='write results as json')
+    args = args.parse_args()
+    if not glob.glob(os.path.join(args.fixtures, '*', '*.html')):
+        print(f'no fixtures in {args.fixtures}, writing synthetic pages')
+        write_synthetic_fixtures(args.fixtures)
+    results = {}
+    for site, new_fn, legacy_fn in (
+        ('lpsg', extract_lpsg_urls, legacy_lpsg_urls),
+        ('adonis', extract_adonis_imgs, legacy_adonis_imgs),
+    ):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(args.fixtures, site, '*.html'))):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                pages.append(f.read())
+        if not pages:
+            continue
+        results[site] = bench_site(pages, new_fn, legacy_fn, args.repeats)
+        r = results[site]
+        print(
+            f"{site:7s} {r['n_pages']} pages ({r['mb']:.1f}MB): legacy {r['legacy_ms_per_page']:.2f}ms/page, "
+            f"single pass {r['single_pass_ms_per_page']:.2f}ms/page, x{r['speedup']:.1f}, "
+            f"{r['pages_differing']} pages with different output"
+        )
+    print(f'lpsg page_source reads per page: {LEGACY_LPSG_PAGE_SOURCE_READS} before, 1 now')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,241 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+import requests
+
+from imageprep.src.bench.bench_extract import (
+    bench_site, legacy_adonis_imgs, legacy_lpsg_urls, write_synthetic_fixtures
+)
+from imageprep.src.collection.blob_store import BlobStore
+from imageprep.src.collection.download_engine import DownloadEngine
+from imageprep.src.collection.extract import extract_adonis_imgs, extract_lpsg_urls
+from imageprep.src.collection.rate_limit import RateLimiter
+from imageprep.src.collection.stub_server import StubServer
+from imageprep.src.quality.cv_quality import CVQuality
+
+# offline benchmarks of the three hot paths: quality scoring on synthetic images, url extraction on
+# recorded (or synthetic) pages, and downloads from a local server with set latency and bandwidth.
+# Results go to json with the commit they ran on, --compare flags regressions against an older run.
+# example run:
+# python -m imageprep.src.bench.bench_suite --output data/bench/$(git rev-parse --short HEAD).json
+# python -m imageprep.src.bench.bench_suite --compare data/bench/old.json --only quality
+
+SUITES = ('quality', 'extract', 'download')
+QUALITY_SIZES = (512, 1024, 2048)
+QUALITY_FORMATS = ('jpg', 'png', 'webp')
+# a slower run than this fraction of the reference counts as a regression
+REGRESSION_TOLERANCE = .1
+
+
+def run_meta() -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def best_of(fn: tp.Callable[[], tp.Any], repeats: int) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def write_quality_images(out_dir: str, size: int, fmt: str, n_images: int, seed: int = 0) -> tp.List[str]:
+    # blurred noise at several strengths so every cascade stage gets to run and to reject
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_images):
+        img = rng.integers(0, 256, (size, size * 3 // 2, 3), dtype=np.uint8)
+        img = cv2.GaussianBlur(img, (0, 0), 0.5 + i % 4)
+        path = os.path.join(out_dir, f'{size}_{i}.{fmt}')
+        cv2.imwrite(path, img)
+        paths.append(path)
+    return paths
+
+
+def bench_quality(work_dir: str, n_images: int, repeats: int) -> dict:
+    configs = {
+        'full': CVQuality(),
+        'cascade': CVQuality(cascade=True),
+        'max_pixels_1mp': CVQuality(max_pixels=1024*1024),
+    }
+    results = {}
+    for fmt in QUALITY_FORMATS:
+        for size in QUALITY_SIZES:
+            paths = write_quality_images(work_dir, size, fmt, n_images)
+            for name, cvq in configs.items():
+                seconds = best_of(lambda: [cvq.calculate_quality(path) for path in paths], repeats)
+                results[f'{name}/{fmt}/{size}'] = {
+                    'images_per_s': n_images / seconds,
+                    'ms_per_image': 1000 * seconds / n_images,
+                }
+            for path in paths:
+                os.remove(path)
+    return results
+
+
+def bench_extract(fixtures_dir: str, repeats: int) -> dict:
+    if not glob.glob(os.path.join(fixtures_dir, '*', '*.html')):
+        write_synthetic_fixtures(fixtures_dir)
+    results = {}
+    for site, new_fn, legacy_fn in (
+        ('lpsg', extract_lpsg_urls, legacy_lpsg_urls),
+        ('adonis', extract_adonis_imgs, legacy_adonis_imgs),
+    ):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, site, '*.html'))):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                pages.append(f.read())
+        if pages:
+            r = bench_site(pages, new_fn, legacy_fn, repeats)
+            results[site] = {
+                'pages_per_s': 1000 / r['single_pass_ms_per_page'],
+                'ms_per_page': r['single_pass_ms_per_page'],
+                'legacy_ms_per_page': r['legacy_ms_per_page'],
+            }
+    return results
+
+
+def bench_download(work_dir: str, n_images: int, img_kb: int, latency: float, bandwidth: float) -> dict:
+    rng = np.random.default_rng(0)
+    # noise barely compresses, so the jpegs stay close to the asked size
+    side = int((img_kb * 1024 / 1.5) ** .5)
+    body = cv2.imencode('.jpg', rng.integers(0, 256, (side, side, 3), dtype=np.uint8))[1].tobytes()
+    # every image distinct, so the blob store writes them all
+    routes = {f'/{i}.jpg': body + i.to_bytes(4, 'big') for i in range(n_images)}
+    n_bytes = sum(len(b) for b in routes.values())
+    results = {}
+    with StubServer(routes, latency=latency, bandwidth=bandwidth) as stub:
+        urls = [stub.url(f'/{i}.jpg') for i in range(n_images)]
+
+        def serial_requests():
+            # the collectors before the engine: one blocking get per image
+            out_dir = tempfile.mkdtemp(dir=work_dir)
+            with requests.Session() as session:
+                for i, url in enumerate(urls):
+                    with open(os.path.join(out_dir, f'{i}.jpg'), 'wb') as f:
+                        f.write(session.get(url, timeout=30).content)
+
+        def engine(store: bool):
+            def run():
+                out_dir = tempfile.mkdtemp(dir=work_dir)
+                # the limiter would measure its own ramp-up here, not the download path
+                limiter = RateLimiter(initial_rate=1e6, max_rate=1e6, burst=1e6, verbose=False)
+                blobs = BlobStore(os.path.join(out_dir, 'blobs')) if store else None
+                with DownloadEngine(limiter=limiter, store=blobs) as e:
+                    results = e.download_many([(url, os.path.join(out_dir, f'{i}.jpg')) for i, url in enumerate(urls)])
+                assert all(r.ok for r in results)
+            return run
+
+        for name, fn in (
+            ('serial_requests', serial_requests),
+            ('engine', engine(False)),
+            ('engine_blob_store', engine(True)),
+        ):
+            seconds = best_of(fn, 1)
+            results[name] = {
+                'images_per_s': n_images / seconds,
+                'mb_per_s': n_bytes / 2**20 / seconds,
+            }
+    return results
+
+
+def flatten(results: dict, prefix: str = '') -> tp.Dict[str, float]:
+    # 'quality/full/jpg/512/images_per_s' -> value
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}/'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results: dict, reference: dict, tolerance: float = REGRESSION_TOLERANCE) -> tp.List[str]:
+    # throughputs (*_per_s) should not drop, times (ms_*) should not rise
+    new = flatten(results)
+    old = flatten(reference)
+    regressions = []
+    for key in sorted(new.keys() & old.keys()):
+        if not old[key]:
+            continue
+        change = new[key] / old[key] - 1.
+        if key.endswith('_per_s'):
+            regressed = change < -tolerance
+        elif key.split('/')[-1].startswith('ms_'):
+            regressed = change > tolerance
+        else:
+            continue
+        flag = ' REGRESSION' if regressed else ''
+        print(f'{key}: {old[key]:.2f} -> {new[key]:.2f} ({change:+.1%}){flag}')
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--only', type=str, nargs='+', choices=SUITES, default=list(SUITES))
+    args.add_argument('--n_images', type=int, default=8, help='images per quality configuration')
+    args.add_argument('--repeats', type=int, default=3)
+    args.add_argument('--fixtures', type=str, default='data/fixtures/html', help='recorded pages, lpsg/*.html and adonis/*.html')
+    args.add_argument('--n_downloads', type=int, default=64)
+    args.add_argument('--img_kb', type=int, default=300)
+    args.add_argument('--latency', type=float, default=.05, help='stub server seconds before each response')
+    args.add_argument('--bandwidth', type=float, default=4*2**20, help='stub server bytes/s per response')
+    args.add_argument('--threads', type=int, default=1, help='cv2.setNumThreads, 1 for stable numbers')
+    args.add_argument('--output', type=str, required=False, default=None, help='write results as json')
+    args.add_argument('--compare', type=str, required=False, default=None, help='earlier --output to check against')
+    args.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = args.parse_args()
+    cv2.setNumThreads(args.threads)
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='imageprep_bench_')
+    try:
+        if 'quality' in args.only:
+            results['quality'] = bench_quality(work_dir, args.n_images, args.repeats)
+        if 'extract' in args.only:
+            results['extract'] = bench_extract(args.fixtures, args.repeats)
+        if 'download' in args.only:
+            results['download'] = bench_download(work_dir, args.n_downloads, args.img_kb, args.latency, args.bandwidth)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for key, value in flatten(results).items():
+        print(f'{key}: {value:.2f}')
+    output = {'meta': run_meta(), 'params': vars(args), 'results': results}
+    if args.output:
+        out_dir = os.path.dirname(args.output)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            reference = json.load(f)
+        regressions = compare(results, reference['results'], args.tolerance)
+        if regressions:
+            raise SystemExit(f'{len(regressions)} regressions against {args.compare}')
@@ -0,0 +1,93 @@
+import argparse
+import os
+import runpy
+import sys
+import typing as tp
+
+# the `imageprep` console command: `imageprep <command> [args]` runs that module's own CLI, imported
+# only once the command is known, so `imageprep status` and `--help` never load selenium or cv2
+# example runs:
+# imageprep run --lpsg https://www.lpsg.com/threads/drazenpn.5832241/ --output_dir data/test --shards_dir data/shards
+# imageprep status --output_dir data/test --shards_dir data/shards --index_dir data/index
+# imageprep quality data/test --output data/test/scores.jsonl --workers 8
+
+# command -> (module, what it does)
+COMMANDS = {
+    'run': ('imageprep.src.pipeline', 'collect, size check, score and export in one streaming pass'),
+    'lpsg': ('imageprep.src.collection.lpsg', 'collect an LPSG thread'),
+    'adonis': ('imageprep.src.collection.adonismale', 'collect Adonismale galleries'),
+    'quality': ('imageprep.src.quality.batch_quality', 'score image folders'),
+    'cache': ('imageprep.src.quality.quality_cache', 're-filter cached quality metrics'),
+    'near_dup': ('imageprep.src.quality.near_dup', 'find near-duplicate images'),
+    'jpeg': ('imageprep.src.quality.jpeg_prescreen', 'JPEG quality estimates from the headers alone'),
+    'buckets': ('imageprep.src.preprocess.buckets', 'resize into aspect-ratio buckets'),
+    'shards': ('imageprep.src.export.shards', 'export to WebDataset tar shards'),
+    'index': ('imageprep.src.index.corpus_index', 'update and query the corpus index'),
+    'manifest': ('imageprep.src.collection.crawl_manifest', 'crawl progress'),
+    'sessions': ('imageprep.src.collection.session', 'saved browser logins'),
+    'blobs': ('imageprep.src.collection.blob_store', 'blob store dedup stats'),
+    'stub': ('imageprep.src.collection.stub_server', 'local stand-in for the image hosts'),
+    'metrics': ('imageprep.src.utils.metrics', 'print a metrics snapshot'),
+    'bench': ('imageprep.src.bench.bench_suite', 'offline benchmarks'),
+}
+
+
+def status(argv: tp.List[str]):
+    # crawl, export and index state in one look; sqlite and numpy only
+    args = argparse.ArgumentParser(prog='imageprep status')
+    args.add_argument('--output_dir', type=str, default='data/test', help="the collectors' output_dir")
+    args.add_argument('--shards_dir', type=str, required=False, default=None)
+    args.add_argument('--index_dir', type=str, required=False, default=None)
+    args = args.parse_args(argv)
+    # status only reads, CorpusIndex would create a missing index dir
+    if args.index_dir and not os.path.isdir(args.index_dir):
+        raise SystemExit(f'no index at {args.index_dir}')
+    from imageprep.src.collection.crawl_manifest import MANIFEST_NAME, CrawlManifest
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with CrawlManifest(manifest_path) as manifest:
+            totals = {}
+            crawls = set()
+            for crawl, state, n_urls, n_bytes in manifest.summary():
+                crawls.add(crawl)
+                n, b = totals.get(state, (0, 0))
+                totals[state] = (n + n_urls, b + n_bytes)
+        states = ', '.join(f'{n} {state}' for state, (n, _) in sorted(totals.items()))
+        kept_bytes = totals.get('done', (0, 0))[1]
+        print(f'crawls: {len(crawls)} galleries, {states}, {kept_bytes / 2**30:.2f}GB kept')
+    else:
+        print(f'crawls: no manifest at {manifest_path}')
+    if args.shards_dir:
+        from imageprep.src.export.shards import read_index, shard_paths
+        paths = shard_paths(args.shards_dir)
+        n_samples = sum(len(read_index(path)) for path in paths)
+        n_bytes = sum(os.path.getsize(path) for path in paths)
+        print(f'shards: {len(paths)} shards, {n_samples} samples, {n_bytes / 2**30:.2f}GB')
+    if args.index_dir:
+        from imageprep.src.index.corpus_index import CorpusIndex
+        print(f'index: {CorpusIndex(args.index_dir).summary()}')
+
+
+def main(argv: tp.List[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    commands = '\n'.join(f'  {name:<10}{help}' for name, (_, help) in COMMANDS.items())
+    args = argparse.ArgumentParser(
+        prog='imageprep',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f'commands:\n  {"status":<10}crawl, shard and index state\n{commands}\n\n'
+               'imageprep <command> --help shows its own arguments',
+    )
+    args.add_argument('command', choices=['status', *COMMANDS], metavar='command')
+    args.add_argument('args', nargs=argparse.REMAINDER)
+    args = args.parse_args(argv)
+    if args.command == 'status':
+        status(args.args)
+        return
+    module, _ = COMMANDS[args.command]
+    # the module runs as __main__ so process pool workers can find its functions, as with python -m
+    sys.argv = [f'imageprep {args.command}', *args.args]
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,37 @@
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import io
 import json
 import os
-from PIL import Image, UnidentifiedImageError
 import requests
-import re
 import random
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 import time
-from selenium.common.exceptions import ElementNotInteractableException
+from selenium.common.exceptions import ElementNotInteractableException, TimeoutException
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 import subprocess
+import threading
+import typing as tp
+
+from imageprep.src.collection.blob_store import BlobStore
+from imageprep.src.collection.crawl_manifest import MANIFEST_NAME, CrawlManifest, next_free_index, record_rows
+from imageprep.src.collection.download_engine import DownloadEngine, DownloadResult
+from imageprep.src.collection.extract import (
+    adonis_next_url, adonis_page_count, extract_adonis_imgs, is_challenge, with_page_no
+)
+from imageprep.src.collection.rate_limit import RateLimiter, shared_limiter
+from imageprep.src.collection.scheduler import N_TRIES, GalleryJob, GalleryScheduler
+from imageprep.src.collection.session import SESSION_DIR, BrowserSession
+from imageprep.src.collection.stub_server import record_page
+from imageprep.src.pipeline import PipelineStopped
+from imageprep.src.quality.inline_gate import SCORES_NAME, InlineGate, add_gate_args, append_scores, gate_from_args
+from imageprep.src.quality.jpeg_prescreen import header_check
+from imageprep.src.utils.metrics import METRICS, add_metrics_args, enable_from_args, export_from_args
 
 # example run:
-# python imageprep/src/collection/adonismale.py --gallery_url 'https://www.adonismale.com/gallery/album/69775-%F0%9F%96%8C-with-the-pencil-erect/' --output_dir data/test/
+# python -m imageprep.src.collection.adonismale --gallery_url 'https://www.adonismale.com/gallery/album/69775-%F0%9F%96%8C-with-the-pencil-erect/' --output_dir data/test/
 # should download 64 images
 
 
@@ -24,39 +39,235 @@ import subprocess
 CHROME_PATH = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'
 # this will save a new Profile in the data directory
 CHROME_USER_DATA_DIR = 'data/Library/Application Support/Google/Chrome/Profile 1'
+# scheduler worker i gets this port + i and its own profile next to the one above
+DEBUG_PORT = 9222
 # set these to your own user email and password
 ADONISMALE_EMAIL = ''
 ADONISMALE_PASSWORD = ''
 MIN_IMG_SIZE = 1024*1024
+FETCH_MODES = ('browser', 'http')
+# gallery pages fetched at once in http mode
+PAGE_CONCURRENCY = 4
+ADONIS_HOME_URL = 'https://www.adonismale.com/'
+ADONIS_LOGIN_URL = 'https://www.adonismale.com/login/'
+# invision's user menu, only rendered for members
+ADONIS_LOGGED_IN_MARKER = 'id="elUserLink"'
 
 
-def download_and_save(j: int, url: str, img_dir: str, max_i: int):
+def download_and_save(
+    j: int,
+    url: str,
+    img_dir: str,
+    max_i: int,
+    engine: DownloadEngine,
+    reencode: bool = False,
+    accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+) -> tp.Optional[DownloadResult]:
     if '.gif' not in url:
+        save_path = os.path.join(img_dir, f"{max_i + j + 1}.{url.split('.')[-1]}")
+        if not reencode:
+            # original bytes straight to disk, only the header is checked; pixels get decoded
+            # later by whichever stage needs them
+            result = engine.download('https://' + url, save_path, accept_header=accept_header)
+            if result.header_rejected:
+                print(f'{j}: low jpeg quality')
+            elif not result.ok and result.error is None and is_gate_reject(result):
+                print(f'{j}: low quality')
+            elif not result.ok:
+                print(f"{j}: {result.error or f'not an image (HTTP {result.status})'}")
+            return result
+        # only the old re-encoding path needs PIL
+        from PIL import Image, UnidentifiedImageError
         try:
-            img = Image.open(requests.get('https://' + url, stream=True).raw)
+            response = engine.request('https://' + url)
+            img = Image.open(io.BytesIO(response.content))
             # save with the same file extension as the original
-            img.save(os.path.join(img_dir, f"{max_i + j + 1}.{url.split('.')[-1]}"))
+            img.save(save_path)
+            return DownloadResult(url, save_path, True, response.status_code, None, 1)
         except UnidentifiedImageError:
             print(f"{j}: UnidentifiedImageError")
-        except OSError:
+            return DownloadResult(url, None, False, 200, None, 1)
+        except OSError as e:
             print(f"{j}: OSError")
+            return DownloadResult(url, None, False, None, str(e), 1)
+        except requests.RequestException as e:
+            print(f"{j}: {e}")
+            return DownloadResult(url, None, False, None, str(e), 1)
+
 
+def is_gate_reject(result: DownloadResult) -> bool:
+    # decoded and scored by the inline gate, as opposed to a body that didn't decode at all
+    return result.gate is not None and result.gate.error is None
 
-def download_images(urls: list[str], gal_dir: str):
+
+def download_images(
+    urls: list[str],
+    gal_dir: str,
+    engine: DownloadEngine = None,
+    reencode: bool = False,
+    blob_dir: str = None,
+    manifest: CrawlManifest = None,
+    on_saved: tp.Callable[[str], None] = None,
+    gate: InlineGate = None,
+    jpeg_quality_threshold: float = None,
+    limiter: RateLimiter = None,
+):
     img_dir = os.path.join(gal_dir, 'imgs')
     os.makedirs(img_dir, exist_ok=True)
-    current_files = list(os.listdir(img_dir))
-    if len(current_files) > 0:
-        max_i = max([int(f.split('.')[0]) for f in current_files])
-    else:
-        max_i = 0
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    top_dir = os.path.dirname(os.path.normpath(gal_dir))
+    # the manifest skips urls finished by an earlier (possibly crashed) run and hands out file indices
+    crawl = f'adonis/{os.path.basename(os.path.normpath(gal_dir))}'
+    own_manifest = manifest is None
+    if own_manifest:
+        manifest = CrawlManifest(os.path.join(top_dir, MANIFEST_NAME))
+    if not manifest.has_counter(crawl):
+        manifest.reserve_indices(crawl, 0, start=max(1, next_free_index(img_dir)))
+    finished_urls = manifest.finished_urls(crawl)
+    urls = [url for url in urls if url not in finished_urls]
+    manifest.add_urls(crawl, urls)
+    # one engine reuses keep-alive connections to the cdn across batches; images land once in
+    # the blob store next to the galleries and imgs/ holds links to them
+    own_engine = engine is None
+    if own_engine:
+        if blob_dir is None:
+            blob_dir = os.path.join(top_dir, 'blobs')
+        engine = DownloadEngine(
+            max_workers=10, store=BlobStore(blob_dir), limiter=limiter or shared_limiter(), gate=gate
+        )
+    # the same image posted twice in a gallery is kept once
+    seen_hashes = manifest.content_hashes(crawl)
+    # heavily recompressed JPEGs are cancelled once their quantization tables have been read
+    accept_header = header_check(jpeg_quality_threshold) if jpeg_quality_threshold is not None else None
+    try:
         for i in range(0, len(urls), 128):
             batch_urls = urls[i:i+128]
-            list(executor.map(lambda j, url: download_and_save(j+i, url, img_dir, max_i), 
-                            range(len(batch_urls)), batch_urls))
-            if i + 128 < len(urls):  # Don't sleep after the last batch
-                time.sleep(5)
+            first_index = manifest.reserve_indices(crawl, len(batch_urls))
+            with METRICS.timer('download_batch'):
+                results = list(engine.executor.map(lambda j, url: download_and_save(j, url, img_dir, first_index - 1, engine, reencode, accept_header),
+                                range(len(batch_urls)), batch_urls))
+            # (url, state, bytes, final_path, content_hash, error) for the manifest
+            rows = []
+            scores = []
+            for url, result in zip(batch_urls, results):
+                if result is None:
+                    rows.append((url, 'rejected', None, None, None, 'gif'))
+                elif result.error is not None or result.status != 200:
+                    rows.append((url, 'failed', None, None, None, result.error or f'HTTP {result.status}'))
+                elif result.header_rejected:
+                    rows.append((url, 'rejected', None, None, None, 'low jpeg quality'))
+                elif not result.ok and is_gate_reject(result):
+                    rows.append((url, 'rejected', None, None, None, 'low quality'))
+                elif not result.ok:
+                    rows.append((url, 'rejected', None, None, None, 'not an image'))
+                elif result.content_hash is not None and result.content_hash in seen_hashes:
+                    os.remove(result.save_path)
+                    rows.append((url, 'rejected', None, None, result.content_hash, 'duplicate'))
+                else:
+                    if result.content_hash is not None:
+                        seen_hashes.add(result.content_hash)
+                    rows.append((
+                        url, 'done', os.path.getsize(result.save_path), result.save_path, result.content_hash, None
+                    ))
+                    if result.gate is not None:
+                        scores.append((result.save_path, result.gate))
+            # the gate already scored what it kept, batch_quality and the exporters read these instead
+            append_scores(os.path.join(gal_dir, SCORES_NAME), scores)
+            manifest.mark_urls(crawl, rows)
+            record_rows(rows)
+            if on_saved is not None:
+                # after the manifest, so a consumer never sees an image the crawl could still drop
+                for row in rows:
+                    if row[1] == 'done':
+                        on_saved(row[3])
+    finally:
+        if own_engine:
+            if engine.store is not None:
+                print(engine.store.summary())
+            if engine.gate is not None:
+                print(engine.gate.summary())
+            print(engine.limiter.summary())
+            engine.close()
+        if own_manifest:
+            manifest.close()
+
+
+def worker_profile(worker_id: int) -> tp.Tuple[int, str]:
+    # (debugging port, chrome profile dir) of a scheduler worker; worker 0 keeps the original pair
+    if worker_id == 0:
+        return DEBUG_PORT, CHROME_USER_DATA_DIR
+    return DEBUG_PORT + worker_id, f'{CHROME_USER_DATA_DIR} worker {worker_id}'
+
+
+def open_chrome(port: int = DEBUG_PORT, user_data_dir: str = CHROME_USER_DATA_DIR):
+    subprocess.Popen(
+        [
+            CHROME_PATH,
+            f'-remote-debugging-port={port}',
+            '--incognito',
+            f"--user-data-dir={user_data_dir}",
+            'https://adonismale.com/login/'
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    time.sleep(3)
+    print('opened chrome')
+
+
+def attach_selenium(port: int = DEBUG_PORT) -> webdriver.Chrome:
+    print('attaching selenium')
+    # incognito
+    chrome_options = Options()
+    chrome_options.add_experimental_option("debuggerAddress", f"127.0.0.1:{port}")
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--no-sandbox')
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    # maximize window
+    driver.maximize_window()
+    if is_challenge(driver.page_source):
+        raise Exception('Cloudflare detected')
+    return driver
+
+
+def open_browser(port: int = DEBUG_PORT, user_data_dir: str = CHROME_USER_DATA_DIR) -> webdriver.Chrome:
+    open_chrome(port, user_data_dir)
+    return attach_selenium(port)
+
+
+def login(driver: webdriver.Chrome):
+    print('logging in')
+    if driver.find_elements(By.NAME, 'auth') == []:
+        driver.get(ADONIS_LOGIN_URL)
+        time.sleep(random.randint(1, 3))
+    input_email = driver.find_element(By.NAME, 'auth')
+    email = ADONISMALE_EMAIL
+    for char in email:
+        input_email.send_keys(char)
+        time.sleep(random.randint(1, 3) / 10.)
+    input_password = driver.find_element(By.NAME, 'password')
+    pw = ADONISMALE_PASSWORD
+    for char in pw:
+        input_password.send_keys(char)
+        time.sleep(random.randint(1, 3) / 10.)
+    signin_button = driver.find_element(By.NAME, '_processLogin')
+    driver.execute_script("arguments[0].click();", signin_button)
+    time.sleep(random.randint(1, 3))
+    if is_challenge(driver.page_source):
+        raise Exception('Cloudflare detected')
+
+
+def adonis_session(session_dir: str = SESSION_DIR, worker_id: int = 0) -> BrowserSession:
+    port, user_data_dir = worker_profile(worker_id)
+    return BrowserSession(
+        'adonismale',
+        ADONIS_HOME_URL,
+        lambda: open_browser(port, user_data_dir),
+        login,
+        ADONIS_LOGGED_IN_MARKER,
+        session_dir=session_dir,
+    )
 
 
 class Adonis:
@@ -65,7 +276,14 @@ class Adonis:
         gallery_url: str,
         top_dir: str,
         subdir: str = None,
+        fetch_mode: str = 'browser',
+        page_concurrency: int = PAGE_CONCURRENCY,
+        record_dir: str = None,
+        session: BrowserSession = None,
+        limiter: RateLimiter = None,
     ):
+        if fetch_mode not in FETCH_MODES:
+            raise ValueError(f'unknown fetch mode {fetch_mode}')
         gal_name = gallery_url.split('album/')[1].replace('/', '')
         if subdir:
             top_dir = os.path.join(top_dir, subdir)
@@ -76,66 +294,32 @@ class Adonis:
         self.gallery_url = gallery_url
         self.subdir = subdir
         self.driver = None
+        # http: the browser logs in and opens the gallery, the remaining pages are plain GETs with its
+        # cookies and selenium only comes back for challenges
+        self.fetch_mode = fetch_mode
+        self.page_concurrency = page_concurrency
+        self.record_dir = record_dir
+        self.n_fallbacks = 0
+        # page fetches run on a pool but there is one browser
+        self.browser_lock = threading.Lock()
+        # paces page loads, by click or by http, per host; shared with the image downloads and
+        # every other gallery, so what a host's 429s taught carries over
+        self.limiter = limiter or shared_limiter()
+        # a batch passes one session to all its galleries, so the browser and its login are reused
+        self.owns_session = session is None
+        self.session = session or adonis_session()
 
     def run(self):
         if os.path.exists(self.url_txt):
             return
-        self.setup()
+        self.driver = self.session.ensure()
         self.navigate_to_gallery()
-        self.loop_through_pages()
+        if self.fetch_mode == 'http':
+            self.fetch_pages_http()
+        else:
+            self.loop_through_pages()
         self.onefile()
-        self.cleanup()
-
-    def setup(self):
-        self.open_chrome()
-        self.attach_selenium()
-        self.login()
-
-    def open_chrome(self):
-        subprocess.Popen(
-            [
-                CHROME_PATH,
-                '-remote-debugging-port=9222',
-                '--incognito',
-                f"--user-data-dir={CHROME_USER_DATA_DIR}",
-                'https://adonismale.com/login/'
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        time.sleep(3)
-        print('opened chrome')
-
-    def attach_selenium(self):
-        print('attaching selenium')
-        # incognito
-        chrome_options = Options()
-        chrome_options.add_experimental_option("debuggerAddress", "127.0.0.1:9222")
-        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--no-sandbox')
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        # maximize window
-        self.driver.maximize_window()
-        self.check_cloudflare()
-
-    def login(self):
-        print('logging in')
-        input_email = self.driver.find_element(By.NAME, 'auth')
-        email = ADONISMALE_EMAIL
-        for char in email:
-            input_email.send_keys(char)
-            time.sleep(random.randint(1, 3) / 10.)
-        input_password = self.driver.find_element(By.NAME, 'password')
-        pw = ADONISMALE_PASSWORD
-        for char in pw:
-            input_password.send_keys(char)
-            time.sleep(random.randint(1, 3) / 10.)
-        signin_button = self.driver.find_element(By.NAME, '_processLogin')
-        self.driver.execute_script("arguments[0].click();", signin_button)
-        time.sleep(random.randint(1, 3))
-        self.check_cloudflare()
+        self.cleanup(failed=False)
 
     def navigate_to_gallery(self):
         self.driver.get(self.gallery_url)
@@ -164,38 +348,82 @@ class Adonis:
         start_time = time.time()
         i = 0
         while time.time() - start_time < timeout:
-            source_ = self.driver.page_source
+            with METRICS.timer('page_source'):
+                source_ = self.driver.page_source
             self.parse_page(source_, i)
             next_button = self.get_next_button()
             if next_button:
+                self.limiter.acquire(self.gallery_url)
+                start = time.time()
                 try:
-                    next_button.click()
-                    time.sleep(random.randint(1, 2))
-                except ElementNotInteractableException:
+                    with METRICS.timer('page_load'):
+                        next_button.click()
+                        # the old pagination is gone once the next page is in, instead of a fixed sleep
+                        WebDriverWait(self.driver, timeout=20).until(EC.staleness_of(next_button))
+                except (ElementNotInteractableException, TimeoutException):
                     break
+                self.limiter.observe(self.gallery_url, 200, time.time() - start)
             else:
                 break
             i += 1
 
-    def parse_tags(self, img_tag):
-        width_search = re.search(r'width="([^"]+)"', img_tag)
-        height_search = re.search(r'height="([^"]+)"', img_tag)
-        src_search = re.search(r'src="([^"]+)"', img_tag)
-        if width_search and height_search and src_search:
-            src = src_search.group(1)
-            width = width_search.group(1)
-            height = height_search.group(1) 
-            return src[2:], int(width), int(height)
-        else:
-            return None
+    def fetch_page_http(self, engine: DownloadEngine, page_url: str) -> str:
+        try:
+            with METRICS.timer('page_fetch'):
+                response = engine.request(page_url)
+            if response.status_code == 200 and not is_challenge(response.text):
+                return response.text
+        except requests.RequestException as e:
+            print(f'http fetch of {page_url} failed: {e}')
+        # challenge or block: let the browser through, then take its fresh cookies
+        with self.browser_lock:
+            print(f'falling back to the browser for {page_url}')
+            self.limiter.acquire(page_url)
+            self.driver.get(page_url)
+            self.check_cloudflare()
+            engine.set_cookies(self.driver.get_cookies())
+            self.n_fallbacks += 1
+            return self.driver.page_source
+
+    def fetch_pages_http(self):
+        # page 1 is already open in the browser with large thumbnails selected
+        html = self.driver.page_source
+        page_url = self.driver.current_url
+        if self.record_dir is not None:
+            record_page(self.record_dir, page_url, html)
+        self.parse_page(html, 0)
+        next_url = adonis_next_url(html, page_url)
+        if next_url is None:
+            return
+        n_pages = adonis_page_count(html)
+        with DownloadEngine(
+            max_workers=self.page_concurrency, per_host_limit=self.page_concurrency, limiter=self.limiter
+        ) as engine:
+            engine.set_cookies(self.driver.get_cookies())
+            engine.set_user_agent(self.driver.execute_script('return navigator.userAgent;'))
+            if n_pages is not None and with_page_no(next_url, 2) is not None:
+                # every page url is known up front, fetch them all at once
+                page_urls = [with_page_no(next_url, n) for n in range(2, n_pages + 1)]
+                htmls = engine.executor.map(lambda url: self.fetch_page_http(engine, url), page_urls)
+                for i, (page_url, html) in enumerate(zip(page_urls, htmls), start=1):
+                    if self.record_dir is not None:
+                        record_page(self.record_dir, page_url, html)
+                    self.parse_page(html, i)
+            else:
+                # no page count: follow the next links, still without the browser
+                i = 1
+                while next_url is not None:
+                    html = self.fetch_page_http(engine, next_url)
+                    if self.record_dir is not None:
+                        record_page(self.record_dir, next_url, html)
+                    self.parse_page(html, i)
+                    next_url = adonis_next_url(html, next_url)
+                    i += 1
+        print(f'{self.n_fallbacks} browser fallbacks')
 
     def parse_page(self, html_text: str, i: int):
-        imgs = []
-        tags = re.findall(r'<img[^>]*src="//cdngallery\.adonismale\.com[^>]*>', html_text)
-        for tag in tags:
-            img = self.parse_tags(tag)
-            if img:
-                imgs.append(img)
+        with METRICS.timer('extract'):
+            imgs = extract_adonis_imgs(html_text)
         large_imgs = [img for img in imgs if img[1]*img[2] >= MIN_IMG_SIZE]
         # write all urls to {gal_dir}/urls.txt
         with open(os.path.join(self.webpages_dir, f'{i}.txt'), 'w') as f:
@@ -215,68 +443,171 @@ class Adonis:
                 f.write(f"{img}\n")
 
     def check_cloudflare(self):
-        moment_check = 'Just a moment...' in self.driver.page_source
-        human_check = 'you are human' in self.driver.page_source
-        if moment_check or human_check:
+        if is_challenge(self.driver.page_source):
             self.cleanup()
             raise Exception('Cloudflare detected')
 
-    def cleanup(self):
-        if self.driver:
-            self.driver.close()
+    def cleanup(self, failed: bool = True):
+        if self.owns_session:
+            self.session.close()
+        elif failed:
+            # whatever went wrong, the shared browser gets checked before its next use
+            self.session.invalidate()
+
 
+def process_gallery_url(
+    gallery_url: str,
+    output_dir: str,
+    n_tries: int = N_TRIES,
+    reencode: bool = False,
+    fetch_mode: str = 'browser',
+    record_dir: str = None,
+    session: BrowserSession = None,
+    on_saved: tp.Callable[[str], None] = None,
+    gate: InlineGate = None,
+    jpeg_quality_threshold: float = None,
+    limiter: RateLimiter = None,
+    session_dir: str = SESSION_DIR,
+) -> tp.List[tp.Tuple[GalleryJob, str]]:
+    limiter = limiter or shared_limiter()
 
-def process_gallery_url(gallery_url: str, output_dir: str, n_tries: int = 3):
-    success = False
-    for i in range(n_tries):
-        if success:
-            continue
+    def run_job(job: GalleryJob, session: BrowserSession):
         adonis = Adonis(
-            gallery_url=gallery_url,
+            gallery_url=job.url,
             top_dir=output_dir,
+            fetch_mode=fetch_mode,
+            record_dir=record_dir,
+            session=session,
+            limiter=limiter,
         )
         try:
             adonis.run()
-            success = True
             with open(adonis.url_txt, 'r') as f:
                 urls = [url for url in f.read().strip().split('\n') if url]
-            download_images(urls=urls, gal_dir=adonis.gal_dir)
-        except Exception as e:
-            print(e)
+            download_images(
+                urls=urls,
+                gal_dir=adonis.gal_dir,
+                reencode=reencode,
+                on_saved=on_saved,
+                gate=gate,
+                jpeg_quality_threshold=jpeg_quality_threshold,
+                limiter=limiter,
+            )
+        except Exception:
             adonis.cleanup()
-            print(f'failed to process gallery {gallery_url} ({i+1}/{n_tries})')
-            print(f'sleeping for {i*30} seconds')
-            time.sleep(i*30)
+            raise
+
+    # a one gallery batch: retries wait on the scheduler's queue, and a stopped streaming pipeline
+    # (on_saved raised PipelineStopped) ends it without one. A session passed in stays open
+    scheduler = GalleryScheduler(
+        run_job,
+        lambda site, worker_id: session or adonis_session(session_dir),
+        n_tries=n_tries,
+        stop_on=(PipelineStopped,),
+        close_sessions=session is None,
+    )
+    scheduler.add('adonismale', gallery_url)
+    return scheduler.run()
 
 
-def process_gallery_json(gallery_json_path: str, output_dir: str, n_tries: int = 3):
+def process_gallery_json(
+    gallery_json_path: str,
+    output_dir: str,
+    n_tries: int = N_TRIES,
+    session_dir: str = SESSION_DIR,
+    n_workers: int = 1,
+    max_per_site: int = None,
+    fetch_mode: str = 'browser',
+    limiter: RateLimiter = None,
+    record_dir: str = None,
+) -> tp.List[tp.Tuple[GalleryJob, str]]:
+    # collects each gallery's image urls (url.txt) only, the downloads are a separate step
     with open(gallery_json_path, 'r') as f:
         gallery_json = json.load(f)
+    # one limiter for all workers, N browsers on a host still add up to the one adapted rate
+    limiter = limiter or shared_limiter()
+
+    def run_job(job: GalleryJob, session: BrowserSession):
+        adonis = Adonis(
+            gallery_url=job.url,
+            subdir=job.subdir,
+            top_dir=output_dir,
+            fetch_mode=fetch_mode,
+            record_dir=record_dir,
+            session=session,
+            limiter=limiter,
+        )
+        try:
+            adonis.run()
+        except Exception:
+            adonis.cleanup()
+            raise
+
+    # one browser and one login per worker for the whole batch
+    scheduler = GalleryScheduler(
+        run_job,
+        lambda site, worker_id: adonis_session(session_dir, worker_id),
+        n_workers=n_workers,
+        site_limits={'adonismale': max_per_site} if max_per_site else None,
+        n_tries=n_tries,
+    )
     for subdir in gallery_json.keys():
         for gallery_url in gallery_json[subdir]:
-            success = False
-            for i in range(n_tries):
-                if success:
-                    continue
-                adonis = Adonis(
-                    gallery_url=gallery_url,
-                    subdir=subdir,
-                    top_dir=output_dir,
-                )
-                try:
-                    adonis.run()
-                    success = True
-                    break
-                except Exception as e:
-                    print(e)
-                    adonis.cleanup()
-                    print(f'failed to process gallery {gallery_url} ({i+1}/{n_tries})')
-                    print(f'sleeping for {i*30} seconds')
-                    time.sleep(i*30)
+            scheduler.add('adonismale', gallery_url, subdir)
+    return scheduler.run()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gallery_url', type=str)
+    parser.add_argument('--gallery_json', type=str, default=None, help='{subdir: [gallery urls]}, collected on --workers browsers')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max_per_site', type=int, default=None, help='galleries open at once on the site')
     parser.add_argument('--output_dir', type=str)
+    parser.add_argument('--reencode', action='store_true', default=False, help='decode and re-save every image like before')
+    parser.add_argument('--fetch_mode', type=str, choices=FETCH_MODES, default='browser',
+                        help='http: fetch gallery pages without the browser after login')
+    parser.add_argument('--record_dir', type=str, default=None, help='save every fetched page here')
+    parser.add_argument('--session_dir', type=str, default=SESSION_DIR,
+                        help='saved login cookies, reused until the site logs us out')
+    add_gate_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
-    process_gallery_url(args.gallery_url, args.output_dir)
+    enable_from_args(args)
+    if args.gallery_json:
+        # a batch only collects urls, nothing for these to act on
+        download_flags = [
+            flag for flag, value in (
+                ('--reencode', args.reencode),
+                ('--quality_gate', args.quality_gate),
+                ('--jpeg_quality_threshold', args.jpeg_quality_threshold is not None),
+            ) if value
+        ]
+        if download_flags:
+            parser.error(f"{', '.join(download_flags)} only apply to --gallery_url, --gallery_json doesn't download")
+        process_gallery_json(
+            args.gallery_json,
+            args.output_dir,
+            session_dir=args.session_dir,
+            n_workers=args.workers,
+            max_per_site=args.max_per_site,
+            fetch_mode=args.fetch_mode,
+            record_dir=args.record_dir,
+        )
+    else:
+        gate = gate_from_args(args)
+        try:
+            with adonis_session(args.session_dir) as session:
+                process_gallery_url(
+                    args.gallery_url,
+                    args.output_dir,
+                    reencode=args.reencode,
+                    fetch_mode=args.fetch_mode,
+                    record_dir=args.record_dir,
+                    session=session,
+                    gate=gate,
+                    jpeg_quality_threshold=args.jpeg_quality_threshold,
+                )
+        finally:
+            if gate is not None:
+                gate.close()
+    export_from_args(args)
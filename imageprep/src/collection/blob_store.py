@@ -0,0 +1,141 @@
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import typing as tp
+
+import requests
+
+from imageprep.src.collection.header_sniff import SniffStats, image_format, stream_to
+
+# content-addressed image store: every distinct image is written once to {root}/{hash[:2]}/{hash}.{ext}
+# and gallery folders get hard links to it, so reposts cost neither disk nor a second quality score
+# example run, dedup stats of a store:
+# python -m imageprep.src.collection.blob_store data/blobs
+
+# downloads are held in memory up to this size while their hash is computed, so a known image
+# never hits the disk; bigger ones spill to a temp file
+SPOOL_SIZE = 32*1024*1024
+FORMAT_EXTS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp'}
+
+
+class HashingWriter:
+    def __init__(self, f: tp.BinaryIO):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.n_bytes = 0
+
+    def write(self, data: bytes):
+        self.digest.update(data)
+        self.n_bytes += len(data)
+        return self.f.write(data)
+
+
+class StoredBlob(tp.NamedTuple):
+    content_hash: str
+    blob_path: str
+    # False when the store already had this image and nothing was written
+    is_new: bool
+
+
+class BlobStore:
+    def __init__(self, root: str, spool_size: int = SPOOL_SIZE):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.spool_size = spool_size
+        # shared by the download threads
+        self.lock = threading.Lock()
+        self.n_new = 0
+        self.n_known = 0
+        self.bytes_deduped = 0
+
+    def blob_path(self, content_hash: str, ext: str) -> str:
+        return os.path.join(self.root, content_hash[:2], f'{content_hash}.{ext}')
+
+    def put_response(
+        self,
+        response: requests.Response,
+        accept_size: tp.Callable[[int, int], bool] = None,
+        stats: SniffStats = None,
+        accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+    ) -> tp.Optional[StoredBlob]:
+        # hashes the body while streaming it; None when the header sniff rejected it
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size, dir=self.tmp_dir) as spool:
+            writer = HashingWriter(spool)
+            if not stream_to(response, lambda: writer, accept_size, stats, accept_header):
+                return None
+            spool.seek(0)
+            ext = FORMAT_EXTS[image_format(spool.read(12))]
+            spool.seek(0)
+            return self.put_file(spool, writer.digest.hexdigest(), ext, writer.n_bytes)
+
+    def put_bytes(self, data: bytes) -> StoredBlob:
+        # a body already held in memory, e.g. one the inline quality gate accepted
+        ext = FORMAT_EXTS[image_format(data[:12])]
+        return self.put_file(io.BytesIO(data), hashlib.sha256(data).hexdigest(), ext, len(data))
+
+    def put_file(self, src: tp.BinaryIO, content_hash: str, ext: str, n_bytes: int) -> StoredBlob:
+        blob_path = self.blob_path(content_hash, ext)
+        if os.path.exists(blob_path):
+            with self.lock:
+                self.n_known += 1
+                self.bytes_deduped += n_bytes
+            return StoredBlob(content_hash, blob_path, False)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, part_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(src, f)
+            # two threads racing on the same new image both land the same bytes, either rename wins
+            os.replace(part_path, blob_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        with self.lock:
+            self.n_new += 1
+        return StoredBlob(content_hash, blob_path, True)
+
+    def link(self, blob_path: str, dest_path: str):
+        # hard link so deleting a gallery never loses a blob; symlink across filesystems
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(blob_path, dest_path)
+        except OSError:
+            os.symlink(os.path.abspath(blob_path), dest_path)
+
+    def summary(self) -> str:
+        return (
+            f'blob store: {self.n_new} new, {self.n_known} already stored '
+            f'({self.bytes_deduped / 2**20:.1f}MB not written again)'
+        )
+
+
+def iter_blobs(root: str) -> tp.Iterator[str]:
+    for prefix in sorted(os.listdir(root)):
+        prefix_dir = os.path.join(root, prefix)
+        if prefix == 'tmp' or not os.path.isdir(prefix_dir):
+            continue
+        for name in sorted(os.listdir(prefix_dir)):
+            yield os.path.join(prefix_dir, name)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('root', type=str)
+    args = args.parse_args()
+    n_blobs = 0
+    n_links = 0
+    total_bytes = 0
+    for path in iter_blobs(args.root):
+        stat = os.stat(path)
+        n_blobs += 1
+        # st_nlink counts the blob itself plus every gallery link
+        n_links += stat.st_nlink - 1
+        total_bytes += stat.st_size
+    print(f'{n_blobs} blobs, {total_bytes / 2**30:.2f}GB, linked from {n_links} gallery files')
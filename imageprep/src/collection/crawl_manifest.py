@@ -0,0 +1,188 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import typing as tp
+
+from imageprep.src.utils.metrics import METRICS
+
+# durable record of what a crawl has already done, so an interrupted run picks up where it stopped
+# example run, progress of every crawl in a manifest:
+# python -m imageprep.src.collection.crawl_manifest data/test/crawl_manifest.sqlite
+
+MANIFEST_NAME = 'crawl_manifest.sqlite'
+URL_STATES = ('pending', 'done', 'rejected', 'failed')
+# done and rejected urls are never fetched again, failed ones are retried on the next run
+FINISHED_STATES = ('done', 'rejected')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    crawl TEXT NOT NULL,
+    page_no INTEGER NOT NULL,
+    page_url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    n_urls INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (crawl, page_no)
+);
+CREATE TABLE IF NOT EXISTS urls (
+    crawl TEXT NOT NULL,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    bytes INTEGER,
+    final_path TEXT,
+    content_hash TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    PRIMARY KEY (crawl, url)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    crawl TEXT PRIMARY KEY,
+    next_index INTEGER NOT NULL
+);
+"""
+
+
+class CrawlManifest:
+    def __init__(self, db_path: str):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        # one connection shared by the collector's threads, writes are serialized by the lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # collectors can reach cleanup twice, e.g. after a cloudflare check
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def last_done_page(self, crawl: str) -> int:
+        # 0 when no page of this crawl has finished yet
+        row = self.conn.execute(
+            "SELECT MAX(page_no) FROM pages WHERE crawl = ? AND state = 'done'",
+            (crawl,)
+        ).fetchone()
+        return row[0] or 0
+
+    def mark_page(self, crawl: str, page_no: int, page_url: str, state: str, n_urls: int = None):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages (crawl, page_no, page_url, state, n_urls, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (crawl, page_no, page_url, state, n_urls, time.time())
+            )
+            self.conn.commit()
+
+    def finished_urls(self, crawl: str) -> tp.Set[str]:
+        # loaded once per crawl so the per-url skip check is a set lookup
+        rows = self.conn.execute(
+            f'SELECT url FROM urls WHERE crawl = ? AND state IN ({",".join("?" * len(FINISHED_STATES))})',
+            (crawl, *FINISHED_STATES)
+        )
+        return {row[0] for row in rows}
+
+    def content_hashes(self, crawl: str) -> tp.Set[str]:
+        rows = self.conn.execute(
+            "SELECT content_hash FROM urls WHERE crawl = ? AND state = 'done' AND content_hash IS NOT NULL",
+            (crawl,)
+        )
+        return {row[0] for row in rows}
+
+    def done_files(self) -> tp.Dict[str, tp.Tuple[str, str]]:
+        # resolved final path -> (source url, content hash) of every kept image, for exports. Collectors
+        # store output_dir as given, relative paths are taken from the working directory like theirs
+        rows = self.conn.execute(
+            "SELECT final_path, url, content_hash FROM urls WHERE state = 'done' AND final_path IS NOT NULL"
+        )
+        return {os.path.realpath(path): (url, content_hash) for path, url, content_hash in rows}
+
+    def add_urls(self, crawl: str, urls: tp.Iterable[str]):
+        # new urls start as pending, known ones keep their state
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO urls (crawl, url, state, updated) VALUES (?, ?, 'pending', ?)",
+                [(crawl, url, now) for url in urls]
+            )
+            self.conn.commit()
+
+    def mark_urls(self, crawl: str, rows: tp.Iterable[tp.Tuple[str, str, int, str, str, str]]):
+        # (url, state, bytes, final_path, content_hash, error) rows, one commit for the batch
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                'INSERT INTO urls (crawl, url, state, bytes, final_path, content_hash, error, attempts, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?) '
+                'ON CONFLICT (crawl, url) DO UPDATE SET state = excluded.state, bytes = excluded.bytes, '
+                'final_path = excluded.final_path, content_hash = excluded.content_hash, '
+                'error = excluded.error, attempts = urls.attempts + 1, updated = excluded.updated',
+                [(crawl, url, state, n_bytes, final_path, content_hash, error, now)
+                 for url, state, n_bytes, final_path, content_hash, error in rows]
+            )
+            self.conn.commit()
+
+    def reserve_indices(self, crawl: str, n: int, start: int = 0) -> int:
+        # hands out n consecutive file indices and returns the first; start seeds a new crawl
+        with self.lock:
+            row = self.conn.execute('SELECT next_index FROM counters WHERE crawl = ?', (crawl,)).fetchone()
+            first = row[0] if row is not None else start
+            self.conn.execute(
+                'INSERT OR REPLACE INTO counters (crawl, next_index) VALUES (?, ?)',
+                (crawl, first + n)
+            )
+            self.conn.commit()
+        return first
+
+    def has_counter(self, crawl: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM counters WHERE crawl = ?', (crawl,)).fetchone() is not None
+
+    def summary(self, crawl: str = None) -> tp.List[tp.Tuple[str, str, int, int]]:
+        # (crawl, state, n_urls, bytes)
+        where = 'WHERE crawl = ?' if crawl is not None else ''
+        return self.conn.execute(
+            f'SELECT crawl, state, COUNT(*), COALESCE(SUM(bytes), 0) FROM urls {where} '
+            'GROUP BY crawl, state ORDER BY crawl, state',
+            (crawl,) if crawl is not None else ()
+        ).fetchall()
+
+
+def next_free_index(img_dir: str) -> int:
+    # one-off listing to seed the counter of a gallery downloaded before the manifest existed
+    indices = [int(f.split('.')[0]) for f in os.listdir(img_dir) if f.split('.')[0].isdigit()]
+    return max(indices) + 1 if indices else 0
+
+
+def record_rows(rows: tp.Iterable[tp.Tuple[str, str, int, str, str, str]]):
+    # mark_urls rows -> image counts by outcome and bytes kept, for the metrics export
+    if not METRICS.enabled:
+        return
+    for _, state, n_bytes, _, _, error in rows:
+        METRICS.count('images', state=state, reason=error if state == 'rejected' else '')
+        if n_bytes:
+            METRICS.count('bytes_kept', n_bytes)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('db_path', type=str)
+    args.add_argument('--crawl', type=str, required=False, default=None)
+    args = args.parse_args()
+    with CrawlManifest(args.db_path) as manifest:
+        for crawl, state, n_urls, n_bytes in manifest.summary(args.crawl):
+            print(f'{crawl}\t{state}\t{n_urls}\t{n_bytes / 2**20:.1f}MB\tlast page {manifest.last_done_page(crawl)}')
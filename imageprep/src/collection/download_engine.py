@@ -0,0 +1,289 @@
+import io
+import os
+import random
+import threading
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from imageprep.src.collection.blob_store import BlobStore
+from imageprep.src.collection.header_sniff import SniffStats, stream_to, stream_to_file
+from imageprep.src.collection.rate_limit import RateLimiter
+from imageprep.src.utils.metrics import METRICS
+
+if tp.TYPE_CHECKING:
+    from imageprep.src.quality.inline_gate import GateResult, InlineGate
+
+MAX_WORKERS = 16
+PER_HOST_LIMIT = 4
+RETRIES = 3
+BACKOFF = 1.
+# (connect, read) seconds
+TIMEOUT = (10., 30.)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# the gate holds a body in memory per download thread; bigger ones are dropped unscored
+GATE_MAX_BYTES = 32*1024*1024
+
+
+class RetryableStatus(requests.HTTPError):
+    pass
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class CappedBuffer(io.BytesIO):
+    # in-memory sink for stream_to that refuses to grow past max_bytes
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def write(self, data: bytes) -> int:
+        if self.tell() + len(data) > self.max_bytes:
+            raise BodyTooLarge(f'body over the gate limit of {self.max_bytes / 2**20:.0f}MB')
+        return super().write(data)
+
+
+class DownloadResult(tp.NamedTuple):
+    url: str
+    save_path: tp.Optional[str]
+    ok: bool
+    status: tp.Optional[int]
+    error: tp.Optional[str]
+    attempts: int
+    content_hash: tp.Optional[str] = None
+    # the blob store already had these bytes
+    duplicate: bool = False
+    # the inline quality gate's verdict, kept or not
+    gate: tp.Optional['GateResult'] = None
+    # cancelled by accept_header, e.g. the JPEG quality pre-screen
+    header_rejected: bool = False
+
+
+class DownloadEngine:
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        per_host_limit: int = PER_HOST_LIMIT,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        timeout: tp.Tuple[float, float] = TIMEOUT,
+        user_agent: str = None,
+        store: BlobStore = None,
+        limiter: RateLimiter = None,
+        gate: 'InlineGate' = None,
+        gate_max_bytes: int = GATE_MAX_BYTES,
+    ):
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # one session = keep-alive connection pools per host, shared by every worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=max(max_workers, per_host_limit))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        self.host_locks: tp.Dict[str, threading.BoundedSemaphore] = {}
+        self.host_locks_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.sniff_stats = SniffStats()
+        # with a store, save_path becomes a link to the content-addressed copy
+        self.store = store
+        # paces requests per host on top of the per-host connection cap
+        self.limiter = limiter or RateLimiter()
+        # with a gate, bodies are scored in memory and only the ones that pass are written
+        self.gate = gate
+        self.gate_max_bytes = gate_max_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def set_user_agent(self, user_agent: str):
+        self.session.headers['User-Agent'] = user_agent
+
+    def set_cookies(self, cookies: tp.List[dict]):
+        # selenium's driver.get_cookies(); scoped to their domain so they don't leak to image CDNs
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie.get('domain', ''),
+                path=cookie.get('path', '/'),
+            )
+
+    def host_lock(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self.host_locks_lock:
+            lock = self.host_locks.get(host)
+            if lock is None:
+                lock = threading.BoundedSemaphore(self.per_host_limit)
+                self.host_locks[host] = lock
+            return lock
+
+    def sleep_before_retry(self, attempt: int):
+        # full jitter, so workers that failed together don't retry together
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def get(self, url: str, headers: dict = None, stream: bool = False) -> requests.Response:
+        # one GET after limiter.acquire; the host's rate learns from its status, latency and Retry-After
+        try:
+            response = self.session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+        except requests.Timeout:
+            self.limiter.observe(url, None, self.timeout[1])
+            raise
+        latency = response.elapsed.total_seconds()
+        self.limiter.observe(url, response.status_code, latency, response.headers.get('Retry-After'))
+        # time to headers; bodies are timed by the callers' batches
+        METRICS.observe('http_headers', latency)
+        METRICS.count('http_responses', status=response.status_code)
+        return response
+
+    def request(self, url: str, headers: dict = None, stream: bool = False) -> requests.Response:
+        # GET with retries on connection errors, timeouts and 429/5xx; other statuses are returned as is
+        for attempt in range(self.retries + 1):
+            try:
+                # wait for a token before taking one of the host's connection slots
+                self.limiter.acquire(url)
+                with self.host_lock(url):
+                    response = self.get(url, headers=headers, stream=stream)
+                    if response.status_code in RETRY_STATUSES:
+                        response.close()
+                        raise RetryableStatus(f'HTTP {response.status_code}')
+                    if not stream:
+                        # read the body while we still hold the host slot
+                        response.content
+                return response
+            except (requests.ConnectionError, requests.Timeout, RetryableStatus) as e:
+                if attempt == self.retries:
+                    raise
+                print(f'retrying {url} ({attempt + 1}/{self.retries}): {e}')
+                self.sleep_before_retry(attempt)
+
+    def download(
+        self,
+        url: str,
+        save_path: str,
+        accept_size: tp.Callable[[int, int], bool] = None,
+        headers: dict = None,
+        accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+    ) -> DownloadResult:
+        attempts = 0
+        header_rejects = []
+
+        def check_header(head: bytes) -> tp.Optional[bool]:
+            # remembers a reject, so the collectors can tell it from too small or not an image
+            verdict = accept_header(head)
+            if verdict is False:
+                header_rejects.append(url)
+            return verdict
+
+        header_check = check_header if accept_header is not None else None
+        for attempt in range(self.retries + 1):
+            attempts = attempt + 1
+            try:
+                self.limiter.acquire(url)
+                with self.host_lock(url):
+                    response = self.get(url, headers=headers, stream=True)
+                    if response.status_code in RETRY_STATUSES:
+                        response.close()
+                        raise RetryableStatus(f'HTTP {response.status_code}')
+                    if response.status_code != 200:
+                        response.close()
+                        return DownloadResult(url, None, False, response.status_code, None, attempts)
+                    if self.gate is not None:
+                        # a declared size over the limit is dropped unread, a chunked or lying one once it gets there
+                        if int(response.headers.get('Content-Length') or 0) > self.gate_max_bytes:
+                            response.close()
+                            raise BodyTooLarge(f'body over the gate limit of {self.gate_max_bytes / 2**20:.0f}MB')
+                        body = CappedBuffer(self.gate_max_bytes)
+                        try:
+                            ok = stream_to(response, lambda: body, accept_size, self.sniff_stats, header_check)
+                        except BodyTooLarge:
+                            response.close()
+                            raise
+                    elif self.store is None:
+                        ok = stream_to_file(response, save_path, accept_size, self.sniff_stats, header_check)
+                        return DownloadResult(
+                            url, save_path if ok else None, ok, response.status_code, None, attempts,
+                            header_rejected=bool(header_rejects),
+                        )
+                    else:
+                        blob = self.store.put_response(response, accept_size, self.sniff_stats, header_check)
+                if self.gate is not None:
+                    # scored after the host slot is released, the connection moves on to the next image
+                    if not ok:
+                        return DownloadResult(
+                            url, None, False, response.status_code, None, attempts, header_rejected=bool(header_rejects)
+                        )
+                    return self.save_gated(url, body.getvalue(), save_path, response.status_code, attempts)
+                if blob is None:
+                    return DownloadResult(
+                        url, None, False, response.status_code, None, attempts, header_rejected=bool(header_rejects)
+                    )
+                self.store.link(blob.blob_path, save_path)
+                return DownloadResult(
+                    url, save_path, True, response.status_code, None, attempts, blob.content_hash, not blob.is_new
+                )
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                RetryableStatus
+            ) as e:
+                # stream_to_file and the store already dropped the partial file
+                if attempt == self.retries:
+                    return DownloadResult(url, None, False, None, str(e), attempts)
+                self.sleep_before_retry(attempt)
+            except Exception as e:
+                return DownloadResult(url, None, False, None, str(e), attempts)
+        return DownloadResult(url, None, False, None, 'retries exhausted', attempts)
+
+    def save_gated(self, url: str, data: bytes, save_path: str, status: int, attempts: int) -> DownloadResult:
+        verdict = self.gate.check(data)
+        if not verdict.passed:
+            return DownloadResult(url, None, False, status, None, attempts, gate=verdict)
+        if self.store is not None:
+            blob = self.store.put_bytes(data)
+            self.store.link(blob.blob_path, save_path)
+            return DownloadResult(
+                url, save_path, True, status, None, attempts, blob.content_hash, not blob.is_new, verdict
+            )
+        part_path = save_path + '.part'
+        try:
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            os.replace(part_path, save_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return DownloadResult(url, save_path, True, status, None, attempts, gate=verdict)
+
+    def download_many(
+        self,
+        jobs: tp.Iterable[tp.Tuple[str, str]],
+        accept_size: tp.Callable[[int, int], bool] = None,
+        headers: dict = None,
+        accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+    ) -> tp.List[DownloadResult]:
+        # (url, save_path) jobs; results come back in job order
+        futures = [
+            self.executor.submit(self.download, url, save_path, accept_size, headers, accept_header)
+            for url, save_path in jobs
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,94 @@
+import html as html_lib
+import re
+import typing as tp
+from urllib.parse import urljoin, urlsplit
+
+# url and <img> tag extraction for both collectors: every page is read from the browser once and
+# scanned once with a compiled pattern, instead of a page_source round trip and a regex per kind of url
+
+LPSG_ATTACHMENT_PREFIX = 'https://www.lpsg.com/attachments/'
+# hosts whose urls are images even without an extension
+IMAGE_HOST_PREFIXES = ('https://i.pinimg.com/', 'https://pbs.twimg.com/')
+IMAGE_EXT_MARKERS = ('.jpg', '.jpeg', '.png')
+
+# an https url running up to the closing quote of its attribute, on one line
+QUOTED_URL_RE = re.compile(r'https://[^"\n]*(?=")')
+ADONIS_IMG_RE = re.compile(r'<img[^>]*src="//cdngallery\.adonismale\.com[^>]*>')
+# one scan of a tag picks up all three attributes, whatever their order
+ADONIS_ATTR_RE = re.compile(r'(width|height|src)="([^"]*)"')
+HREF_RE = re.compile(r'href="([^"]*)"')
+# invision pagination: the page count sits on the list, the next link is an <a> with this class
+ADONIS_PAGES_RE = re.compile(r'data-pages="(\d+)"')
+ADONIS_NEXT_RE = re.compile(r'<a[^>]*class="[^"]*ipsPagination_next[^"]*"[^>]*>')
+# the page number in a friendly (/page/2/) or query (?page=2) url
+PAGE_NO_RE = re.compile(r'(page[/=])\d+')
+CHALLENGE_MARKERS = ('Just a moment...', 'you are human')
+
+
+def _from_prefix(url: str, prefix: str) -> tp.Optional[str]:
+    # a prefix can also sit inside a longer url (proxies, redirects); the url starts there
+    idx = url.find(prefix)
+    return url[idx:] if idx >= 0 else None
+
+
+def extract_lpsg_urls(html: str) -> tp.Tuple[tp.List[str], tp.List[str]]:
+    # (attachments, other image urls), both sorted and unique
+    attachments = set()
+    others = set()
+    for url in QUOTED_URL_RE.findall(html):
+        attachment = _from_prefix(url, LPSG_ATTACHMENT_PREFIX)
+        if attachment is not None:
+            attachments.add(attachment)
+        for prefix in IMAGE_HOST_PREFIXES:
+            hosted = _from_prefix(url, prefix)
+            if hosted is not None:
+                others.add(hosted)
+        if any(ext in url for ext in IMAGE_EXT_MARKERS):
+            others.add(url)
+    return sorted(attachments), sorted(others)
+
+
+def extract_adonis_imgs(html: str) -> tp.List[tp.Tuple[str, int, int]]:
+    # (src without the leading //, width, height) of every gallery cdn image, in page order
+    imgs = []
+    for tag in ADONIS_IMG_RE.findall(html):
+        attrs = {}
+        for name, value in ADONIS_ATTR_RE.findall(tag):
+            # the first occurrence wins
+            attrs.setdefault(name, value)
+        if len(attrs) == 3 and attrs['width'].isdigit() and attrs['height'].isdigit():
+            imgs.append((attrs['src'][2:], int(attrs['width']), int(attrs['height'])))
+    return imgs
+
+
+def has_link(html: str, url: str) -> bool:
+    # hrefs are often relative, so match on the path
+    path = urlsplit(url).path
+    return any(path in href for href in HREF_RE.findall(html))
+
+
+def is_challenge(html: str) -> bool:
+    return any(marker in html for marker in CHALLENGE_MARKERS)
+
+
+def adonis_page_count(html: str) -> tp.Optional[int]:
+    match = ADONIS_PAGES_RE.search(html)
+    return int(match.group(1)) if match else None
+
+
+def adonis_next_url(html: str, page_url: str) -> tp.Optional[str]:
+    # absolute url of the next page, None on the last one
+    match = ADONIS_NEXT_RE.search(html)
+    if match is None:
+        return None
+    href = HREF_RE.search(match.group(0))
+    if href is None or not href.group(1):
+        return None
+    return urljoin(page_url, html_lib.unescape(href.group(1)))
+
+
+def with_page_no(page_url: str, page_no: int) -> tp.Optional[str]:
+    # the url of page page_no, modelled on the url of another page; None when it has no page number
+    if PAGE_NO_RE.search(page_url) is None:
+        return None
+    return PAGE_NO_RE.sub(lambda m: f'{m.group(1)}{page_no}', page_url, count=1)
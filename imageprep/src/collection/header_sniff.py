@@ -0,0 +1,228 @@
+import os
+import struct
+import threading
+import time
+import typing as tp
+
+import requests
+
+# how far into a response we look for the image dimensions before giving up and downloading it all;
+# JPEG SOF markers can sit behind large EXIF/ICC segments
+SNIFF_LIMIT = 256*1024
+CHUNK_SIZE = 8*1024
+
+# SOF0-SOF15 minus DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def image_format(data: bytes) -> tp.Optional[str]:
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def jpeg_size(data: bytes) -> tp.Optional[tp.Tuple[int, int]]:
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker == 0xDA:
+            # start of scan without a frame header, not a valid image
+            return None
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def png_size(data: bytes) -> tp.Optional[tp.Tuple[int, int]]:
+    if len(data) < 24 or data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def webp_size(data: bytes) -> tp.Optional[tp.Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30:
+        # lossy: 3 byte frame tag, 3 byte start code, then 14 bit width and height
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def parse_image_size(data: bytes) -> tp.Optional[tp.Tuple[str, int, int]]:
+    # (format, width, height) from the first bytes of a file, None if unknown or not enough bytes yet
+    fmt = image_format(data)
+    if fmt == 'jpeg':
+        size = jpeg_size(data)
+    elif fmt == 'png':
+        size = png_size(data)
+    elif fmt == 'webp':
+        size = webp_size(data)
+    else:
+        return None
+    if size is None:
+        return None
+    return fmt, size[0], size[1]
+
+
+class SniffStats:
+    def __init__(self):
+        # shared by the download threads
+        self.lock = threading.Lock()
+        self.n_complete = 0
+        self.n_too_small = 0
+        self.n_not_image = 0
+        self.n_low_quality = 0
+        self.bytes_read = 0
+        self.bytes_saved = 0
+        self.seconds = 0.
+
+    def record(self, outcome: str, bytes_read: int, bytes_saved: int, seconds: float):
+        with self.lock:
+            if outcome == 'complete':
+                self.n_complete += 1
+            elif outcome == 'too_small':
+                self.n_too_small += 1
+            elif outcome == 'low_quality':
+                self.n_low_quality += 1
+            else:
+                self.n_not_image += 1
+            self.bytes_read += bytes_read
+            self.bytes_saved += bytes_saved
+            self.seconds += seconds
+
+    def time_saved(self) -> float:
+        # what the skipped bytes would have cost at the throughput we observed
+        if self.bytes_read == 0:
+            return 0.
+        return self.bytes_saved * self.seconds / self.bytes_read
+
+    def summary(self) -> str:
+        return (
+            f'downloads: {self.n_complete} complete, {self.n_too_small} aborted as too small, '
+            f'{self.n_low_quality} as low quality, {self.n_not_image} as not an image; read {self.bytes_read / 2**20:.1f}MB, '
+            f'skipped {self.bytes_saved / 2**20:.1f}MB (~{self.time_saved():.1f}s of transfer)'
+        )
+
+
+def stream_to(
+    response: requests.Response,
+    open_sink: tp.Callable[[], tp.BinaryIO],
+    accept_size: tp.Callable[[int, int], bool] = None,
+    stats: SniffStats = None,
+    accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+) -> bool:
+    # streams the body into the writable returned by open_sink(), but cancels the transfer as soon as
+    # the header shows the image is rejected by accept_size(width, height) or isn't an image at all.
+    # accept_header(head) then sees the sniffed bytes, e.g. for the JPEG quality pre-screen, and
+    # returns None while it needs more of them; past SNIFF_LIMIT (or the body's end) that accepts.
+    # open_sink is only called once the image is accepted, rejected responses never touch the sink.
+    start = time.time()
+    content_length = int(response.headers.get('Content-Length') or 0)
+    head = b''
+    sniffing = True
+    outcome = 'complete'
+    bytes_read = 0
+    sink = None
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            bytes_read += len(chunk)
+            if sniffing:
+                head += chunk
+                if len(head) >= 12 and image_format(head) is None:
+                    outcome = 'not_image'
+                    break
+                parsed = parse_image_size(head)
+                if parsed is not None and accept_size is not None and not accept_size(parsed[1], parsed[2]):
+                    outcome = 'too_small'
+                    break
+                if parsed is None and len(head) < SNIFF_LIMIT:
+                    continue
+                if accept_header is not None:
+                    verdict = accept_header(head)
+                    if verdict is None and len(head) < SNIFF_LIMIT:
+                        continue
+                    if verdict is False:
+                        outcome = 'low_quality'
+                        break
+                # size accepted, or the header was too deep to find; write what we have and carry on
+                sniffing = False
+                sink = open_sink()
+                sink.write(head)
+                head = b''
+            else:
+                sink.write(chunk)
+        if sniffing and outcome == 'complete':
+            # body ended inside the sniff window, e.g. a small image whose size we couldn't parse
+            if image_format(head) is None:
+                outcome = 'not_image'
+            elif accept_header is not None and accept_header(head) is False:
+                outcome = 'low_quality'
+            else:
+                sink = open_sink()
+                sink.write(head)
+    finally:
+        if outcome != 'complete':
+            # closing an unread response drops the connection, which cancels the rest of the transfer
+            response.close()
+    if stats is not None:
+        bytes_saved = max(content_length - bytes_read, 0) if outcome != 'complete' else 0
+        stats.record(outcome, bytes_read, bytes_saved, time.time() - start)
+    return outcome == 'complete'
+
+
+def stream_to_file(
+    response: requests.Response,
+    save_path: str,
+    accept_size: tp.Callable[[int, int], bool] = None,
+    stats: SniffStats = None,
+    accept_header: tp.Callable[[bytes], tp.Optional[bool]] = None,
+) -> bool:
+    # stream_to into a .part file that is renamed into place once complete,
+    # so save_path never holds a truncated image
+    part_path = save_path + '.part'
+    files = []
+
+    def open_part():
+        files.append(open(part_path, 'wb'))
+        return files[0]
+
+    try:
+        ok = stream_to(response, open_part, accept_size, stats, accept_header)
+        for f in files:
+            f.close()
+        if ok:
+            os.replace(part_path, save_path)
+        return ok
+    except BaseException:
+        for f in files:
+            f.close()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
@@ -1,16 +1,31 @@
 import argparse
 import os
-import re
+import queue
 import random
-from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
+import typing as tp
+from concurrent.futures import Future
 import requests
 from selenium.webdriver.common.by import By
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
+from imageprep.src.collection.blob_store import BlobStore
+from imageprep.src.collection.crawl_manifest import (
+    FINISHED_STATES, MANIFEST_NAME, CrawlManifest, next_free_index, record_rows
+)
+from imageprep.src.collection.download_engine import DownloadEngine
+from imageprep.src.collection.extract import extract_lpsg_urls, has_link, is_challenge
+from imageprep.src.collection.rate_limit import RateLimiter, shared_limiter
+from imageprep.src.collection.session import SESSION_DIR, BrowserSession
+from imageprep.src.collection.stub_server import record_page
+from imageprep.src.quality.inline_gate import SCORES_NAME, InlineGate, add_gate_args, append_scores, gate_from_args
+from imageprep.src.quality.jpeg_prescreen import header_check
+from imageprep.src.utils.metrics import METRICS, add_metrics_args, enable_from_args, export_from_args
+
 # example run:
-# python imageprep/src/collection/lpsg.py --thread_url https://www.lpsg.com/threads/drazenpn.5832241/ --output_dir data/test --order_by_reaction_score
+# python -m imageprep.src.collection.lpsg --thread_url https://www.lpsg.com/threads/drazenpn.5832241/ --output_dir data/test --order_by_reaction_score
 # should download 9 images
 
 # set with your own email and password
@@ -18,6 +33,66 @@ EMAIL = ''
 PASSWORD = ''
 
 ORDER_BY_REACTION_SCORE = 'order=th_mrp_reaction_score'
+MIN_IMG_SIZE = 1024*1024
+# pages whose downloads may wait in the pipeline while the browser moves on; when it is full
+# navigation blocks, so we never run further ahead of the disk and the image hosts than this
+PIPELINE_DEPTH = 2
+FETCH_MODES = ('browser', 'http')
+# thread pages fetched ahead in http mode
+PAGE_CONCURRENCY = 4
+LPSG_HOME_URL = 'https://www.lpsg.com/'
+# xenforo sets this on <html> for members
+LPSG_LOGGED_IN_MARKER = 'data-logged-in="true"'
+
+
+def open_selenium() -> webdriver.Chrome:
+    chrome_options = Options()
+    chrome_options.add_argument('--incognito')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--no-sandbox')
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    # maximize window
+    driver.maximize_window()
+    return driver
+
+
+def login(driver: webdriver.Chrome):
+    driver.get('https://www.lpsg.com/login')
+    time.sleep(2)
+    if is_challenge(driver.page_source):
+        raise Exception('Cloudflare detected')
+    input_email = driver.find_element(By.NAME, 'login')
+    email = EMAIL
+    for char in email:
+        input_email.send_keys(char)
+        time.sleep(random.randint(1, 3) / 10.)
+    input_password = driver.find_element(By.NAME, 'password')
+    pw = PASSWORD
+    for char in pw:
+        input_password.send_keys(char)
+        time.sleep(random.randint(1, 3) / 10.)
+    buttons = driver.find_elements(By.TAG_NAME, 'button')
+    for button in buttons:
+        if button.get_attribute('class') == 'button--primary button button--icon button--icon--login rippleButton':
+            button.click()
+            break
+    time.sleep(2)
+    if is_challenge(driver.page_source):
+        raise Exception('Cloudflare detected')
+    print('logged in')
+
+
+def lpsg_session(session_dir: str = SESSION_DIR) -> BrowserSession:
+    return BrowserSession(
+        'lpsg',
+        LPSG_HOME_URL,
+        open_selenium,
+        login,
+        LPSG_LOGGED_IN_MARKER,
+        session_dir=session_dir,
+    )
 
 
 class LPSG:
@@ -27,7 +102,22 @@ class LPSG:
         top_dir: str,
         order_by_reaction_score: bool = False,
         max_pages: int = 1000,
+        engine: DownloadEngine = None,
+        manifest: CrawlManifest = None,
+        pipelined: bool = False,
+        pipeline_depth: int = PIPELINE_DEPTH,
+        fetch_mode: str = 'browser',
+        page_concurrency: int = PAGE_CONCURRENCY,
+        record_dir: str = None,
+        session: BrowserSession = None,
+        session_dir: str = SESSION_DIR,
+        on_saved: tp.Callable[[str], None] = None,
+        gate: InlineGate = None,
+        jpeg_quality_threshold: float = None,
+        limiter: RateLimiter = None,
     ):
+        if fetch_mode not in FETCH_MODES:
+            raise ValueError(f'unknown fetch mode {fetch_mode}')
         if thread_url[-1] != '/':
             thread_url += '/'
         self.thread_url = thread_url
@@ -39,86 +129,59 @@ class LPSG:
         self.driver = None
         self.order_by_reaction_score = order_by_reaction_score
         self.max_pages = max_pages
+        # keep-alive connections and per-host caps shared across every page of the thread;
+        # images land once in the shared blob store and imgs/ holds links to them
+        # one per-host limiter paces page loads and image downloads, shared with every other thread
+        # crawled by this process unless one is passed in
+        self.limiter = limiter or (engine.limiter if engine is not None else shared_limiter())
+        # with a quality gate, bodies are scored in memory and low quality images are never written
+        self.engine = engine or DownloadEngine(
+            store=BlobStore(os.path.join(self.top_dir, 'blobs')), limiter=self.limiter, gate=gate
+        )
+        self.scores_path = os.path.join(self.gal_dir, SCORES_NAME)
+        # heavily recompressed JPEGs are cancelled once their quantization tables have been read
+        self.accept_header = header_check(jpeg_quality_threshold) if jpeg_quality_threshold is not None else None
+        # page and url progress, a rerun resumes at the last finished page and skips finished urls
+        self.manifest = manifest or CrawlManifest(os.path.join(self.top_dir, MANIFEST_NAME))
+        self.crawl = f'lpsg/{self.gal_name}'
+        if order_by_reaction_score:
+            self.crawl += '/by_reaction_score'
+        if not self.manifest.has_counter(self.crawl):
+            self.manifest.reserve_indices(self.crawl, 0, start=next_free_index(self.imgs_dir))
+        self.finished_urls = self.manifest.finished_urls(self.crawl)
+        # hashes already linked into this gallery, a repost on a later page is dropped
+        self.seen_hashes = self.manifest.content_hashes(self.crawl)
+        # pipelined: the browser keeps navigating while a background thread drains page downloads
+        self.pipelined = pipelined
+        self.pipeline_depth = pipeline_depth
+        # urls handed to the pipeline but not processed yet, so a later page doesn't queue them again
+        self.queued_urls = set()
+        self.worker_error = None
+        self.nav_seconds = 0.
+        self.download_seconds = 0.
+        # http: after login, thread pages are plain GETs with the browser's cookies and selenium only
+        # handles challenges; record_dir keeps every fetched page for the stub server and benchmarks
+        self.fetch_mode = fetch_mode
+        self.page_concurrency = page_concurrency
+        self.record_dir = record_dir
+        # called with the final path of every kept image, e.g. to feed the streaming pipeline
+        self.on_saved = on_saved
+        self.n_fallbacks = 0
+        # a session passed in is shared with other threads and outlives this one, so cleanup leaves it open
+        self.owns_session = session is None
+        self.session = session or lpsg_session(session_dir)
 
     def run(self):
-        self.open_selenium()
-        self.login()
+        self.driver = self.session.ensure()
         self.thread_loop()
-        self.cleanup()
-
-    def open_selenium(self):
-        chrome_options = Options()
-        chrome_options.add_argument('--incognito')
-        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--no-sandbox')
-        self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        # maximize window
-        self.driver.maximize_window()
-
-    def login(self):
-        self.driver.get('https://www.lpsg.com/login')
-        time.sleep(2)
-        self.check_cloudflare()
-        input_email = self.driver.find_element(By.NAME, 'login')
-        email = EMAIL
-        for char in email:
-            input_email.send_keys(char)
-            time.sleep(random.randint(1, 3) / 10.)
-        input_password = self.driver.find_element(By.NAME, 'password')
-        pw = PASSWORD
-        for char in pw:
-            input_password.send_keys(char)
-            time.sleep(random.randint(1, 3) / 10.)
-        buttons = self.driver.find_elements(By.TAG_NAME, 'button')
-        for button in buttons:
-            if button.get_attribute('class') == 'button--primary button button--icon button--icon--login rippleButton':
-                button.click()
-                break
-        time.sleep(2)
-        self.check_cloudflare()
-        print('logged in')
-
-    def get_attachments(self):
-        unique_links = set(re.findall(r'https://www.lpsg.com/attachments/.*?(?=")', self.driver.page_source))
-        return list(sorted(list(unique_links)))
-
-    def get_pintwimg_imgs(self):
-        # https://i.pinimg.com/
-        unique_links = set(re.findall(r'https://i.pinimg.com/.*?(?=")', self.driver.page_source))
-        # twimg
-        unique_links.update(set(re.findall(r'https://pbs.twimg.com/.*?(?=")', self.driver.page_source)))
-        # any link the ends in .jpg, .jpeg, .png
-        unique_links.update(set(re.findall(r'https://.*?\.jpg.*?(?=")', self.driver.page_source)))
-        unique_links.update(set(re.findall(r'https://.*?\.jpeg.*?(?=")', self.driver.page_source)))
-        unique_links.update(set(re.findall(r'https://.*?\.png.*?(?=")', self.driver.page_source)))
-        return list(sorted(list(unique_links)))
-
-    def download_image_with_session(self, session: requests.Session, user_agent: str, img_url: str, save_path: str):
-        # Create requests session with same cookies
-        # Create requests session with same cookies
-        try:
-            if 'lpsg' in img_url:
-                
-                # Copy selenium headers
-                headers = {
-                    'User-Agent': user_agent
-                }
-                
-                # Download image
-                response = session.get(img_url, headers=headers, stream=True)
-                if response.status_code == 200:
-                    with open(save_path, 'wb') as f:
-                        for chunk in response.iter_content(1024):
-                            f.write(chunk)
-            else:
-                response = requests.get(img_url)
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
-            
-        except Exception as e:
-            print(f'error in download_image_with_session: {img_url}', e)
+        print(f'navigation {self.nav_seconds:.1f}s, downloads {self.download_seconds:.1f}s, {self.n_fallbacks} browser fallbacks')
+        print(self.engine.sniff_stats.summary())
+        print(self.limiter.summary())
+        if self.engine.store is not None:
+            print(self.engine.store.summary())
+        if self.engine.gate is not None:
+            print(self.engine.gate.summary())
+        self.cleanup(failed=False)
 
     def get_lpsg_extension(self, img_url: str):
         return img_url.split('-')[-1].split('.')[0]
@@ -145,24 +208,30 @@ class LPSG:
         else:
             return None
 
+    def is_large_enough_size(self, width: int, height: int):
+        return width*height > MIN_IMG_SIZE
+
     def is_large_enough(self, path: str):
         from PIL import Image
         try:
-            with Image.open(path) as img:
-                return img.size[0]*img.size[1] > 1024*1024
+            with METRICS.timer('size_check'), Image.open(path) as img:
+                return self.is_large_enough_size(*img.size)
         except Exception:
             return False
 
-    def download_images(self, img_index: int):
+    def download_images(self, html: str = None) -> int:
+        return self.process_jobs(self.extract_jobs(html))
+
+    def extract_jobs(self, html: str = None) -> tp.List[tp.Tuple[str, str]]:
+        # everything that needs the browser: cookies, user agent and the page's image urls
         import uuid
-        cookies = self.driver.get_cookies()
-        session = requests.Session()
-        for cookie in cookies:
-            session.cookies.set(cookie['name'], cookie['value'])
-        user_agent = self.driver.execute_script('return navigator.userAgent;')
-        attachments = self.get_attachments()
+        if self.fetch_mode == 'browser':
+            self.sync_session()
+        if html is None:
+            html = self.driver.page_source
+        with METRICS.timer('extract'):
+            attachments, other_urls = extract_lpsg_urls(html)
         lpsg_exts = [self.get_lpsg_extension(attachment) for attachment in attachments]
-        other_urls = self.get_pintwimg_imgs()
         other_exts = [self.get_other_extension(url) for url in other_urls]
         keep_other_urls = []
         keep_other_exts = []
@@ -172,80 +241,220 @@ class LPSG:
                 keep_other_exts.append(ext)
         urls = attachments + keep_other_urls
         exts = lpsg_exts + keep_other_exts
-        save_paths = []
-        for ext in exts:
-            if ext in ['jpg', 'jpeg', 'png']:
-                path = os.path.join(self.imgs_dir, f'{uuid.uuid4()}.{ext}')
-                save_paths.append(path)
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [
-                executor.submit(
-                    self.download_image_with_session,
-                    session,
-                    user_agent,
-                    url,
-                    save_path
-                ) for url, save_path in zip(urls, save_paths)
-            ]
-            for future in futures:
-                future.result()
+        jobs = []
+        for url, ext in zip(urls, exts):
+            if ext in ['jpg', 'jpeg', 'png'] and url not in self.finished_urls and url not in self.queued_urls:
+                jobs.append((url, os.path.join(self.imgs_dir, f'{uuid.uuid4()}.{ext}')))
+        self.queued_urls.update(url for url, _ in jobs)
+        self.manifest.add_urls(self.crawl, [url for url, _ in jobs])
+        return jobs
+
+    def process_jobs(self, jobs: tp.List[tp.Tuple[str, str]]) -> int:
+        # downloads, size checks and renames; doesn't touch the browser, so it can run in the background
+        start = time.time()
+        # thumbnails and avatars are cancelled as soon as their header shows they're too small
+        with METRICS.timer('download_batch'):
+            results = self.engine.download_many(
+                jobs, accept_size=self.is_large_enough_size, accept_header=self.accept_header
+            )
+        # (url, state, bytes, final_path, content_hash, error) for the manifest
+        rows = []
         to_keep = []
-        for save_path in save_paths:
-            if os.path.exists(save_path):
-                if not self.is_large_enough(save_path):
-                    os.remove(save_path)
-                else:
-                    to_keep.append(save_path)
-        for save_path in to_keep:
+        for result, (url, save_path) in zip(results, jobs):
+            if result.error is not None or result.status != 200:
+                error = result.error or f'HTTP {result.status}'
+                print(f'error downloading {url} after {result.attempts} attempts: {error}')
+                rows.append((url, 'failed', None, None, None, error))
+            elif result.header_rejected:
+                rows.append((url, 'rejected', None, None, None, 'low jpeg quality'))
+            elif not result.ok and result.gate is not None and result.gate.error is None:
+                rows.append((url, 'rejected', None, None, None, 'low quality'))
+            elif not result.ok:
+                rows.append((url, 'rejected', None, None, None, 'too small or not an image'))
+            elif result.content_hash is not None and result.content_hash in self.seen_hashes:
+                os.remove(save_path)
+                rows.append((url, 'rejected', None, None, result.content_hash, 'duplicate'))
+            elif not self.is_large_enough(save_path):
+                os.remove(save_path)
+                rows.append((url, 'rejected', None, None, result.content_hash, 'too small'))
+            else:
+                if result.content_hash is not None:
+                    self.seen_hashes.add(result.content_hash)
+                to_keep.append((url, save_path, result.content_hash, result.gate))
+        img_index = self.manifest.reserve_indices(self.crawl, len(to_keep))
+        scores = []
+        for url, save_path, content_hash, verdict in to_keep:
             ext = save_path.split('.')[-1]
-            os.rename(save_path, os.path.join(self.imgs_dir, f'{img_index}.{ext}'))
+            final_path = os.path.join(self.imgs_dir, f'{img_index}.{ext}')
+            os.rename(save_path, final_path)
+            rows.append((url, 'done', os.path.getsize(final_path), final_path, content_hash, None))
+            if verdict is not None:
+                scores.append((final_path, verdict))
             img_index += 1
-        return img_index
-
-    def next_link_available(self, next_url: str):
-        links = self.driver.find_elements(By.TAG_NAME, 'a')
-        next_link_found = False
-        for link in links:
-            href = link.get_attribute('href')
-            if href is not None:
-                if next_url in href:
-                    next_link_found = True
-        return next_link_found
+        # the gate already scored what it kept, batch_quality and the exporters read these instead
+        append_scores(self.scores_path, scores)
+        self.manifest.mark_urls(self.crawl, rows)
+        record_rows(rows)
+        if self.on_saved is not None:
+            # after the manifest, so a consumer never sees an image the crawl could still drop
+            for row in rows:
+                if row[1] == 'done':
+                    self.on_saved(row[3])
+        self.finished_urls.update(row[0] for row in rows if row[1] in FINISHED_STATES)
+        self.queued_urls.difference_update(url for url, _ in jobs)
+        self.download_seconds += time.time() - start
+        return len(to_keep)
 
-    def thread_loop(self):
-        page = 1
-        first_page = self.thread_url
-        page_format = 'page-{page}'
-        img_index = 0
+    def download_worker(self, pages: queue.Queue):
+        # single consumer, so file indices still follow page order
         while True:
-            if page == 1:
-                page_url = first_page
-            else:
-                page_url = first_page + page_format.format(page=page)
-            if self.order_by_reaction_score:
-                page_url += f'?{ORDER_BY_REACTION_SCORE}'
+            item = pages.get()
+            if item is None:
+                return
+            if self.worker_error is not None:
+                # keep draining so the producer never blocks, but don't mark later pages done
+                continue
+            page, page_url, jobs = item
             try:
-                self.driver.get(page_url)
-                time.sleep(random.randint(2, 4))
+                n_kept = self.process_jobs(jobs)
+                self.manifest.mark_page(self.crawl, page, page_url, 'done', n_kept)
             except Exception as e:
-                print(e)
-                break
-            img_index = self.download_images(img_index)
-            next_url = first_page + page_format.format(page=page+1)
-            if page >= self.max_pages or not self.next_link_available(next_url):
-                break
-            page += 1
+                self.worker_error = e
+
+    def next_link_available(self, next_url: str, html: str = None):
+        if html is None:
+            html = self.driver.page_source
+        return has_link(html, next_url)
+
+    def page_url(self, page: int) -> str:
+        if page == 1:
+            page_url = self.thread_url
+        else:
+            page_url = self.thread_url + f'page-{page}'
+        if self.order_by_reaction_score:
+            page_url += f'?{ORDER_BY_REACTION_SCORE}'
+        return page_url
+
+    def sync_session(self):
+        # attachments and browserless page fetches need the logged in browser's cookies and user agent
+        self.engine.set_cookies(self.driver.get_cookies())
+        self.engine.set_user_agent(self.driver.execute_script('return navigator.userAgent;'))
+
+    def fetch_page_browser(self, page_url: str) -> str:
+        # the browser is paced by the same per-host limiter as the engine, a challenge counts as a 429
+        self.limiter.acquire(page_url)
+        start = time.time()
+        with METRICS.timer('page_load'):
+            self.driver.get(page_url)
+        # one serialization of the DOM per page, shared by every extraction below
+        with METRICS.timer('page_source'):
+            html = self.driver.page_source
+        self.limiter.observe(page_url, 429 if is_challenge(html) else 200, time.time() - start)
+        return html
+
+    def fetch_page_http(self, page_url: str) -> tp.Optional[str]:
+        # None when the site wants a real browser (challenge page, block), the caller falls back to selenium
+        try:
+            with METRICS.timer('page_fetch'):
+                response = self.engine.request(page_url)
+        except requests.RequestException as e:
+            print(f'http fetch of {page_url} failed: {e}')
+            return None
+        if response.status_code != 200 or is_challenge(response.text):
+            return None
+        return response.text
+
+    def iter_pages(self, page: int) -> tp.Iterator[tp.Tuple[int, str, str]]:
+        # (page, page_url, html) from page on; the caller stops iterating at the last page
+        if self.fetch_mode == 'browser':
+            while page <= self.max_pages:
+                page_url = self.page_url(page)
+                yield page, page_url, self.fetch_page_browser(page_url)
+                page += 1
+            return
+        # http: the next page_concurrency pages are always in flight on the engine's pool
+        ahead: tp.Dict[int, Future] = {}
+        try:
+            while page <= self.max_pages:
+                for p in range(page, min(page + self.page_concurrency, self.max_pages + 1)):
+                    if p not in ahead:
+                        ahead[p] = self.engine.executor.submit(self.fetch_page_http, self.page_url(p))
+                page_url = self.page_url(page)
+                html = ahead.pop(page).result()
+                if html is None:
+                    print(f'falling back to the browser for {page_url}')
+                    html = self.fetch_page_browser(page_url)
+                    # the browser may have picked up fresh clearance cookies
+                    self.sync_session()
+                    self.n_fallbacks += 1
+                yield page, page_url, html
+                page += 1
+        finally:
+            for future in ahead.values():
+                future.cancel()
+
+    def thread_loop(self):
+        # the last finished page is visited again, it may have gained posts (and a next page) since
+        page = max(1, self.manifest.last_done_page(self.crawl))
+        if page > 1:
+            print(f'resuming {self.gal_name} at page {page}')
+        if self.fetch_mode == 'http':
+            self.sync_session()
+        pages = None
+        worker = None
+        if self.pipelined:
+            pages = queue.Queue(maxsize=self.pipeline_depth)
+            worker = threading.Thread(target=self.download_worker, args=(pages,), daemon=True)
+            worker.start()
+        page_iter = self.iter_pages(page)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    page, page_url, html = next(page_iter)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    print(e)
+                    break
+                if self.record_dir is not None:
+                    record_page(self.record_dir, page_url, html)
+                if self.pipelined:
+                    if self.worker_error is not None:
+                        raise self.worker_error
+                    jobs = self.extract_jobs(html)
+                    self.nav_seconds += time.time() - start
+                    # blocks while pipeline_depth pages are already waiting
+                    pages.put((page, page_url, jobs))
+                    METRICS.gauge('pipeline_pages', pages.qsize())
+                else:
+                    self.nav_seconds += time.time() - start
+                    n_kept = self.download_images(html)
+                    self.manifest.mark_page(self.crawl, page, page_url, 'done', n_kept)
+                next_url = self.thread_url + f'page-{page + 1}'
+                if not self.next_link_available(next_url, html):
+                    break
+        finally:
+            page_iter.close()
+            if worker is not None:
+                pages.put(None)
+                worker.join()
+        if self.worker_error is not None:
+            raise self.worker_error
 
     def check_cloudflare(self):
-        moment_check = 'Just a moment...' in self.driver.page_source
-        human_check = 'you are human' in self.driver.page_source
-        if moment_check or human_check:
+        if is_challenge(self.driver.page_source):
             self.cleanup()
             raise Exception('Cloudflare detected')
 
-    def cleanup(self):
-        if self.driver:
-            self.driver.close()
+    def cleanup(self, failed: bool = True):
+        if self.owns_session:
+            self.session.close()
+        elif failed:
+            # whatever went wrong, the shared browser gets checked before its next use
+            self.session.invalidate()
+        self.engine.close()
+        self.manifest.close()
 
 
 if __name__ == '__main__':
@@ -254,19 +463,43 @@ if __name__ == '__main__':
     args.add_argument('--output_dir', type=str, required=True)
     args.add_argument('--order_by_reaction_score', action='store_true', default=False)
     args.add_argument('--max_pages', type=int, required=False, default=1000)
+    args.add_argument('--pipelined', action='store_true', default=False, help='navigate while earlier pages download')
+    args.add_argument('--pipeline_depth', type=int, required=False, default=PIPELINE_DEPTH)
+    args.add_argument('--fetch_mode', type=str, choices=FETCH_MODES, default='browser',
+                      help='http: fetch thread pages without the browser after login')
+    args.add_argument('--page_concurrency', type=int, required=False, default=PAGE_CONCURRENCY)
+    args.add_argument('--record_dir', type=str, required=False, default=None, help='save every fetched page here')
+    args.add_argument('--session_dir', type=str, required=False, default=SESSION_DIR,
+                      help='saved login cookies, reused until the site logs us out')
+    add_gate_args(args)
+    add_metrics_args(args)
     args = args.parse_args()
+    enable_from_args(args)
     thread_url = args.thread_url
     output_dir = args.output_dir
     order_by_reaction_score = args.order_by_reaction_score
     max_pages = args.max_pages
+    gate = gate_from_args(args)
     lpsg = LPSG(
         thread_url=thread_url,
         top_dir=output_dir,
         order_by_reaction_score=order_by_reaction_score,
         max_pages=max_pages,
+        pipelined=args.pipelined,
+        pipeline_depth=args.pipeline_depth,
+        fetch_mode=args.fetch_mode,
+        page_concurrency=args.page_concurrency,
+        record_dir=args.record_dir,
+        session_dir=args.session_dir,
+        gate=gate,
+        jpeg_quality_threshold=args.jpeg_quality_threshold,
     )
     try:
         lpsg.run()
     except Exception as e:
         print(e)
         lpsg.cleanup()
+    finally:
+        if gate is not None:
+            gate.close()
+        export_from_args(args)
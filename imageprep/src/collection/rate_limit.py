@@ -0,0 +1,171 @@
+import email.utils
+import threading
+import time
+import typing as tp
+from urllib.parse import urlsplit
+
+# per-host token buckets whose rate follows the host: additive increase while responses come back
+# fast and clean, multiplicative decrease on 429/503 or when latency climbs, and a full pause for
+# as long as a Retry-After header asks
+
+INITIAL_RATE = 5.
+MIN_RATE = .2
+MAX_RATE = 50.
+# requests that can go out back to back after an idle spell
+BURST = 10.
+# requests/s added per fast, successful response
+INCREASE = .2
+# rate kept after a 429/503
+DECREASE = .5
+# rate kept when latency is SLOW_FACTOR times the host's best
+SLOW_DECREASE = .9
+SLOW_FACTOR = 3.
+THROTTLE_STATUSES = {429, 503}
+# the rate is logged again once it moved this much
+LOG_CHANGE = .25
+
+
+def parse_retry_after(value: tp.Optional[str]) -> tp.Optional[float]:
+    # seconds, from either form of the header
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0., email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostBucket:
+    def __init__(self, host: str, rate: float, min_rate: float, max_rate: float, burst: float):
+        self.host = host
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.paused_until = 0.
+        self.lock = threading.Lock()
+        # exponentially smoothed latency and the best it has been
+        self.latency = None
+        self.best_latency = None
+        self.logged_rate = rate
+        self.n_requests = 0
+        self.n_throttled = 0
+        self.waited = 0.
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self) -> float:
+        # blocks until a request may go out, returns the seconds waited
+        waited = 0.
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1.:
+                    self.tokens -= 1.
+                    self.n_requests += 1
+                    self.waited += waited
+                    return waited
+                else:
+                    wait = (1. - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def observe(self, status: tp.Optional[int], latency: float = None, retry_after: float = None) -> tp.Optional[str]:
+        # adapts the rate to one response; returns a log line when the rate moved enough to report
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            # throttling is always logged, a slow host only once the rate moved LOG_CHANGE
+            reason = None
+            forced = False
+            # Retry-After also rides on 3xx and plain 200s, only a 429/503 means the host is throttling
+            if status in THROTTLE_STATUSES:
+                self.n_throttled += 1
+                self.rate = max(self.min_rate, self.rate * DECREASE)
+                self.tokens = 0.
+                reason = f'HTTP {status}'
+                forced = True
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                    reason += f', retry after {retry_after:.0f}s'
+            elif latency is not None:
+                self.latency = latency if self.latency is None else .8 * self.latency + .2 * latency
+                self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+                if self.latency > SLOW_FACTOR * self.best_latency:
+                    self.rate = max(self.min_rate, self.rate * SLOW_DECREASE)
+                    reason = f'latency {self.latency:.2f}s'
+                elif status is not None and status < 400:
+                    self.rate = min(self.max_rate, self.rate + INCREASE)
+            if not forced and abs(self.rate - self.logged_rate) < LOG_CHANGE * self.logged_rate:
+                return None
+            self.logged_rate = self.rate
+            return f'rate {self.host}: {self.rate:.2f}/s' + (f' ({reason})' if reason else '')
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        initial_rate: float = INITIAL_RATE,
+        min_rate: float = MIN_RATE,
+        max_rate: float = MAX_RATE,
+        burst: float = BURST,
+        verbose: bool = True,
+    ):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.verbose = verbose
+        self.buckets: tp.Dict[str, HostBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url: str) -> HostBucket:
+        host = urlsplit(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = HostBucket(host, self.initial_rate, self.min_rate, self.max_rate, self.burst)
+                self.buckets[host] = bucket
+            return bucket
+
+    def acquire(self, url: str) -> float:
+        return self.bucket(url).acquire()
+
+    def observe(self, url: str, status: tp.Optional[int], latency: float = None, retry_after: str = None):
+        # retry_after is the raw header
+        line = self.bucket(url).observe(status, latency, parse_retry_after(retry_after))
+        if line is not None and self.verbose:
+            print(line)
+
+    def summary(self) -> str:
+        with self.lock:
+            buckets = list(self.buckets.values())
+        return '\n'.join(
+            f'{b.host}: {b.rate:.2f}/s, {b.n_requests} requests, {b.n_throttled} throttled, '
+            f'{b.waited:.1f}s waited for tokens'
+            for b in buckets
+        )
+
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def shared_limiter() -> RateLimiter:
+    # the process-wide limiter the collectors fall back to: page loads and image downloads, every
+    # gallery and every scheduler worker draw from one bucket per host and keep what it learned
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter()
+        return _shared_limiter
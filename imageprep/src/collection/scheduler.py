@@ -0,0 +1,155 @@
+import collections
+import threading
+import time
+import typing as tp
+
+# runs gallery jobs on n workers, each with its own browser session; a failed job goes back on the
+# queue with a delay instead of its worker sleeping, and per-site limits keep us polite to each host
+
+# failed attempt i is retried after i * RETRY_DELAY seconds, like the old inline sleeps
+RETRY_DELAY = 30.
+N_TRIES = 3
+PROGRESS_EVERY = 60.
+
+
+class GalleryJob(tp.NamedTuple):
+    site: str
+    url: str
+    subdir: tp.Optional[str] = None
+    attempt: int = 0
+    not_before: float = 0.
+
+
+class GalleryScheduler:
+    def __init__(
+        self,
+        run_job: tp.Callable[[GalleryJob, tp.Any], None],
+        make_session: tp.Callable[[str, int], tp.Any],
+        n_workers: int = 1,
+        site_limits: tp.Dict[str, int] = None,
+        n_tries: int = N_TRIES,
+        retry_delay: float = RETRY_DELAY,
+        progress_every: float = PROGRESS_EVERY,
+        stop_on: tp.Tuple[tp.Type[BaseException], ...] = (),
+        close_sessions: bool = True,
+    ):
+        # run_job(job, session) raises on failure; make_session(site, worker_id) opens the
+        # worker's session for a site, with its own browser profile and debugging port.
+        # An error of a stop_on type isn't retried, it ends the run and run() raises it again.
+        # Sessions are closed when their worker ends, unless make_session hands out the caller's
+        self.run_job = run_job
+        self.make_session = make_session
+        self.stop_on = stop_on
+        self.close_sessions = close_sessions
+        self.stop_error: tp.Optional[BaseException] = None
+        self.n_workers = n_workers
+        # sites without a limit can use every worker
+        self.site_limits = site_limits or {}
+        self.n_tries = n_tries
+        self.retry_delay = retry_delay
+        self.progress_every = progress_every
+        self.cond = threading.Condition()
+        self.pending: tp.List[GalleryJob] = []
+        self.running: tp.Dict[str, int] = collections.Counter()
+        self.n_done = 0
+        self.n_retried = 0
+        self.failed: tp.List[tp.Tuple[GalleryJob, str]] = []
+        self.n_jobs = 0
+
+    def add(self, site: str, url: str, subdir: str = None):
+        with self.cond:
+            self.pending.append(GalleryJob(site, url, subdir))
+            self.n_jobs += 1
+            self.cond.notify()
+
+    def next_job(self) -> tp.Optional[GalleryJob]:
+        # blocks until a job is due and its site has room; None once nothing is left to run
+        with self.cond:
+            while True:
+                if self.stop_error is not None:
+                    return None
+                if not self.pending and not sum(self.running.values()):
+                    self.cond.notify_all()
+                    return None
+                now = time.time()
+                wait = None
+                for i, job in enumerate(self.pending):
+                    if self.running[job.site] >= self.site_limits.get(job.site, self.n_workers):
+                        continue
+                    if job.not_before > now:
+                        wait = job.not_before - now if wait is None else min(wait, job.not_before - now)
+                        continue
+                    self.running[job.site] += 1
+                    return self.pending.pop(i)
+                # woken by a finished job (a site slot or the end) or when a retry comes due
+                self.cond.wait(timeout=wait)
+
+    def finish(self, job: GalleryJob, error: Exception = None):
+        with self.cond:
+            self.running[job.site] -= 1
+            if error is None:
+                self.n_done += 1
+            elif job.attempt + 1 < self.n_tries:
+                print(f'failed {job.url} ({job.attempt + 1}/{self.n_tries}): {error}, retrying in {job.attempt * self.retry_delay:.0f}s')
+                self.pending.append(job._replace(attempt=job.attempt + 1, not_before=time.time() + job.attempt * self.retry_delay))
+                self.n_retried += 1
+            else:
+                print(f'giving up on {job.url} after {self.n_tries} tries: {error}')
+                self.failed.append((job, str(error)))
+            self.cond.notify_all()
+
+    def stop(self, job: GalleryJob, error: BaseException):
+        # nothing new starts, jobs already running on other workers finish
+        with self.cond:
+            self.running[job.site] -= 1
+            self.stop_error = error
+            self.pending.clear()
+            self.cond.notify_all()
+
+    def worker(self, worker_id: int):
+        sessions = {}
+        try:
+            while True:
+                job = self.next_job()
+                if job is None:
+                    break
+                try:
+                    if job.site not in sessions:
+                        sessions[job.site] = self.make_session(job.site, worker_id)
+                    self.run_job(job, sessions[job.site])
+                except self.stop_on as e:
+                    self.stop(job, e)
+                except Exception as e:
+                    self.finish(job, e)
+                else:
+                    self.finish(job)
+        finally:
+            if self.close_sessions:
+                for session in sessions.values():
+                    session.close()
+
+    def summary(self) -> str:
+        with self.cond:
+            n_running = sum(self.running.values())
+            n_waiting = sum(job.attempt > 0 for job in self.pending)
+            return (
+                f'galleries: {self.n_done}/{self.n_jobs} done, {n_running} running, '
+                f'{len(self.pending) - n_waiting} queued, {n_waiting} waiting to retry, '
+                f'{len(self.failed)} failed ({self.n_retried} retries)'
+            )
+
+    def run(self) -> tp.List[tp.Tuple[GalleryJob, str]]:
+        # returns the jobs that failed every try, with their last error
+        start = time.time()
+        workers = [threading.Thread(target=self.worker, args=(i,), daemon=True) for i in range(self.n_workers)]
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=self.progress_every / len(workers))
+            if any(worker.is_alive() for worker in workers):
+                print(self.summary())
+        print(f'{self.summary()} in {time.time() - start:.0f}s')
+        if self.stop_error is not None:
+            raise self.stop_error
+        return self.failed
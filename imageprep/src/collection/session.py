@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import typing as tp
+
+# one logged in browser per site, shared by every gallery of a batch, with its cookies saved to disk
+# so the next run starts logged in; the typed-out login only runs when the site says we are logged out
+# example run, what is saved for each site:
+# python -m imageprep.src.collection.session --session_dir data/sessions
+
+SESSION_DIR = 'data/sessions'
+# a session checked this recently is trusted without loading a page
+VALIDATE_EVERY = 10*60
+# add_cookie rejects keys it doesn't know
+COOKIE_KEYS = ('name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'expiry', 'sameSite')
+
+
+def load_cookies(cookie_path: str) -> tp.List[dict]:
+    # the unexpired cookies of a saved session, [] when there is none
+    if not os.path.exists(cookie_path):
+        return []
+    try:
+        with open(cookie_path, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return []
+    now = time.time()
+    return [cookie for cookie in saved.get('cookies', []) if cookie.get('expiry', now + 1) > now]
+
+
+def save_cookies(cookie_path: str, cookies: tp.List[dict]):
+    cookie_dir = os.path.dirname(cookie_path) or '.'
+    os.makedirs(cookie_dir, exist_ok=True)
+    # a private temp file per writer (these cookies log in as us), workers sharing a site can save at once
+    fd, part_path = tempfile.mkstemp(dir=cookie_dir, suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'saved': time.time(), 'cookies': cookies}, f)
+    os.replace(part_path, cookie_path)
+
+
+class BrowserSession:
+    def __init__(
+        self,
+        name: str,
+        home_url: str,
+        open_browser: tp.Callable[[], tp.Any],
+        login: tp.Callable[[tp.Any], None],
+        logged_in_marker: str,
+        session_dir: str = SESSION_DIR,
+        validate_every: float = VALIDATE_EVERY,
+    ):
+        # open_browser returns a new driver, login(driver) fills in the login form;
+        # logged_in_marker is a string only pages seen by a logged in user contain
+        self.name = name
+        self.home_url = home_url
+        self.open_browser = open_browser
+        self.login_fn = login
+        self.logged_in_marker = logged_in_marker
+        self.cookie_path = os.path.join(session_dir, f'{name}.json')
+        self.validate_every = validate_every
+        self.driver = None
+        self.validated_at = None
+        self.n_logins = 0
+        self.n_restored = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def is_logged_in(self) -> bool:
+        return self.logged_in_marker in self.driver.page_source
+
+    def restore(self) -> bool:
+        # the cookie jar of an earlier run; add_cookie only works on a page of the cookie's domain
+        cookies = load_cookies(self.cookie_path)
+        if not cookies:
+            return False
+        self.driver.get(self.home_url)
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie({k: v for k, v in cookie.items() if k in COOKIE_KEYS})
+            except Exception:
+                # cookies of another subdomain, the browser picks them up again after login
+                pass
+        self.driver.get(self.home_url)
+        return self.is_logged_in()
+
+    def ensure(self):
+        # a logged in driver, at the cost of one page load at most while the session is alive
+        if self.driver is not None and self.validated_at is not None:
+            if time.time() - self.validated_at < self.validate_every:
+                return self.driver
+        try:
+            self.validate()
+        except Exception as e:
+            # the browser went away under us, start over once
+            print(f'{self.name} session lost ({e}), reopening the browser')
+            self.reset()
+            self.validate()
+        return self.driver
+
+    def validate(self):
+        if self.driver is None:
+            self.driver = self.open_browser()
+            if self.restore():
+                self.n_restored += 1
+                print(f'{self.name}: restored saved session')
+                self.validated_at = time.time()
+                return
+        else:
+            self.driver.get(self.home_url)
+            if self.is_logged_in():
+                self.validated_at = time.time()
+                return
+        print(f'{self.name}: logging in')
+        self.login_fn(self.driver)
+        self.n_logins += 1
+        self.driver.get(self.home_url)
+        if not self.is_logged_in():
+            raise Exception(f'{self.name} login failed')
+        save_cookies(self.cookie_path, self.driver.get_cookies())
+        self.validated_at = time.time()
+
+    def invalidate(self):
+        # after a failure, the next ensure checks the session again before trusting it
+        self.validated_at = None
+
+    def save(self):
+        if self.driver is not None and self.validated_at is not None:
+            save_cookies(self.cookie_path, self.driver.get_cookies())
+
+    def reset(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+        self.driver = None
+        self.validated_at = None
+
+    def close(self):
+        # keeps cookies refreshed during the run for the next one
+        try:
+            self.save()
+        except Exception as e:
+            print(f'could not save the {self.name} session: {e}')
+        self.reset()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--session_dir', type=str, required=False, default=SESSION_DIR)
+    args = args.parse_args()
+    if not os.path.isdir(args.session_dir):
+        print(f'no sessions in {args.session_dir}')
+    else:
+        for name in sorted(os.listdir(args.session_dir)):
+            if not name.endswith('.json'):
+                continue
+            cookie_path = os.path.join(args.session_dir, name)
+            with open(cookie_path, 'r') as f:
+                saved = json.load(f)
+            expiries = [cookie['expiry'] for cookie in load_cookies(cookie_path) if 'expiry' in cookie]
+            expires = time.strftime('%Y-%m-%d %H:%M', time.localtime(min(expiries))) if expiries else 'with the browser'
+            print(
+                f"{name[:-5]}\tsaved {time.strftime('%Y-%m-%d %H:%M', time.localtime(saved['saved']))}\t"
+                f"{len(saved['cookies'])} cookies\tfirst expiry {expires}"
+            )
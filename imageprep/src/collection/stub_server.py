@@ -0,0 +1,205 @@
+import argparse
+import collections
+import os
+import threading
+import time
+import typing as tp
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# local stand-in for the image hosts, so the download path can be exercised without the network
+# example run, serve a folder of images on port 8000:
+# python -m imageprep.src.collection.stub_server --root data/test/imgs --port 8000
+# pages saved by a collector's --record_dir are served under their original paths:
+# python -m imageprep.src.collection.stub_server --root data/fixtures/pages --port 8000
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.html': 'text/html; charset=utf-8',
+    '.json': 'application/json',
+}
+
+# bandwidth-limited bodies go out in pieces this big
+STREAM_CHUNK = 16*1024
+
+
+class StubServer:
+    def __init__(
+        self,
+        routes: tp.Dict[str, bytes] = None,
+        root: str = None,
+        latency: float = 0.,
+        fail_first: int = 0,
+        fail_status: int = 503,
+        port: int = 0,
+        max_rate: float = None,
+        retry_after: int = 1,
+        bandwidth: float = None,
+    ):
+        # routes maps a path to a body and wins over files under root; fail_first answers the
+        # first n requests of every path with fail_status, to exercise retries; past max_rate
+        # requests/s the server answers 429 with Retry-After, like a host that throttles;
+        # bandwidth caps each response at that many bytes/s
+        self.routes = dict(routes or {})
+        self.root = root
+        self.latency = latency
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.lock = threading.Lock()
+        self.hits: tp.Dict[str, int] = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        # a second's worth of requests may arrive at once
+        self.tokens = max_rate or 0.
+        self.last = time.monotonic()
+        self.n_throttled = 0
+        self.bandwidth = bandwidth
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def url(self, path: str = '/') -> str:
+        return f'http://127.0.0.1:{self.port}{path}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def throttled(self) -> bool:
+        if self.max_rate is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_rate, self.tokens + (now - self.last) * self.max_rate)
+            self.last = now
+            if self.tokens >= 1.:
+                self.tokens -= 1.
+                return False
+            self.n_throttled += 1
+            return True
+
+    def body_for(self, path: str) -> tp.Optional[tp.Tuple[bytes, str]]:
+        if path in self.routes:
+            ext = os.path.splitext(path)[1].lower()
+            return self.routes[path], CONTENT_TYPES.get(ext, 'application/octet-stream')
+        if self.root is None:
+            return None
+        root = os.path.abspath(self.root)
+        file_path = os.path.abspath(os.path.join(root, path.lstrip('/')))
+        if os.path.isdir(file_path):
+            # recorded pages live at {path}/index.html
+            file_path = os.path.join(file_path, 'index.html')
+        # no escaping the served folder with ../
+        if not file_path.startswith(root + os.sep) or not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        ext = os.path.splitext(file_path)[1].lower()
+        return body, CONTENT_TYPES.get(ext, 'application/octet-stream')
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                with stub.lock:
+                    stub.hits[path] += 1
+                    n_hits = stub.hits[path]
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    if n_hits <= stub.fail_first:
+                        self.send(stub.fail_status, b'', 'text/plain')
+                        return
+                    if stub.throttled():
+                        self.send(429, b'slow down', 'text/plain', {'Retry-After': str(stub.retry_after)})
+                        return
+                    found = stub.body_for(path)
+                    if found is None:
+                        self.send(404, b'not found', 'text/plain')
+                        return
+                    self.send(200, *found)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+            def send(self, status: int, body: bytes, content_type: str, headers: tp.Dict[str, str] = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    if stub.bandwidth is None:
+                        self.wfile.write(body)
+                    else:
+                        for i in range(0, len(body), STREAM_CHUNK):
+                            chunk = body[i:i + STREAM_CHUNK]
+                            self.wfile.write(chunk)
+                            time.sleep(len(chunk) / stub.bandwidth)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client aborted the transfer, e.g. after sniffing the header
+                    pass
+
+        return Handler
+
+
+def record_page(root: str, url: str, html: str):
+    # keeps a fetched page where StubServer(root=root) serves it again
+    page_dir = os.path.join(root, urlsplit(url).path.strip('/'))
+    os.makedirs(page_dir, exist_ok=True)
+    with open(os.path.join(page_dir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(html)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--root', type=str, required=True)
+    args.add_argument('--port', type=int, required=False, default=8000)
+    args.add_argument('--latency', type=float, required=False, default=0.)
+    args.add_argument('--fail_first', type=int, required=False, default=0)
+    args.add_argument('--max_rate', type=float, required=False, default=None, help='answer 429 past this many requests/s')
+    args.add_argument('--bandwidth', type=float, required=False, default=None, help='bytes/s per response')
+    args = args.parse_args()
+    stub = StubServer(
+        root=args.root,
+        latency=args.latency,
+        fail_first=args.fail_first,
+        port=args.port,
+        max_rate=args.max_rate,
+        bandwidth=args.bandwidth,
+    )
+    print(f'serving {args.root} on {stub.url()}')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
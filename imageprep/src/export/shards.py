@@ -0,0 +1,388 @@
+import argparse
+import glob
+import io
+import itertools
+import json
+import mmap
+import os
+import re
+import sys
+import tarfile
+import time
+import typing as tp
+
+import numpy as np
+
+from imageprep.src.collection.crawl_manifest import MANIFEST_NAME, CrawlManifest
+from imageprep.src.utils.paths import iter_image_paths, path_digest, read_path_list
+
+# WebDataset style export: accepted images go into fixed-size tar shards as {key}.{ext} plus
+# {key}.json with the quality metrics and source url, so trainers stream a few big files instead
+# of millions of small ones. Next to every shard a .idx file of fixed-size records holds the byte
+# offsets of each sample, a reader memory-maps both and seeks straight to any image.
+# Later runs append: the last shard is reopened and images already exported are skipped.
+# example runs, export what batch_quality accepted, or score and export in one streaming pass:
+# python -m imageprep.src.export.shards --scores data/test/scores.jsonl --output_dir data/shards
+# python -m imageprep.src.export.shards data/test --output_dir data/shards --workers 8
+# list the shards of an export:
+# python -m imageprep.src.export.shards --output_dir data/shards --info
+
+SHARD_PREFIX = 'shard'
+SHARD_MAX_COUNT = 10000
+SHARD_MAX_BYTES = 1 << 30
+INDEX_DTYPE = np.dtype([
+    ('key', 'S128'),
+    ('ext', 'S8'),
+    ('img_offset', '<u8'),
+    ('img_size', '<u8'),
+    ('json_offset', '<u8'),
+    ('json_size', '<u8'),
+])
+# webdataset splits member names at the first dot, keys must not have one
+KEY_UNSAFE_RE = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+def sample_key(img_path: str) -> str:
+    # {gallery}_{index}_{digest}: the collectors' file names repeat across galleries, gallery names
+    # across sites and top dirs, and a repeated key is skipped as exported; the path digest goes
+    # last so a key cut to the record size keeps it
+    parts = [p for p in os.path.normpath(img_path).split(os.sep) if p not in ('imgs', '')]
+    stem = os.path.splitext(parts[-1])[0]
+    key = f'{parts[-2]}_{stem}' if len(parts) > 1 else stem
+    return KEY_UNSAFE_RE.sub('_', f'{key}_{path_digest(img_path)}')[-INDEX_DTYPE['key'].itemsize:]
+
+
+def index_path(shard_path: str) -> str:
+    return shard_path[:-len('.tar')] + '.idx'
+
+
+def data_offset(tar: tarfile.TarFile, size: int) -> int:
+    # addfile leaves tar.offset after the block-padded data, whatever the header length was
+    return tar.offset - (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+def scan_shard(shard_path: str) -> tp.Tuple[np.ndarray, int]:
+    # index records of every complete sample in a tar and the byte offset where they end; a run
+    # killed mid-write leaves a half sample (or half member) behind, everything after is dropped
+    shard_size = os.path.getsize(shard_path)
+    records = []
+    end = 0
+    current_key, members = None, {}
+    try:
+        with tarfile.open(shard_path, 'r') as tar:
+            for member in tar:
+                if member.offset_data + member.size > shard_size:
+                    break
+                key, ext = member.name.split('.', 1)
+                if key != current_key:
+                    current_key, members = key, {}
+                members[ext] = member
+                img_ext = next((e for e in members if e != 'json'), None)
+                if img_ext is not None and 'json' in members:
+                    img, meta = members[img_ext], members['json']
+                    records.append((key, img_ext, img.offset_data, img.size, meta.offset_data, meta.size))
+                    end = tar.offset
+                    current_key, members = None, {}
+    except tarfile.ReadError:
+        pass
+    return np.array(records, dtype=INDEX_DTYPE), end
+
+
+def terminate_shard(shard_path: str, end: int):
+    # a run killed before closing the shard left no end-of-archive blocks, maybe half a sample;
+    # whatever follows the last complete sample is replaced by them
+    with open(shard_path, 'r+b') as f:
+        f.seek(end)
+        tail = f.read()
+        if len(tail) >= 2 * tarfile.BLOCKSIZE and not tail.strip(b'\0'):
+            return
+        f.truncate(end)
+        f.seek(end)
+        f.write(bytes(2 * tarfile.BLOCKSIZE))
+
+
+def read_index(shard_path: str) -> np.ndarray:
+    path = index_path(shard_path)
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(path, dtype=INDEX_DTYPE, mode='r')
+
+
+def shard_paths(output_dir: str, prefix: str = SHARD_PREFIX) -> tp.List[str]:
+    return sorted(glob.glob(os.path.join(output_dir, f'{prefix}-[0-9]*.tar')))
+
+
+class ShardWriter:
+    def __init__(
+        self,
+        output_dir: str,
+        prefix: str = SHARD_PREFIX,
+        max_count: int = SHARD_MAX_COUNT,
+        max_bytes: int = SHARD_MAX_BYTES,
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.f = None
+        self.tar = None
+        self.index_f = None
+        self.shard_path = None
+        self.shard_count = 0
+        self.n_written = 0
+        self.n_skipped = 0
+        self.bytes_written = 0
+        paths = shard_paths(output_dir, prefix)
+        # keys of every earlier run, so re-exporting a folder only adds what is new
+        self.keys = set()
+        for path in paths[:-1]:
+            self.keys.update(k.decode() for k in read_index(path)['key'])
+        self.shard_no = len(paths)
+        if paths:
+            self.reopen(paths[-1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def reopen(self, shard_path: str):
+        # the last shard is rescanned rather than trusting its index, which may be a record behind
+        records, end = scan_shard(shard_path)
+        self.keys.update(k.decode() for k in records['key'])
+        with open(index_path(shard_path), 'wb') as f:
+            f.write(records.tobytes())
+        # a full shard stays closed, its index is repaired all the same
+        if len(records) >= self.max_count or end >= self.max_bytes:
+            terminate_shard(shard_path, end)
+            return
+        self.shard_no -= 1
+        self.open_shard(shard_path, end, len(records))
+
+    def open_shard(self, shard_path: str = None, end: int = 0, count: int = 0):
+        # new members go right after the last complete sample, over the end-of-archive blocks
+        # of a closed shard or the remains of a killed run
+        self.shard_path = shard_path or os.path.join(self.output_dir, f'{self.prefix}-{self.shard_no:06d}.tar')
+        self.f = open(self.shard_path, 'r+b' if end else 'wb')
+        self.f.truncate(end)
+        self.f.seek(end)
+        self.tar = tarfile.open(fileobj=self.f, mode='w', format=tarfile.PAX_FORMAT)
+        self.index_f = open(index_path(self.shard_path), 'ab' if end else 'wb')
+        self.shard_count = count
+        self.shard_no += 1
+
+    def close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.f.close()
+        self.index_f.close()
+        self.f = None
+        self.tar = None
+        self.index_f = None
+
+    def add_member(self, name: str, data: bytes, mtime: float) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+        return data_offset(self.tar, len(data))
+
+    def write(self, key: str, img_bytes: bytes, ext: str, metadata: dict) -> bool:
+        # False when the key was exported before
+        if key in self.keys:
+            self.n_skipped += 1
+            return False
+        if self.tar is None or self.shard_count >= self.max_count or self.tar.offset >= self.max_bytes:
+            self.close_shard()
+            self.open_shard()
+        json_bytes = json.dumps(metadata).encode()
+        mtime = time.time()
+        img_offset = self.add_member(f'{key}.{ext}', img_bytes, mtime)
+        json_offset = self.add_member(f'{key}.json', json_bytes, mtime)
+        record = np.array(
+            [(key, ext, img_offset, len(img_bytes), json_offset, len(json_bytes))], dtype=INDEX_DTYPE
+        )
+        # the tar goes first, a record is never ahead of the data it points to
+        self.f.flush()
+        self.index_f.write(record.tobytes())
+        self.index_f.flush()
+        self.keys.add(key)
+        self.shard_count += 1
+        self.n_written += 1
+        self.bytes_written += len(img_bytes)
+        return True
+
+    def write_file(self, img_path: str, metadata: dict) -> bool:
+        key = sample_key(img_path)
+        if key in self.keys:
+            self.n_skipped += 1
+            return False
+        with open(img_path, 'rb') as f:
+            img_bytes = f.read()
+        ext = os.path.splitext(img_path)[1][1:].lower().replace('jpeg', 'jpg')
+        return self.write(key, img_bytes, ext, metadata)
+
+    def close(self):
+        self.close_shard()
+
+    def summary(self) -> str:
+        return (
+            f'{self.n_written} samples ({self.bytes_written / 2**20:.1f}MB) written, '
+            f'{self.n_skipped} already exported, {self.shard_no} shards in {self.output_dir}'
+        )
+
+
+class ShardReader:
+    def __init__(self, shard_path: str):
+        # both files are mapped, a lookup touches only the pages of the one sample it reads
+        self.shard_path = shard_path
+        self.index = read_index(shard_path)
+        self.f = open(shard_path, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key_rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> tp.Tuple[str, memoryview, dict]:
+        # (key, image bytes, metadata); the image is a zero-copy view into the mapping,
+        # copy it with bytes() to keep it past close()
+        key, _, img_offset, img_size, json_offset, json_size = self.index[i]
+        view = memoryview(self.data)
+        metadata = json.loads(bytes(view[json_offset:json_offset + json_size]))
+        return key.decode(), view[img_offset:img_offset + img_size], metadata
+
+    def get(self, key: str) -> tp.Tuple[str, memoryview, dict]:
+        if self.key_rows is None:
+            self.key_rows = {k.decode(): i for i, k in enumerate(self.index['key'])}
+        return self[self.key_rows[key]]
+
+    def close(self):
+        self.index = None
+        self.data.close()
+        self.f.close()
+
+
+class ShardedDataset:
+    def __init__(self, output_dir: str, prefix: str = SHARD_PREFIX):
+        # global sample i -> (shard, row) through the cumulative shard sizes
+        self.readers = [ShardReader(path) for path in shard_paths(output_dir, prefix)]
+        self.starts = np.cumsum([0] + [len(r) for r in self.readers])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def __getitem__(self, i: int) -> tp.Tuple[str, memoryview, dict]:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.readers[shard][i - int(self.starts[shard])]
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+
+class SourceLookup:
+    def __init__(self, manifest_paths: tp.Iterable[str] = ()):
+        # image path -> (url, content hash) from the collectors' crawl manifests; those next to the
+        # images ({top_dir}/{gallery}/imgs/{index}.ext) are found on their own
+        self.files = {}
+        self.seen_dirs = set()
+        for path in manifest_paths:
+            self.load(path)
+
+    def load(self, manifest_path: str):
+        with CrawlManifest(manifest_path) as manifest:
+            self.files.update(manifest.done_files())
+
+    def get(self, img_path: str) -> tp.Tuple[tp.Optional[str], tp.Optional[str]]:
+        # resolved like the manifest's paths, an absolute one and a relative one meet
+        img_path = os.path.realpath(img_path)
+        top_dir = os.path.dirname(os.path.dirname(os.path.dirname(img_path)))
+        if top_dir not in self.seen_dirs:
+            self.seen_dirs.add(top_dir)
+            if os.path.exists(os.path.join(top_dir, MANIFEST_NAME)):
+                self.load(os.path.join(top_dir, MANIFEST_NAME))
+        return self.files.get(img_path, (None, None))
+
+
+def sample_metadata(result: dict, sources: SourceLookup) -> dict:
+    url, content_hash = sources.get(result['path'])
+    return {
+        'path': result['path'],
+        'url': url,
+        'content_hash': content_hash,
+        'sharpness': result.get('sharpness'),
+        'brightness': result.get('brightness'),
+        'brisque': result.get('brisque'),
+    }
+
+
+def export_results(results: tp.Iterable[dict], writer: ShardWriter, sources: SourceLookup = None) -> tp.Iterator[dict]:
+    # batch_quality results in, each accepted image goes into the shards as it arrives;
+    # yields every result back so a caller can keep its own log
+    sources = sources or SourceLookup()
+    for result in results:
+        if result.get('quality'):
+            try:
+                writer.write_file(result['path'], sample_metadata(result, sources))
+            except OSError as e:
+                print(f'could not export {result["path"]}: {e}', file=sys.stderr)
+        yield result
+
+
+def read_scores(scores_path: str) -> tp.Iterator[dict]:
+    with open(scores_path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='*', help='image directories and/or image paths, scored on the fly')
+    args.add_argument('--scores', type=str, required=False, default=None, help='batch_quality jsonl to export from')
+    args.add_argument('--path_list', type=str, required=False, default=None, help='text file with one image path per line')
+    args.add_argument('--output_dir', type=str, required=True)
+    args.add_argument('--prefix', type=str, default=SHARD_PREFIX)
+    args.add_argument('--max_count', type=int, default=SHARD_MAX_COUNT, help='samples per shard')
+    args.add_argument('--max_bytes', type=int, default=SHARD_MAX_BYTES, help='bytes per shard')
+    args.add_argument('--manifest', type=str, nargs='*', default=[], help='crawl manifests with the source urls')
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--cascade', action='store_true', default=False)
+    args.add_argument('--info', action='store_true', default=False, help='list the shards and exit')
+    args = args.parse_args()
+    if args.info:
+        n_samples = 0
+        for path in shard_paths(args.output_dir, args.prefix):
+            index = read_index(path)
+            n_samples += len(index)
+            print(f'{os.path.basename(path)}\t{len(index)} samples\t{os.path.getsize(path) / 2**20:.1f}MB')
+        print(f'{n_samples} samples')
+        raise SystemExit
+    if args.scores:
+        results = read_scores(args.scores)
+    elif args.inputs or args.path_list:
+        # cv2 and the BRISQUE model only when scoring here, --info stays quick
+        from imageprep.src.quality.batch_quality import BatchQuality
+        inputs = iter_image_paths(args.inputs)
+        if args.path_list:
+            inputs = itertools.chain(inputs, iter_image_paths(read_path_list(args.path_list)))
+        results = BatchQuality(n_workers=args.workers, cascade=args.cascade).score(inputs)
+    else:
+        raise SystemExit('no inputs given')
+    n_total = 0
+    with ShardWriter(args.output_dir, args.prefix, args.max_count, args.max_bytes) as writer:
+        for _ in export_results(results, writer, SourceLookup(args.manifest)):
+            n_total += 1
+    print(f'{n_total} images seen, {writer.summary()}')
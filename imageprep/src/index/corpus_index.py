@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from imageprep.src.export.shards import SourceLookup
+from imageprep.src.utils.metrics import write_atomic
+from imageprep.src.utils.paths import iter_image_paths
+
+if tp.TYPE_CHECKING:
+    from imageprep.src.quality.quality_cache import QualityCache
+
+# columnar index of every image in the corpus: one memory-mapped file per column, so a filter over
+# millions of rows is a few vectorized comparisons on pages the OS already caches, no directory walk
+# and no decode. Updates append the new files and patch changed rows in place, and meta.json (written
+# last) holds the row count, so a killed update leaves the index as it was.
+# example runs, index the collectors' output with the scores batch_quality wrote, then query it:
+# python -m imageprep.src.index.corpus_index data/index --update data/test --scores data/test/scores.jsonl
+# python -m imageprep.src.index.corpus_index data/index --where 'pixels>2e6' --where 'brisque<25' --gallery drazenpn.5832241
+
+META_NAME = 'meta.json'
+# fixed-width columns, {name}.col; NaN metrics were never scored
+COLUMNS = {
+    'gallery': np.dtype('<u4'),
+    'width': np.dtype('<u4'),
+    'height': np.dtype('<u4'),
+    'n_bytes': np.dtype('<u8'),
+    'mtime_ns': np.dtype('<i8'),
+    'content_hash': np.dtype('S64'),
+    'sharpness': np.dtype('<f4'),
+    'brightness': np.dtype('<f4'),
+    'brisque': np.dtype('<f4'),
+    'deleted': np.dtype('?'),
+}
+# variable-length utf-8, {name}.data plus n_rows + 1 offsets in {name}.offsets
+STRING_COLUMNS = ('path', 'url')
+# computed on the fly for queries, from the rows still in the selection
+VIRTUAL_COLUMNS = {
+    'pixels': lambda index, rows: index.values('width', rows).astype(np.uint64) * index.values('height', rows),
+    'aspect': lambda index, rows: index.values('width', rows) / np.maximum(index.values('height', rows), 1),
+}
+METRIC_COLUMNS = ('sharpness', 'brightness', 'brisque')
+CONDITION_RE = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+OPS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+# new files are read (header, stat, hash) on threads and committed in chunks of this many
+UPDATE_CHUNK = 4096
+UPDATE_THREADS = 8
+
+
+def gallery_name(img_path: str) -> str:
+    # {top_dir}/{gallery}/imgs/{index}.ext from the collectors, else the parent folder
+    parts = [p for p in os.path.normpath(img_path).split(os.sep) if p not in ('imgs', '')]
+    return parts[-2] if len(parts) > 1 else ''
+
+
+def parse_condition(condition: str) -> tp.Tuple[str, str, tp.Union[float, bytes]]:
+    # 'brisque<25' -> ('brisque', '<', 25.0)
+    match = CONDITION_RE.match(condition)
+    if match is None:
+        raise ValueError(f'bad condition {condition!r}, expected e.g. brisque<25')
+    name, op, value = match.groups()
+    if name == 'content_hash':
+        return name, op, value.encode()
+    return name, op, float(value)
+
+
+def read_scores(scores_path: str) -> tp.Dict[str, tp.Tuple[float, float, float]]:
+    # batch_quality jsonl -> path -> metrics, None for stages a cascade skipped
+    scores = {}
+    with open(scores_path, 'r') as f:
+        for line in f:
+            row = json.loads(line)
+            if row.get('error') is None:
+                scores[os.path.normpath(row['path'])] = tuple(row[m] for m in METRIC_COLUMNS)
+    return scores
+
+
+def read_file_row(img_path: str, content_hash: tp.Optional[str]) -> tp.Optional[tuple]:
+    # header and stat only, plus a hash when no crawl manifest had one
+    # (imported here, queries never load cv2)
+    from imageprep.src.quality.cv_quality import read_image_size
+    from imageprep.src.quality.quality_cache import hash_file
+    try:
+        stat = os.stat(img_path)
+        size = read_image_size(img_path) or (0, 0)
+        if content_hash is None:
+            content_hash = hash_file(img_path)
+    except OSError:
+        return None
+    return size[0], size[1], stat.st_size, stat.st_mtime_ns, content_hash
+
+
+class CorpusIndex:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.load()
+
+    def load(self):
+        meta_path = os.path.join(self.index_dir, META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'n_rows': 0, 'galleries': []}
+        self.n_rows = self.meta['n_rows']
+        self.galleries = self.meta['galleries']
+        self.gallery_ids = {name: i for i, name in enumerate(self.galleries)}
+        self.columns = {}
+        self.path_rows = None
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def col_path(self, name: str, suffix: str = 'col') -> str:
+        return os.path.join(self.index_dir, f'{name}.{suffix}')
+
+    def map(self, path: str, dtype: np.dtype, n: int, mode: str = 'r') -> np.ndarray:
+        # the file can be longer than n after a killed update, the tail is ignored
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode=mode, shape=(n,))
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self.columns:
+            if name in STRING_COLUMNS:
+                raise ValueError(f'{name} is a string column, use strings()')
+            self.columns[name] = self.map(self.col_path(name), COLUMNS[name], self.n_rows)
+        return self.columns[name]
+
+    def values(self, name: str, rows: np.ndarray = None) -> np.ndarray:
+        # a column, or only the given rows of it
+        if name in VIRTUAL_COLUMNS:
+            return VIRTUAL_COLUMNS[name](self, rows)
+        column = self.column(name)
+        return column if rows is None else column[rows]
+
+    def strings(self, name: str, rows: tp.Iterable[int]) -> tp.List[str]:
+        if not self.n_rows:
+            return []
+        offsets = self.map(self.col_path(name, 'offsets'), np.dtype('<u8'), self.n_rows + 1)
+        data = self.map(self.col_path(name, 'data'), np.dtype('u1'), int(offsets[-1]))
+        return [bytes(data[offsets[i]:offsets[i + 1]]).decode() for i in rows]
+
+    def select(
+        self,
+        conditions: tp.Sequence[tp.Tuple[str, str, tp.Any]] = (),
+        galleries: tp.Sequence[str] = (),
+        include_deleted: bool = False,
+    ) -> np.ndarray:
+        # row numbers matching every condition; comparisons with an unscored (NaN) metric are False.
+        # The first filter scans its whole column, later ones only gather the rows still selected
+        filters = []
+        if galleries:
+            ids = [self.gallery_ids[g] for g in galleries if g in self.gallery_ids]
+            filters.append(lambda rows: np.isin(self.values('gallery', rows), ids))
+        for name, op, value in conditions:
+            filters.append(lambda rows, name=name, op=op, value=value: OPS[op](self.values(name, rows), value))
+        if not include_deleted:
+            filters.append(lambda rows: ~self.values('deleted', rows))
+        rows = None
+        for match in filters:
+            mask = match(rows)
+            rows = np.flatnonzero(mask) if rows is None else rows[mask]
+        return np.arange(self.n_rows) if rows is None else rows
+
+    def row(self, i: int) -> dict:
+        row = {name: self.column(name)[i].item() for name in COLUMNS}
+        row['gallery'] = self.galleries[row['gallery']]
+        row['content_hash'] = row['content_hash'].decode()
+        for name in STRING_COLUMNS:
+            row[name] = self.strings(name, [i])[0]
+        return row
+
+    def gallery_id(self, name: str) -> int:
+        if name not in self.gallery_ids:
+            self.gallery_ids[name] = len(self.galleries)
+            self.galleries.append(name)
+        return self.gallery_ids[name]
+
+    def load_path_rows(self) -> tp.Dict[str, int]:
+        # only updates need the path -> row map
+        if self.path_rows is None:
+            self.path_rows = {path: i for i, path in enumerate(self.strings('path', range(self.n_rows)))}
+        return self.path_rows
+
+    def append(self, rows: tp.Dict[str, np.ndarray], strings: tp.Dict[str, tp.List[str]]):
+        # column files are cut back to n_rows first, dropping whatever a killed update left behind
+        n_new = len(strings['path'])
+        for name, dtype in COLUMNS.items():
+            with open(self.col_path(name), 'ab') as f:
+                f.truncate(self.n_rows * dtype.itemsize)
+                f.write(np.asarray(rows[name], dtype=dtype).tobytes())
+        for name in STRING_COLUMNS:
+            offsets_path = self.col_path(name, 'offsets')
+            if self.n_rows:
+                end = int(self.map(offsets_path, np.dtype('<u8'), self.n_rows + 1)[-1])
+            else:
+                end = 0
+            encoded = [s.encode() for s in strings[name]]
+            offsets = end + np.cumsum([0] + [len(b) for b in encoded], dtype=np.uint64)
+            with open(self.col_path(name, 'data'), 'ab') as f:
+                f.truncate(end)
+                f.write(b''.join(encoded))
+            with open(offsets_path, 'ab') as f:
+                f.truncate(self.n_rows * 8)
+                f.write(offsets.astype('<u8').tobytes())
+        if self.path_rows is not None:
+            for i, path in enumerate(strings['path']):
+                self.path_rows[path] = self.n_rows + i
+        self.n_rows += n_new
+        self.commit()
+
+    def patch(self, name: str, rows: tp.Sequence[int], values: tp.Sequence):
+        # fixed-width columns only, written in place
+        if not len(rows):
+            return
+        column = self.map(self.col_path(name), COLUMNS[name], self.n_rows, mode='r+')
+        column[np.asarray(rows)] = values
+        column.flush()
+        self.columns.pop(name, None)
+
+    def commit(self):
+        self.meta = {'n_rows': self.n_rows, 'galleries': self.galleries, 'updated': time.time()}
+        write_atomic(os.path.join(self.index_dir, META_NAME), json.dumps(self.meta))
+        self.columns = {}
+
+    def update(
+        self,
+        paths: tp.Iterable[str],
+        sources: SourceLookup = None,
+        scores: tp.Dict[str, tp.Tuple[float, float, float]] = None,
+        cache: 'QualityCache' = None,
+        roots: tp.Sequence[str] = (),
+    ) -> tp.Dict[str, int]:
+        # new files are appended, files whose size or mtime changed are re-read in place, and
+        # indexed files under roots that this walk no longer found get flagged deleted
+        sources = sources or SourceLookup()
+        scores = scores or {}
+        path_rows = self.load_path_rows()
+        counts = {'new': 0, 'changed': 0, 'scored': 0, 'deleted': 0}
+        seen = set()
+        chunk = []
+
+        def flush(chunk: tp.List[str]):
+            hashes = [sources.get(path)[1] for path in chunk]
+            with ThreadPoolExecutor(max_workers=UPDATE_THREADS) as executor:
+                file_rows = list(executor.map(read_file_row, chunk, hashes))
+            new = {name: [] for name in COLUMNS}
+            new_strings = {name: [] for name in STRING_COLUMNS}
+            changed = []
+            for path, file_row in zip(chunk, file_rows):
+                if file_row is None:
+                    continue
+                metrics = scores.get(path)
+                if metrics is None and cache is not None:
+                    metrics = cache.get(file_row[4])
+                metrics = tuple(np.nan if m is None else m for m in (metrics or (None,) * 3))
+                values = (self.gallery_id(gallery_name(path)), *file_row, *metrics, False)
+                if path in path_rows:
+                    changed.append((path_rows[path], values))
+                    continue
+                for name, value in zip(COLUMNS, values):
+                    new[name].append(value)
+                new_strings['path'].append(path)
+                new_strings['url'].append(sources.get(path)[0] or '')
+            for i, name in enumerate(COLUMNS):
+                self.patch(name, [row for row, _ in changed], [values[i] for _, values in changed])
+            if new_strings['path']:
+                self.append(new, new_strings)
+            else:
+                self.commit()
+            counts['new'] += len(new_strings['path'])
+            counts['changed'] += len(changed)
+
+        n_bytes = self.column('n_bytes')
+        mtime_ns = self.column('mtime_ns')
+        deleted = self.column('deleted')
+        rescore_rows, rescore_values = [], []
+        for path in paths:
+            path = os.path.normpath(path)
+            seen.add(path)
+            row = path_rows.get(path)
+            if row is not None and row < len(n_bytes):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size == n_bytes[row] and stat.st_mtime_ns == mtime_ns[row] and not deleted[row]:
+                    # unchanged file, only its scores can be new
+                    if path in scores:
+                        rescore_rows.append(row)
+                        rescore_values.append(tuple(np.nan if m is None else m for m in scores[path]))
+                    continue
+            chunk.append(path)
+            if len(chunk) >= UPDATE_CHUNK:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        for i, name in enumerate(METRIC_COLUMNS):
+            self.patch(name, rescore_rows, [values[i] for values in rescore_values])
+        counts['scored'] = len(rescore_rows)
+        if roots:
+            prefixes = tuple(os.path.join(os.path.normpath(root), '') for root in roots)
+            deleted = self.column('deleted')
+            gone = [
+                row for path, row in path_rows.items()
+                if path not in seen and path.startswith(prefixes) and not deleted[row]
+            ]
+            self.patch('deleted', gone, True)
+            counts['deleted'] = len(gone)
+        self.commit()
+        return counts
+
+    def summary(self) -> str:
+        n_deleted = int(self.column('deleted').sum()) if self.n_rows else 0
+        n_scored = int((~np.isnan(self.column('brisque'))).sum()) if self.n_rows else 0
+        total_bytes = int(self.column('n_bytes').sum()) if self.n_rows else 0
+        return (
+            f'{self.n_rows - n_deleted} images ({n_deleted} deleted) in {len(self.galleries)} galleries, '
+            f'{total_bytes / 2**30:.2f}GB, {n_scored} with a brisque score'
+        )
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('index_dir', type=str)
+    args.add_argument('--update', type=str, nargs='*', default=[], help='image directories and/or paths to (re)index')
+    args.add_argument('--scores', type=str, nargs='*', default=[], help='batch_quality jsonl files')
+    args.add_argument('--cache', type=str, required=False, default=None, help='quality cache to fill in metrics from')
+    args.add_argument('--manifest', type=str, nargs='*', default=[], help='crawl manifests with the source urls')
+    args.add_argument('--where', type=str, action='append', default=[], help="e.g. 'brisque<25', 'pixels>=2e6'")
+    args.add_argument('--gallery', type=str, action='append', default=[])
+    args.add_argument('--include_deleted', action='store_true', default=False)
+    args.add_argument('--paths', action='store_true', default=False, help='print the matching paths')
+    args.add_argument('--limit', type=int, required=False, default=None)
+    args = args.parse_args()
+    index = CorpusIndex(args.index_dir)
+    if args.update:
+        scores = {}
+        for scores_path in args.scores:
+            scores.update(read_scores(scores_path))
+        cache = None
+        if args.cache:
+            from imageprep.src.quality.quality_cache import QualityCache
+            cache = QualityCache(args.cache)
+        try:
+            counts = index.update(
+                iter_image_paths(args.update),
+                SourceLookup(args.manifest),
+                scores,
+                cache,
+                roots=[path for path in args.update if os.path.isdir(path)],
+            )
+        finally:
+            if cache is not None:
+                cache.close()
+        print(', '.join(f'{n} {what}' for what, n in counts.items()), file=sys.stderr)
+    print(index.summary(), file=sys.stderr)
+    if args.where or args.gallery or args.paths:
+        start = time.perf_counter()
+        rows = index.select([parse_condition(c) for c in args.where], args.gallery, args.include_deleted)
+        print(f'{len(rows)} matching images in {(time.perf_counter() - start) * 1000:.1f}ms', file=sys.stderr)
+        if args.paths:
+            for path in index.strings('path', rows[:args.limit]):
+                print(path)
@@ -0,0 +1,285 @@
+import argparse
+import queue
+import sys
+import threading
+import time
+import typing as tp
+
+from imageprep.src.collection.session import SESSION_DIR
+from imageprep.src.utils.metrics import METRICS, add_metrics_args, enable_from_args, export_from_args
+from imageprep.src.utils.paths import iter_image_paths
+
+# collect -> size check -> quality -> export as one streaming run: every stage is a thread and the
+# stages are joined by bounded queues, so an image is scored and packed into a shard while the
+# collector is still on the next page, and a slow stage holds back the ones before it instead of
+# piling work up on disk. Heavy modules (selenium, cv2) are imported by the stages that use them.
+# example runs, a thread straight into shards, or images already on disk:
+# python -m imageprep.src.pipeline --lpsg https://www.lpsg.com/threads/drazenpn.5832241/ --output_dir data/test --shards_dir data/shards
+# python -m imageprep.src.pipeline --inputs data/test --shards_dir data/shards --scores data/test/scores.jsonl
+
+# items waiting between two stages
+QUEUE_SIZE = 256
+# the collectors' own minimum, checked again for images that come from --inputs
+MIN_PIXELS = 1024*1024
+# marks the end of a stage's output
+DONE = object()
+
+
+class PipelineStopped(Exception):
+    # raised into a source once a later stage failed, not an error of its own
+    pass
+
+
+class StreamingPipeline:
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.threads: tp.List[threading.Thread] = []
+        self.errors: tp.List[tp.Tuple[str, Exception]] = []
+        # set when a stage fails, so the ones before it stop instead of blocking on a full queue
+        self.stopped = threading.Event()
+        self.counts: tp.Dict[str, int] = {}
+
+    def put(self, name: str, out: queue.Queue, item: tp.Any) -> bool:
+        while not self.stopped.is_set():
+            try:
+                out.put(item, timeout=1.)
+            except queue.Full:
+                continue
+            self.counts[name] = self.counts.get(name, 0) + 1
+            METRICS.gauge(f'queue_{name}', out.qsize())
+            return True
+        return False
+
+    def finish(self, out: queue.Queue):
+        # DONE always gets through; once stopped nobody may be reading, so make room for it
+        while True:
+            try:
+                out.put(DONE, timeout=1.)
+                return
+            except queue.Full:
+                if self.stopped.is_set():
+                    try:
+                        out.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def consume(self, out: queue.Queue) -> tp.Iterator[tp.Any]:
+        while True:
+            item = out.get()
+            if item is DONE:
+                return
+            yield item
+
+    def start(self, name: str, run: tp.Callable[[queue.Queue], None]) -> tp.Iterator[tp.Any]:
+        out = queue.Queue(maxsize=self.queue_size)
+
+        def target():
+            try:
+                run(out)
+            except PipelineStopped:
+                pass
+            except Exception as e:
+                print(f'{name} stage failed: {e}', file=sys.stderr)
+                self.errors.append((name, e))
+                self.stopped.set()
+            finally:
+                self.finish(out)
+
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self.consume(out)
+
+    def source(self, name: str, run: tp.Callable[[tp.Callable[[tp.Any], None]], None]) -> tp.Iterator[tp.Any]:
+        # run(emit) pushes items, e.g. a collector's on_saved callback; emit blocks while the queue is full
+        def emit_all(out: queue.Queue):
+            def emit(item: tp.Any):
+                if not self.put(name, out, item):
+                    raise PipelineStopped()
+            run(emit)
+
+        return self.start(name, emit_all)
+
+    def stage(
+        self,
+        name: str,
+        fn: tp.Callable[[tp.Iterator[tp.Any]], tp.Iterable[tp.Any]],
+        items: tp.Iterator[tp.Any],
+    ) -> tp.Iterator[tp.Any]:
+        # fn maps the previous stage's items to this stage's, lazily
+        def run(out: queue.Queue):
+            for item in fn(items):
+                if not self.put(name, out, item):
+                    return
+
+        return self.start(name, run)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+def collect(
+    emit: tp.Callable[[str], None],
+    output_dir: str,
+    lpsg_urls: tp.Sequence[str] = (),
+    adonis_urls: tp.Sequence[str] = (),
+    inputs: tp.Sequence[str] = (),
+    fetch_mode: str = 'browser',
+    session_dir: str = SESSION_DIR,
+    stopped: threading.Event = None,
+):
+    # images already on disk go first, then one gallery after the other on a shared browser per site;
+    # stopped is checked between galleries, a failed later stage ends the crawl at the next one
+    stopped = stopped or threading.Event()
+    if inputs:
+        for path in iter_image_paths(inputs):
+            emit(path)
+    if lpsg_urls:
+        from imageprep.src.collection.lpsg import LPSG, lpsg_session
+        with lpsg_session(session_dir) as session:
+            for url in lpsg_urls:
+                if stopped.is_set():
+                    return
+                lpsg = LPSG(thread_url=url, top_dir=output_dir, fetch_mode=fetch_mode, session=session, on_saved=emit)
+                try:
+                    lpsg.run()
+                except PipelineStopped:
+                    lpsg.cleanup()
+                    raise
+                except Exception as e:
+                    print(f'failed to collect {url}: {e}')
+                    lpsg.cleanup()
+    if adonis_urls:
+        from imageprep.src.collection.adonismale import adonis_session, process_gallery_url
+        with adonis_session(session_dir) as session:
+            for url in adonis_urls:
+                if stopped.is_set():
+                    return
+                process_gallery_url(url, output_dir, fetch_mode=fetch_mode, session=session, on_saved=emit)
+
+
+def size_check(paths: tp.Iterator[str], min_pixels: int = MIN_PIXELS) -> tp.Iterator[str]:
+    # header only, anything the collectors kept passes again without a decode
+    from imageprep.src.quality.cv_quality import read_image_size
+    for path in paths:
+        size = read_image_size(path)
+        if size is not None and size[0] * size[1] >= min_pixels:
+            yield path
+        else:
+            METRICS.count('pipeline_too_small')
+
+
+def run_pipeline(
+    output_dir: str,
+    shards_dir: str,
+    lpsg_urls: tp.Sequence[str] = (),
+    adonis_urls: tp.Sequence[str] = (),
+    inputs: tp.Sequence[str] = (),
+    scores_path: str = None,
+    queue_size: int = QUEUE_SIZE,
+    min_pixels: int = MIN_PIXELS,
+    n_workers: int = None,
+    cascade: bool = False,
+    thresholds: tp.Dict[str, float] = None,
+    fetch_mode: str = 'browser',
+    session_dir: str = SESSION_DIR,
+    jpeg_quality_threshold: float = None,
+) -> tp.Tuple[StreamingPipeline, tp.Dict[str, int]]:
+    from imageprep.src.export.shards import ShardWriter, SourceLookup, export_results
+    from imageprep.src.quality.batch_quality import BatchQuality, ResultWriter
+
+    pipeline = StreamingPipeline(queue_size)
+    batch = BatchQuality(
+        n_workers=n_workers, cascade=cascade, thresholds=thresholds, jpeg_quality_threshold=jpeg_quality_threshold
+    )
+    paths = pipeline.source(
+        'collect',
+        lambda emit: collect(emit, output_dir, lpsg_urls, adonis_urls, inputs, fetch_mode, session_dir, pipeline.stopped),
+    )
+    paths = pipeline.stage('size_check', lambda items: size_check(items, min_pixels), paths)
+    results = pipeline.stage('quality', batch.score, paths)
+    counts = {'scored': 0, 'good': 0, 'errors': 0}
+    scores_f = open(scores_path, 'a') if scores_path else None
+    scores_writer = ResultWriter(scores_f) if scores_f is not None else None
+    try:
+        # export runs on this thread, the end of the chain
+        with ShardWriter(shards_dir) as writer:
+            for result in export_results(results, writer, SourceLookup()):
+                if scores_writer is not None:
+                    scores_writer.write(result)
+                counts['scored'] += 1
+                counts['good'] += int(result['quality'])
+                counts['errors'] += int(result['error'] is not None)
+            counts['exported'] = writer.n_written
+    except BaseException:
+        pipeline.stopped.set()
+        raise
+    finally:
+        if scores_f is not None:
+            scores_f.close()
+    pipeline.join()
+    return pipeline, counts
+
+
+if __name__ == '__main__':
+    from imageprep.src.quality.cv_quality import (
+        BRIGHTNESS_THRESHOLD, BRISQUE_THRESHOLD, DARKNESS_THRESHOLD, SHARPNESS_THRESHOLD
+    )
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--lpsg', type=str, nargs='*', default=[], help='thread urls')
+    args.add_argument('--adonis', type=str, nargs='*', default=[], help='gallery urls')
+    args.add_argument('--inputs', type=str, nargs='*', default=[], help='image directories and/or paths already on disk')
+    args.add_argument('--output_dir', type=str, default='data/test', help='where the collectors save galleries')
+    args.add_argument('--shards_dir', type=str, required=True)
+    args.add_argument('--scores', type=str, required=False, default=None, help='also append every result to this jsonl')
+    args.add_argument('--queue_size', type=int, default=QUEUE_SIZE)
+    args.add_argument('--min_pixels', type=int, default=MIN_PIXELS)
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--cascade', action='store_true', default=False, help='skip later checks once one fails')
+    args.add_argument('--sharpness_threshold', type=float, default=SHARPNESS_THRESHOLD)
+    args.add_argument('--brightness_threshold', type=float, default=BRIGHTNESS_THRESHOLD)
+    args.add_argument('--darkness_threshold', type=float, default=DARKNESS_THRESHOLD)
+    args.add_argument('--brisque_threshold', type=float, default=BRISQUE_THRESHOLD)
+    args.add_argument('--jpeg_quality_threshold', type=float, required=False, default=None,
+                      help='reject JPEGs saved below this quality (e.g. 60) from their header, undecoded')
+    args.add_argument('--fetch_mode', type=str, choices=['browser', 'http'], default='browser')
+    args.add_argument('--session_dir', type=str, default=SESSION_DIR)
+    add_metrics_args(args)
+    args = args.parse_args()
+    enable_from_args(args)
+    if not (args.lpsg or args.adonis or args.inputs):
+        raise SystemExit('nothing to collect, give --lpsg, --adonis or --inputs')
+    start = time.time()
+    pipeline, counts = run_pipeline(
+        output_dir=args.output_dir,
+        shards_dir=args.shards_dir,
+        lpsg_urls=args.lpsg,
+        adonis_urls=args.adonis,
+        inputs=args.inputs,
+        scores_path=args.scores,
+        queue_size=args.queue_size,
+        min_pixels=args.min_pixels,
+        n_workers=args.workers,
+        cascade=args.cascade,
+        thresholds={
+            'sharpness_threshold': args.sharpness_threshold,
+            'brightness_threshold': args.brightness_threshold,
+            'darkness_threshold': args.darkness_threshold,
+            'brisque_threshold': args.brisque_threshold,
+        },
+        fetch_mode=args.fetch_mode,
+        session_dir=args.session_dir,
+        jpeg_quality_threshold=args.jpeg_quality_threshold,
+    )
+    print(
+        f"{pipeline.counts.get('collect', 0)} collected, {pipeline.counts.get('size_check', 0)} large enough, "
+        f"{counts['good']}/{counts['scored']} good ({counts['errors']} errors), {counts['exported']} exported "
+        f"in {time.time() - start:.0f}s"
+    )
+    for name, error in pipeline.errors:
+        print(f'{name} failed: {error}')
+    export_from_args(args)
+    if pipeline.errors:
+        raise SystemExit(1)
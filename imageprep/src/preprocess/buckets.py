@@ -0,0 +1,232 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+import typing as tp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+import tqdm
+
+from imageprep.src.quality.cv_quality import REDUCED_READ_FLAGS, read_oriented_size
+from imageprep.src.utils.paths import iter_image_paths, path_digest, read_path_list
+
+# aspect-ratio bucketing for training output: every accepted image goes to the bucket whose aspect
+# ratio is closest to its own, is scaled to cover it with area interpolation and center cropped.
+# Images are spread over a process pool with a bounded number in flight, big JPEGs are decoded
+# at reduced size, and each result is written (and logged to buckets.jsonl) as soon as it is done.
+# example run, the images batch_quality accepted into sdxl buckets:
+# python -m imageprep.src.preprocess.buckets --scores data/test/scores.jsonl --output_dir data/test/buckets --resolutions sdxl
+
+# (width, height) sets, all close to the same pixel count
+RESOLUTION_SETS = {
+    'sdxl': [
+        (1024, 1024), (1152, 896), (896, 1152), (1216, 832), (832, 1216),
+        (1344, 768), (768, 1344), (1536, 640), (640, 1536),
+    ],
+    'sd15': [
+        (512, 512), (576, 448), (448, 576), (640, 384), (384, 640), (768, 320), (320, 768),
+    ],
+}
+OUTPUT_FORMATS = {
+    'jpg': [cv2.IMWRITE_JPEG_QUALITY, 95],
+    'png': [cv2.IMWRITE_PNG_COMPRESSION, 3],
+    'webp': [cv2.IMWRITE_WEBP_QUALITY, 95],
+}
+MANIFEST_NAME = 'buckets.jsonl'
+# images smaller than this fraction of their bucket (per side) are upscaled too much to be useful
+MIN_SCALE = .5
+
+
+def make_buckets(side: int, step: int = 64, max_ratio: float = 2.) -> tp.List[tp.Tuple[int, int]]:
+    # every (w, h) on the step grid with about side*side pixels and w/h within max_ratio
+    buckets = []
+    w = step
+    while w <= side * max_ratio:
+        h = int(side * side / w) // step * step
+        if h >= step and 1 / max_ratio <= w / h <= max_ratio:
+            buckets.append((w, h))
+        w += step
+    return buckets
+
+
+def parse_resolutions(spec: str) -> tp.List[tp.Tuple[int, int]]:
+    # a named set, 'auto:<side>' or '1024x1024,1152x896,...'
+    if spec in RESOLUTION_SETS:
+        return RESOLUTION_SETS[spec]
+    if spec.startswith('auto:'):
+        return make_buckets(int(spec.split(':')[1]))
+    return [tuple(int(v) for v in r.split('x')) for r in spec.split(',')]
+
+
+def assign_bucket(w: int, h: int, buckets: tp.Sequence[tp.Tuple[int, int]]) -> tp.Tuple[int, int]:
+    # nearest in log aspect ratio, so 2:1 and 1:2 are equally far from 1:1
+    ratio = math.log(w / h)
+    return min(buckets, key=lambda b: abs(math.log(b[0] / b[1]) - ratio))
+
+
+def reduced_factor(w: int, h: int, bucket: tp.Tuple[int, int]) -> int:
+    # largest libjpeg DCT scale that still covers the bucket, so a 6000px photo is never decoded whole.
+    # Compared long side to long side, the header size is from before the EXIF rotation
+    long_side, short_side = max(w, h), min(w, h)
+    bucket_long, bucket_short = max(bucket), min(bucket)
+    factor = 1
+    while factor < 8 and long_side // (factor * 2) >= bucket_long and short_side // (factor * 2) >= bucket_short:
+        factor *= 2
+    return factor
+
+
+def resize_to_bucket(img: np.ndarray, bucket: tp.Tuple[int, int]) -> np.ndarray:
+    # scale to cover the bucket, then center crop the overflow
+    h, w = img.shape[:2]
+    bw, bh = bucket
+    scale = max(bw / w, bh / h)
+    new_w = max(bw, round(w * scale))
+    new_h = max(bh, round(h * scale))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    img = cv2.resize(img, (new_w, new_h), interpolation=interpolation)
+    x = (new_w - bw) // 2
+    y = (new_h - bh) // 2
+    return img[y:y + bh, x:x + bw]
+
+
+def output_name(img_path: str) -> str:
+    # {gallery}_{index}_{digest}: collectors name files by index inside {gallery}/imgs/, so the index
+    # alone collides, and so can gallery names from different sites or top dirs; the path digest
+    # keeps two inputs from ever sharing an output (which the rerun check would take as done)
+    parts = os.path.normpath(img_path).split(os.sep)
+    stem = os.path.splitext(parts[-1])[0]
+    dirs = [p for p in parts[:-1] if p not in ('imgs', '')]
+    name = f'{dirs[-1]}_{stem}' if dirs else stem
+    return f'{name}_{path_digest(img_path)}'
+
+
+def too_small(w: int, h: int, bucket: tp.Tuple[int, int], min_scale: float) -> bool:
+    return max(bucket[0] / w, bucket[1] / h) > 1 / min_scale
+
+
+def process_image(
+    img_path: str,
+    output_dir: str,
+    buckets: tp.Sequence[tp.Tuple[int, int]],
+    fmt: str,
+    min_scale: float,
+) -> dict:
+    # runs in a worker; only this small dict travels back, never pixels
+    result = {'path': img_path, 'bucket': None, 'output': None, 'error': None}
+    try:
+        # as imread will return it, EXIF rotation applied, so a rotated photo is checked against
+        # (and found in on reruns) its real bucket without a decode
+        size = read_oriented_size(img_path)
+        if size is None:
+            raise ValueError('unreadable header')
+        w, h = size
+        bucket = assign_bucket(w, h, buckets)
+        result['bucket'] = f'{bucket[0]}x{bucket[1]}'
+        if too_small(w, h, bucket, min_scale):
+            result['error'] = 'too small for its bucket'
+            return result
+        out_path = os.path.join(output_dir, result['bucket'], f'{output_name(img_path)}.{fmt}')
+        if not os.path.exists(out_path):
+            img = cv2.imread(img_path, REDUCED_READ_FLAGS[reduced_factor(w, h, bucket)])
+            if img is None:
+                raise ValueError('could not decode image')
+            # an orientation the header didn't tell (EXIF PIL couldn't read), the decode wins
+            if (img.shape[1] > img.shape[0]) != (w > h):
+                w, h = h, w
+                bucket = assign_bucket(w, h, buckets)
+                result['bucket'] = f'{bucket[0]}x{bucket[1]}'
+                if too_small(w, h, bucket, min_scale):
+                    result['error'] = 'too small for its bucket'
+                    return result
+                out_path = os.path.join(output_dir, result['bucket'], f'{output_name(img_path)}.{fmt}')
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            # temp name then rename, a killed run never leaves a truncated output that looks done
+            part_path = out_path + '.part.' + fmt
+            if not cv2.imwrite(part_path, resize_to_bucket(img, bucket), OUTPUT_FORMATS[fmt]):
+                raise ValueError('could not encode output')
+            os.replace(part_path, out_path)
+        result['output'] = out_path
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def _init_worker():
+    # the pool already uses every core
+    cv2.setNumThreads(1)
+
+
+def iter_accepted(scores_path: str) -> tp.Iterator[str]:
+    # paths batch_quality marked as good
+    with open(scores_path, 'r') as f:
+        for line in f:
+            row = json.loads(line)
+            if row.get('quality'):
+                yield row['path']
+
+
+def bucket_images(
+    paths: tp.Iterable[str],
+    output_dir: str,
+    buckets: tp.Sequence[tp.Tuple[int, int]],
+    fmt: str = 'jpg',
+    n_workers: int = None,
+    max_in_flight: int = None,
+    min_scale: float = MIN_SCALE,
+) -> tp.Iterator[dict]:
+    # results in completion order; at most max_in_flight images are decoded or queued at once
+    n_workers = n_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or n_workers * 2
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
+        in_flight = set()
+        for path in paths:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            in_flight.add(executor.submit(process_image, path, output_dir, buckets, fmt, min_scale))
+        for future in in_flight:
+            yield future.result()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='*', help='image directories and/or image paths')
+    args.add_argument('--scores', type=str, required=False, default=None, help='batch_quality jsonl, only good images are used')
+    args.add_argument('--path_list', type=str, required=False, default=None, help='text file with one image path per line')
+    args.add_argument('--output_dir', type=str, required=True)
+    args.add_argument('--resolutions', type=str, default='sdxl', help=f"{', '.join(RESOLUTION_SETS)}, auto:<side> or WxH,WxH,...")
+    args.add_argument('--format', type=str, choices=list(OUTPUT_FORMATS), default='jpg')
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--max_in_flight', type=int, required=False, default=None)
+    args.add_argument('--min_scale', type=float, default=MIN_SCALE)
+    args = args.parse_args()
+    inputs = iter_image_paths(args.inputs)
+    if args.path_list:
+        inputs = itertools.chain(inputs, iter_image_paths(read_path_list(args.path_list)))
+    if args.scores:
+        inputs = itertools.chain(inputs, iter_accepted(args.scores))
+    buckets = parse_resolutions(args.resolutions)
+    os.makedirs(args.output_dir, exist_ok=True)
+    counts = {}
+    n_errors = 0
+    # appended per image, so an interrupted run keeps its log and reruns skip finished outputs
+    with open(os.path.join(args.output_dir, MANIFEST_NAME), 'a') as manifest:
+        for result in tqdm.tqdm(
+            bucket_images(inputs, args.output_dir, buckets, args.format, args.workers, args.max_in_flight, args.min_scale),
+            unit='img',
+            file=sys.stderr,
+        ):
+            manifest.write(json.dumps(result) + '\n')
+            manifest.flush()
+            if result['error'] is None:
+                counts[result['bucket']] = counts.get(result['bucket'], 0) + 1
+            else:
+                n_errors += 1
+    for bucket, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+        print(f'{bucket}: {n}')
+    print(f'{sum(counts.values())} images bucketed, {n_errors} skipped or failed')
@@ -0,0 +1,364 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import typing as tp
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import cv2
+import tqdm
+
+from imageprep.src.quality.cv_quality import (
+    BRIGHTNESS_THRESHOLD,
+    BRISQUE_THRESHOLD,
+    CASCADE_STAGES,
+    DARKNESS_THRESHOLD,
+    PRESCREEN_STAGE,
+    SHARPNESS_THRESHOLD,
+    CascadeStats,
+    CVQuality,
+    estimate_peak_bytes,
+    is_good_quality,
+    stats_stages,
+)
+from imageprep.src.quality.jpeg_prescreen import parse_jpeg_header, passes_prescreen, read_head
+from imageprep.src.quality.quality_cache import QualityCache, scoring_profile
+from imageprep.src.utils.metrics import METRICS, add_metrics_args, enable_from_args, export_from_args
+from imageprep.src.utils.paths import iter_image_paths, read_path_list
+
+# example run:
+# python -m imageprep.src.quality.batch_quality data/test/drazenpn.5832241/imgs --output data/test/scores.jsonl --workers 8
+
+RESULT_FIELDS = ['path', 'sharpness', 'brightness', 'brisque', 'quality', 'error']
+
+# one CVQuality (and so one QualityBRISQUE) per process worker, or per thread
+_process_cvq = None
+_thread_local = threading.local()
+
+
+def _init_process_worker(cvq_kwargs: dict):
+    global _process_cvq
+    # the pool already uses every core, don't let each worker spawn its own OpenCV threads
+    cv2.setNumThreads(1)
+    # a forked copy of the parent's registry would never be exported; stage times come back with each result
+    METRICS.enabled = False
+    _process_cvq = CVQuality(**cvq_kwargs)
+
+
+def _init_thread_worker(cvq_kwargs: dict):
+    _thread_local.cvq = CVQuality(**cvq_kwargs)
+
+
+def _get_cvq() -> CVQuality:
+    if _process_cvq is not None:
+        return _process_cvq
+    return _thread_local.cvq
+
+
+def score_path(img_path: str) -> dict:
+    # workers only return raw metrics, thresholds are applied by the parent;
+    # in cascade mode metrics of skipped stages are None
+    cvq = _get_cvq()
+    result = {'path': img_path, 'metrics': None, 'error': None, 'stage_times': None, 'rejected_stage': None}
+    try:
+        if cvq.cascade:
+            sharpness, brightness, brisque, _ = cvq.calculate_quality_cascade(img_path)
+            result['rejected_stage'] = cvq.last_rejected_stage
+        else:
+            sharpness, brightness, brisque = cvq.calculate_metrics(img_path)
+        result['stage_times'] = cvq.last_stage_times
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    result['metrics'] = tuple(None if m is None else float(m) for m in (sharpness, brightness, brisque))
+    return result
+
+
+class BatchQuality:
+    def __init__(
+        self,
+        n_workers: int = None,
+        use_threads: bool = False,
+        max_in_flight: int = None,
+        cache: QualityCache = None,
+        thresholds: tp.Dict[str, float] = None,
+        cascade: bool = False,
+        stage_order: tp.Sequence[str] = CASCADE_STAGES,
+        adaptive: bool = False,
+        brisque_backend: str = 'opencv',
+        max_pixels: int = None,
+        jpeg_quality_threshold: float = None,
+    ):
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.use_threads = use_threads
+        # bounds memory: at most this many paths are submitted but not yet yielded
+        self.max_in_flight = max_in_flight or self.n_workers * 4
+        # a hit must have been scored the way the workers would score it now
+        if cache is not None and cache.profile != scoring_profile(max_pixels, brisque_backend=brisque_backend):
+            raise ValueError(
+                f"cache profile {cache.profile} doesn't match max_pixels={max_pixels}, brisque_backend={brisque_backend}"
+            )
+        self.cache = cache
+        self.thresholds = thresholds or {}
+        self.n_cache_hits = 0
+        self.jpeg_quality_threshold = jpeg_quality_threshold
+        # workers must reject with the same thresholds the parent applies
+        self.cvq_kwargs = dict(
+            self.thresholds,
+            cascade=cascade,
+            stage_order=tuple(stage_order),
+            adaptive=adaptive,
+            brisque_backend=brisque_backend,
+            max_pixels=max_pixels,
+            jpeg_quality_threshold=jpeg_quality_threshold,
+        )
+        self.cascade_stats = CascadeStats(stats_stages(jpeg_quality_threshold)) if cascade else None
+
+    def make_executor(self) -> Executor:
+        if self.use_threads:
+            return ThreadPoolExecutor(
+                max_workers=self.n_workers,
+                initializer=_init_thread_worker,
+                initargs=(self.cvq_kwargs,)
+            )
+        return ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            initializer=_init_process_worker,
+            initargs=(self.cvq_kwargs,)
+        )
+
+    def make_result(self, img_path: str, metrics: tp.Optional[tp.Tuple[float, float, float]], error: tp.Optional[str]) -> dict:
+        if metrics is None:
+            return {
+                'path': img_path,
+                'sharpness': None,
+                'brightness': None,
+                'brisque': None,
+                'quality': False,
+                'error': error,
+            }
+        sharpness, brightness, brisque = metrics
+        # a skipped cascade stage means an earlier one already rejected the image
+        complete = None not in metrics
+        return {
+            'path': img_path,
+            'sharpness': sharpness,
+            'brightness': brightness,
+            'brisque': brisque,
+            'quality': complete and bool(is_good_quality(sharpness, brightness, brisque, **self.thresholds)),
+            'error': None,
+        }
+
+    def finish(self, future: Future, content_hash: tp.Optional[str]) -> dict:
+        result = future.result()
+        metrics = result['metrics']
+        if self.cascade_stats is not None and result['stage_times'] is not None:
+            self.cascade_stats.record(result['stage_times'], result['rejected_stage'])
+        if not self.use_threads and result['stage_times'] is not None:
+            # thread workers already recorded into this process's METRICS
+            for stage, seconds in result['stage_times'].items():
+                METRICS.observe(f'quality_{stage}', seconds)
+        # partial cascade results can't answer queries under other thresholds, don't cache them
+        if self.cache is not None and content_hash is not None and metrics is not None and None not in metrics:
+            self.cache.put(content_hash, *metrics)
+        return self.make_result(result['path'], metrics, result['error'])
+
+    def lookup(self, img_path: str) -> tp.Tuple[tp.Optional[str], tp.Optional[tp.Tuple[float, float, float]]]:
+        if self.cache is None:
+            return None, None
+        try:
+            content_hash = self.cache.content_key(img_path)
+        except OSError:
+            # let the worker report the missing/unreadable file
+            return None, None
+        return content_hash, self.cache.get(content_hash)
+
+    def prescreen(self, img_path: str) -> bool:
+        # with a cache the JPEG pre-screen runs here, ahead of the lookup: cached metrics were scored
+        # without it (or under another threshold) and would let a rejected file through. Without a
+        # cache the workers run it
+        if self.jpeg_quality_threshold is None or self.cache is None:
+            return True
+        start = time.time()
+        try:
+            passed = passes_prescreen(parse_jpeg_header(read_head(img_path)), self.jpeg_quality_threshold)
+        except OSError:
+            # let the worker report the missing/unreadable file
+            return True
+        if not passed:
+            # only rejects are counted here, a file that passes is screened and counted again by its worker
+            seconds = time.time() - start
+            METRICS.observe(f'quality_{PRESCREEN_STAGE}', seconds)
+            if self.cascade_stats is not None:
+                self.cascade_stats.record({PRESCREEN_STAGE: seconds}, PRESCREEN_STAGE)
+        return passed
+
+    def score(self, paths: tp.Iterable[str]) -> tp.Iterator[dict]:
+        # results are yielded in completion order, not input order;
+        # the cache is only touched from this (parent) thread
+        with self.make_executor() as executor:
+            in_flight = {}
+            for path in paths:
+                if not self.prescreen(path):
+                    # what a worker returns for a file the pre-screen rejected
+                    yield self.make_result(path, (None, None, None), None)
+                    continue
+                content_hash, cached = self.lookup(path)
+                if cached is not None:
+                    self.n_cache_hits += 1
+                    METRICS.count('quality_cache_hits')
+                    yield self.make_result(path, cached, None)
+                    continue
+                if len(in_flight) >= self.max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self.finish(future, in_flight.pop(future))
+                in_flight[executor.submit(score_path, path)] = content_hash
+                METRICS.gauge('quality_in_flight', len(in_flight))
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self.finish(future, in_flight.pop(future))
+
+
+class ResultWriter:
+    def __init__(self, f: tp.TextIO, fmt: str = 'jsonl'):
+        if fmt not in ['jsonl', 'csv']:
+            raise ValueError(f'unknown output format: {fmt}')
+        self.f = f
+        self.fmt = fmt
+        self.csv_writer = None
+        if fmt == 'csv':
+            self.csv_writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            self.csv_writer.writeheader()
+
+    def write(self, result: dict):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(result)
+        else:
+            self.f.write(json.dumps(result) + '\n')
+        # flush per row so partial results survive an interrupted run
+        self.f.flush()
+
+
+def run_batch(
+    inputs: tp.Iterable[str],
+    output_f: tp.TextIO,
+    fmt: str = 'jsonl',
+    n_workers: int = None,
+    use_threads: bool = False,
+    max_in_flight: int = None,
+    cache: QualityCache = None,
+    thresholds: tp.Dict[str, float] = None,
+    cascade: bool = False,
+    stage_order: tp.Sequence[str] = CASCADE_STAGES,
+    adaptive: bool = False,
+    brisque_backend: str = 'opencv',
+    max_pixels: int = None,
+    jpeg_quality_threshold: float = None,
+) -> tp.Tuple[int, int, int]:
+    batch = BatchQuality(
+        n_workers=n_workers,
+        use_threads=use_threads,
+        max_in_flight=max_in_flight,
+        cache=cache,
+        thresholds=thresholds,
+        cascade=cascade,
+        stage_order=stage_order,
+        adaptive=adaptive,
+        brisque_backend=brisque_backend,
+        max_pixels=max_pixels,
+        jpeg_quality_threshold=jpeg_quality_threshold,
+    )
+    writer = ResultWriter(output_f, fmt=fmt)
+    n_total, n_good, n_errors = 0, 0, 0
+    for result in tqdm.tqdm(batch.score(inputs), unit='img', file=sys.stderr):
+        writer.write(result)
+        n_total += 1
+        n_good += int(result['quality'])
+        n_errors += int(result['error'] is not None)
+        METRICS.count('images_scored', outcome='error' if result['error'] else 'good' if result['quality'] else 'rejected')
+    if batch.cascade_stats is not None:
+        print(batch.cascade_stats.summary(), file=sys.stderr)
+    return n_total, n_good, n_errors
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='*', help='image directories and/or image paths')
+    args.add_argument('--path_list', type=str, required=False, default=None, help='text file with one image path per line')
+    args.add_argument('--output', type=str, required=False, default=None, help='defaults to stdout')
+    args.add_argument('--format', type=str, choices=['jsonl', 'csv'], default='jsonl')
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--threads', action='store_true', default=False, help='thread pool instead of process pool')
+    args.add_argument('--max_in_flight', type=int, required=False, default=None)
+    args.add_argument('--cache', type=str, required=False, default=None, help='sqlite quality cache path')
+    args.add_argument('--cache_max_entries', type=int, required=False, default=None)
+    args.add_argument('--sharpness_threshold', type=float, default=SHARPNESS_THRESHOLD)
+    args.add_argument('--brightness_threshold', type=float, default=BRIGHTNESS_THRESHOLD)
+    args.add_argument('--darkness_threshold', type=float, default=DARKNESS_THRESHOLD)
+    args.add_argument('--brisque_threshold', type=float, default=BRISQUE_THRESHOLD)
+    args.add_argument('--cascade', action='store_true', default=False, help='skip later checks once one fails')
+    args.add_argument('--stage_order', type=str, default=','.join(CASCADE_STAGES))
+    args.add_argument('--adaptive', action='store_true', default=False, help='reorder cascade stages by cost and reject rate')
+    args.add_argument('--brisque_backend', type=str, choices=['opencv', 'numpy'], default='opencv')
+    args.add_argument('--max_pixels', type=int, required=False, default=None,
+                      help='decode budget per image, never below the 1MP reference metrics are reported at')
+    args.add_argument('--jpeg_quality_threshold', type=float, required=False, default=None,
+                      help='reject JPEGs saved below this quality (e.g. 60) from their header, undecoded')
+    # --profile_stages (e.g. quality_brisque) only sees thread workers, use it with --threads
+    add_metrics_args(args)
+    args = args.parse_args()
+    enable_from_args(args)
+    if not args.inputs and not args.path_list:
+        raise SystemExit('no inputs given')
+    inputs = iter_image_paths(args.inputs)
+    if args.path_list:
+        inputs = itertools.chain(inputs, iter_image_paths(read_path_list(args.path_list)))
+    if args.output:
+        output_f = open(args.output, 'w', newline='')
+    else:
+        output_f = sys.stdout
+    if args.max_pixels:
+        print(
+            f'decode budget {args.max_pixels} px, expected peak ~{estimate_peak_bytes(args.max_pixels) / 2**20:.0f}MB per worker',
+            file=sys.stderr
+        )
+    cache = None
+    if args.cache:
+        profile = scoring_profile(args.max_pixels, brisque_backend=args.brisque_backend)
+        cache = QualityCache(args.cache, max_entries=args.cache_max_entries, profile=profile)
+    thresholds = {
+        'sharpness_threshold': args.sharpness_threshold,
+        'brightness_threshold': args.brightness_threshold,
+        'darkness_threshold': args.darkness_threshold,
+        'brisque_threshold': args.brisque_threshold,
+    }
+    try:
+        n_total, n_good, n_errors = run_batch(
+            inputs,
+            output_f,
+            fmt=args.format,
+            n_workers=args.workers,
+            use_threads=args.threads,
+            max_in_flight=args.max_in_flight,
+            cache=cache,
+            thresholds=thresholds,
+            cascade=args.cascade,
+            stage_order=args.stage_order.split(','),
+            adaptive=args.adaptive,
+            brisque_backend=args.brisque_backend,
+            max_pixels=args.max_pixels,
+            jpeg_quality_threshold=args.jpeg_quality_threshold,
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+        if output_f is not sys.stdout:
+            output_f.close()
+    print(f'scored {n_total} images: {n_good} good, {n_errors} errors', file=sys.stderr)
+    export_from_args(args)
@@ -0,0 +1,186 @@
+import math
+import typing as tp
+
+import cv2
+import cv2.typing
+import numpy as np
+
+from imageprep.src.quality.cv_quality import BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH
+
+# NumPy port of opencv_contrib's qualitybrisque.cpp that loads the model once
+# (filters still go through cv2, fits and the SVM are vectorized).
+# Scores match cv2.quality.QualityBRISQUE within BRISQUE_TOLERANCE. Typical differences are
+# below 0.01; on heavily blocked JPEGs the flat 8x8 blocks give MSCN coefficients at +-1 ulp of
+# zero whose sign can differ from the C++ path, which moves the score by up to ~0.4.
+BRISQUE_TOLERANCE = 0.5
+# the same gamma grid OpenCV walks in AGGDfit: 0.2, 0.201, ... < 10
+GAMMA_START = 0.2
+GAMMA_STOP = 10.
+GAMMA_STEP = 0.001
+# upper bound on pixels per AGGD row tile, keeps the working set small enough to stay in cache
+TILE_PIXELS = 128*1024
+# pair-wise product orientations (H, V, D1, D2) as (row, col) shifts
+SHIFTS = ((0, 1), (1, 0), (1, 1), (-1, 1))
+
+
+def _gamma_grid() -> np.ndarray:
+    # accumulate the step like the C++ loop does so grid values match bit for bit
+    grid = []
+    gam = GAMMA_START
+    while gam < GAMMA_STOP:
+        grid.append(gam)
+        gam += GAMMA_STEP
+    return np.array(grid)
+
+
+class GammaLUT:
+    def __init__(self):
+        self.grid = _gamma_grid()
+        self.gamma_1 = np.array([math.gamma(1 / g) for g in self.grid])
+        self.gamma_2 = np.array([math.gamma(2 / g) for g in self.grid])
+        self.gamma_3 = np.array([math.gamma(3 / g) for g in self.grid])
+        # r(gamma) is strictly increasing on the grid, so the solve becomes a sorted lookup
+        self.r_gam = self.gamma_2 * self.gamma_2 / (self.gamma_1 * self.gamma_3)
+
+    def solve(self, rhatnorm: np.ndarray) -> np.ndarray:
+        # OpenCV walks the grid until |r_gam - rhatnorm| starts growing; on a monotonic grid that is
+        # the nearer of the two neighbours of rhatnorm, preferring the later one on ties
+        idx = np.searchsorted(self.r_gam, rhatnorm)
+        hi = np.clip(idx, 0, len(self.grid) - 1)
+        lo = np.clip(idx - 1, 0, len(self.grid) - 1)
+        diff_hi = np.abs(self.r_gam[hi] - rhatnorm)
+        diff_lo = np.abs(self.r_gam[lo] - rhatnorm)
+        idx = np.where(diff_hi <= diff_lo, hi, lo)
+        # NaN fits (flat images) fall back to the first grid point like the C++ loop
+        return np.where(np.isnan(rhatnorm), 0, idx)
+
+
+def aggd_sums(x: np.ndarray) -> np.ndarray:
+    # x is (H, W) float32; returns (5,) float64 sums (pos sq, neg sq, abs, pos count, neg count).
+    # The sums are additive, so a large image can be fed in row tiles that stay in cache.
+    x = x.reshape(-1)
+    pos = np.maximum(x, 0)
+    neg = np.minimum(x, 0)
+    # square and accumulate in float64 like the C++ loop, without materialising float64 copies
+    return np.array([
+        np.dot(pos.astype(np.float64), pos),
+        np.dot(neg.astype(np.float64), neg),
+        pos.sum(dtype=np.float64) - neg.sum(dtype=np.float64),
+        np.count_nonzero(pos),
+        np.count_nonzero(neg),
+    ])
+
+
+def aggd_fit(
+    sums: np.ndarray,
+    total_count: int,
+    lut: GammaLUT
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # returns (gamma grid index, left sigma, right sigma), same math as OpenCV's AGGDfit
+    possqsum, negsqsum, abssum, poscount, negcount = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lsigma = np.sqrt(negsqsum / negcount)
+        rsigma = np.sqrt(possqsum / poscount)
+        gammahat = lsigma / rsigma
+        rhat = (abssum / total_count) ** 2 / ((negsqsum + possqsum) / total_count)
+        rhatnorm = rhat * (gammahat ** 3 + 1) * (gammahat + 1) / (gammahat ** 2 + 1) ** 2
+    return lut.solve(rhatnorm), lsigma, rsigma
+
+
+def _blur(x: np.ndarray) -> np.ndarray:
+    return cv2.GaussianBlur(x, (7, 7), 7. / 6., sigmaY=0., borderType=cv2.BORDER_REPLICATE)
+
+
+def mscn(gray: np.ndarray) -> np.ndarray:
+    # gray is (H, W) float32 in [0, 1]; returns MSCN coefficients as (H, W)
+    mu = _blur(gray)
+    sigma = _blur(gray * gray)
+    sigma -= mu * mu
+    # cv::pow with a non-integer exponent works on absolute values
+    np.abs(sigma, out=sigma)
+    np.sqrt(sigma, out=sigma)
+    sigma += np.float32(1. / 255)
+    structdis = gray - mu
+    structdis /= sigma
+    return structdis
+
+
+def to_gray_float(image: cv2.typing.MatLike) -> np.ndarray:
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    elif image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+    elif image.ndim != 2:
+        raise ValueError(f'unsupported image shape {image.shape}')
+    return image.astype(np.float32) * np.float32(1. / 255)
+
+
+class NumpyBRISQUE:
+    def __init__(self, model_path: str = BRISQUE_MODEL_PATH, range_path: str = BRISQUE_RANGE_PATH):
+        svm = cv2.ml.SVM_load(model_path)
+        if svm.getKernelType() != cv2.ml.SVM_RBF:
+            raise ValueError(f'only RBF BRISQUE models are supported: {model_path}')
+        rho, alpha, sv_idx = svm.getDecisionFunction(0)
+        support_vectors = svm.getSupportVectors().astype(np.float64)
+        self.support_vectors = support_vectors[sv_idx.ravel()]
+        self.sv_sq_norms = (self.support_vectors ** 2).sum(axis=1)
+        self.alpha = alpha.ravel().astype(np.float64)
+        self.rho = rho
+        self.svm_gamma = svm.getGamma()
+        fs = cv2.FileStorage(range_path, cv2.FILE_STORAGE_READ)
+        feature_range = fs.getNode('range').mat().astype(np.float64)
+        fs.release()
+        self.range_min = feature_range[0]
+        self.range_max = feature_range[1]
+        self.lut = GammaLUT()
+
+    def scale_features(self, gray: np.ndarray) -> np.ndarray:
+        # gray is (H, W) float32; returns the 18 features of this scale
+        lut = self.lut
+        structdis = mscn(gray)
+        h, w = structdis.shape
+        # sums[0] is the MSCN image itself, sums[1:] the pair-wise products
+        sums = np.zeros((1 + len(SHIFTS), 5))
+        tile_rows = max(1, TILE_PIXELS // w)
+        for r0 in range(0, h, tile_rows):
+            r1 = min(h, r0 + tile_rows)
+            sums[0] += aggd_sums(structdis[r0:r1])
+            for k, (dr, dc) in enumerate(SHIFTS):
+                # product with the neighbour at (i + dr, j + dc); out-of-image neighbours count as 0,
+                # so only rows whose neighbour row exists contribute
+                lo, hi = max(r0, -dr), min(r1, h - dr)
+                if lo < hi:
+                    product = structdis[lo:hi, :w - dc] * structdis[lo + dr:hi + dr, dc:]
+                    sums[k + 1] += aggd_sums(product)
+        feats = []
+        gamma_idx, lsigma, rsigma = aggd_fit(sums[0], h * w, lut)
+        feats.append(lut.grid[gamma_idx])
+        feats.append((lsigma ** 2 + rsigma ** 2) / 2)
+        for k in range(len(SHIFTS)):
+            gamma_idx, lsigma, rsigma = aggd_fit(sums[k + 1], h * w, lut)
+            gamma_1 = lut.gamma_1[gamma_idx]
+            constant = np.sqrt(gamma_1) / np.sqrt(lut.gamma_3[gamma_idx])
+            meanparam = (rsigma - lsigma) * (lut.gamma_2[gamma_idx] / gamma_1) * constant
+            feats.extend([lut.grid[gamma_idx], meanparam, lsigma ** 2, rsigma ** 2])
+        # the C++ feature vector is float32
+        return np.array(feats, dtype=np.float32)
+
+    def features(self, gray: np.ndarray) -> np.ndarray:
+        # gray is (H, W) float32 in [0, 1]; returns the 36 features of both scales
+        h, w = gray.shape
+        half = cv2.resize(gray, (w // 2, h // 2), interpolation=cv2.INTER_CUBIC)
+        return np.concatenate([self.scale_features(gray), self.scale_features(half)])
+
+    def predict(self, features: np.ndarray) -> float:
+        x = -1. + 2. * (features.astype(np.float64) - self.range_min) / (self.range_max - self.range_min)
+        # the SVM works in float32 as well
+        x = x.astype(np.float32).astype(np.float64)
+        sq_dists = (x ** 2).sum() + self.sv_sq_norms - 2. * self.support_vectors @ x
+        kernel = np.exp(-self.svm_gamma * np.maximum(sq_dists, 0.))
+        score = kernel @ self.alpha - self.rho
+        return float(np.clip(score, 0., 100.))
+
+    def score(self, image: cv2.typing.MatLike) -> float:
+        return self.predict(self.features(to_gray_float(image)))
@@ -1,27 +1,322 @@
 import cv2
+import math
 import os
+import time
 import tqdm
 import typing as tp
 
 import cv2.typing
+import numpy as np
 
-BRISQUE_MODEL_PATH = 'models/quality/brisque_model_live.yml'
-BRISQUE_RANGE_PATH = 'models/quality/brisque_range_live.yml'
+from imageprep.src.utils.metrics import METRICS
+
+# the repo's models/ dir, found from here so the CLIs run from any working directory
+MODELS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'models'))
+BRISQUE_MODEL_PATH = os.path.join(MODELS_DIR, 'quality', 'brisque_model_live.yml')
+BRISQUE_RANGE_PATH = os.path.join(MODELS_DIR, 'quality', 'brisque_range_live.yml')
 SHARPNESS_THRESHOLD = 80.
 BRIGHTNESS_THRESHOLD = 200.
 DARKNESS_THRESHOLD = 20.
 BRISQUE_THRESHOLD = 30.
+# cascade stages, cheapest first
+CASCADE_STAGES = ('brightness', 'sharpness', 'brisque')
+# the decode-free JPEG quality pre-screen, always ahead of the read when a threshold is set
+PRESCREEN_STAGE = 'jpeg'
+# how many images between re-orderings of an adaptive cascade
+ADAPT_EVERY = 64
+# with a pixel budget, metrics are reported as if scored at this many pixels (what the collectors keep):
+# sharpness is extrapolated to it, BRISQUE (scale dependent, no such correction) is scored on the image
+# area-resized to it, so the decode never goes below it, whatever the budget
+REFERENCE_PIXELS = 1024*1024
+# libjpeg DCT scaling; other formats are decoded fully and then downsampled by OpenCV
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# EXIF orientations that turn the image by 90 degrees (transposed, rotated 90/270, transversed)
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+# measured peak bytes per working pixel while scoring (BGR, gray, float32 laplacian, BRISQUE buffers),
+# on top of a fixed per-worker overhead for the loaded model
+BYTES_PER_WORK_PIXEL = 24
+WORKER_OVERHEAD_BYTES = 80*1024*1024
 
 
-class CVQuality:
+def is_good_quality(
+    sharpness: float,
+    brightness: float,
+    brisque: float,
+    sharpness_threshold: float = SHARPNESS_THRESHOLD,
+    brightness_threshold: float = BRIGHTNESS_THRESHOLD,
+    darkness_threshold: float = DARKNESS_THRESHOLD,
+    brisque_threshold: float = BRISQUE_THRESHOLD,
+) -> bool:
+    sharpness_condition = sharpness >= sharpness_threshold
+    bright_condition = brightness < brightness_threshold
+    dark_condition = brightness > darkness_threshold
+    brisque_condition = brisque < brisque_threshold
+    return all([
+        sharpness_condition,
+        bright_condition,
+        dark_condition,
+        brisque_condition
+    ])
+
+
+def read_image_size(img_path: str) -> tp.Optional[tp.Tuple[int, int]]:
+    # PIL only parses the header here, no pixels are decoded
+    from PIL import Image
+    try:
+        with Image.open(img_path) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def read_oriented_size(img_path: str) -> tp.Optional[tp.Tuple[int, int]]:
+    # the size imread returns, EXIF orientations 5-8 swap width and height; still header only
+    from PIL import Image
+    try:
+        with Image.open(img_path) as img:
+            w, h = img.size
+            if img.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+                return h, w
+            return w, h
+    except Exception:
+        return None
+
+
+def stats_stages(jpeg_quality_threshold: tp.Optional[float]) -> tp.Tuple[str, ...]:
+    # what a CascadeStats has to track for this configuration
+    return ((PRESCREEN_STAGE,) if jpeg_quality_threshold is not None else ()) + CASCADE_STAGES
+
+
+def estimate_peak_bytes(max_pixels: int, reference_pixels: int = REFERENCE_PIXELS) -> int:
+    # upper bound for JPEGs; other formats are decoded at full size before being reduced.
+    # Halving stops before the reference, a decode can stay just under 4x it
+    return WORKER_OVERHEAD_BYTES + BYTES_PER_WORK_PIXEL * max(max_pixels, 4 * reference_pixels)
+
+
+class StageClock:
+    # times a scoring stage into stage_times (shipped back by process workers) and METRICS
+    __slots__ = ('stage_times', 'stage', 'timer', 'start')
+
+    def __init__(self, stage_times: tp.Dict[str, float], stage: str):
+        self.stage_times = stage_times
+        self.stage = stage
+
+    def __enter__(self):
+        self.timer = METRICS.timer(f'quality_{self.stage}')
+        self.timer.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stage_times[self.stage] = time.perf_counter() - self.start
+        self.timer.__exit__(*exc)
+
+
+class StageStats:
     def __init__(self):
-        self.brisque = cv2.quality.QualityBRISQUE()
+        self.n_run = 0
+        self.n_reject = 0
+        self.n_skipped = 0
+        self.total_time = 0.
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.n_run if self.n_run else 0.
+
+    @property
+    def reject_rate(self) -> float:
+        return self.n_reject / self.n_run if self.n_run else 0.
+
+
+class CascadeStats:
+    def __init__(self, stages: tp.Sequence[str] = CASCADE_STAGES):
+        self.stages = {stage: StageStats() for stage in stages}
+        self.n_images = 0
+
+    def record(self, stage_times: tp.Dict[str, float], rejected_stage: tp.Optional[str]):
+        self.n_images += 1
+        for stage, stats in self.stages.items():
+            if stage in stage_times:
+                stats.n_run += 1
+                stats.total_time += stage_times[stage]
+            else:
+                stats.n_skipped += 1
+        if rejected_stage is not None:
+            self.stages[rejected_stage].n_reject += 1
+
+    def time_saved(self) -> float:
+        # estimated from the mean cost of each stage when it did run
+        return sum(stats.n_skipped * stats.mean_time for stats in self.stages.values())
+
+    def best_order(self, current_order: tp.Sequence[str]) -> tp.List[str]:
+        # for independent checks the expected cost is minimised by sorting on cost / rejection rate
+        if any(self.stages[stage].n_run == 0 for stage in current_order):
+            return list(current_order)
+        return sorted(
+            current_order,
+            key=lambda stage: self.stages[stage].mean_time / max(self.stages[stage].reject_rate, 1e-3)
+        )
+
+    def report(self) -> dict:
+        return {
+            'n_images': self.n_images,
+            'time_saved': self.time_saved(),
+            'stages': {
+                stage: {
+                    'n_run': stats.n_run,
+                    'n_reject': stats.n_reject,
+                    'n_skipped': stats.n_skipped,
+                    'mean_time': stats.mean_time,
+                    'reject_rate': stats.reject_rate,
+                } for stage, stats in self.stages.items()
+            },
+        }
 
-    def calculate_sharpness(self, gray: cv2.typing.MatLike) -> float:
+    def summary(self) -> str:
+        lines = [f'cascade: {self.n_images} images, ~{self.time_saved():.2f}s saved by skipped stages']
+        for stage, stats in self.stages.items():
+            lines.append(
+                f'  {stage}: run {stats.n_run}, rejected {stats.n_reject} ({stats.reject_rate:.1%}), '
+                f'skipped {stats.n_skipped}, mean {stats.mean_time*1000:.2f}ms'
+            )
+        return '\n'.join(lines)
+
+
+class CVQuality:
+    def __init__(
+        self,
+        sharpness_threshold: float = SHARPNESS_THRESHOLD,
+        brightness_threshold: float = BRIGHTNESS_THRESHOLD,
+        darkness_threshold: float = DARKNESS_THRESHOLD,
+        brisque_threshold: float = BRISQUE_THRESHOLD,
+        cascade: bool = False,
+        stage_order: tp.Sequence[str] = CASCADE_STAGES,
+        adaptive: bool = False,
+        brisque_backend: str = 'opencv',
+        max_pixels: int = None,
+        reference_pixels: int = REFERENCE_PIXELS,
+        jpeg_quality_threshold: float = None,
+    ):
+        # load the BRISQUE model once instead of re-parsing the yml files on every compute
+        if brisque_backend == 'opencv':
+            self.brisque = cv2.quality.QualityBRISQUE_create(BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH)
+        elif brisque_backend == 'numpy':
+            from imageprep.src.quality.brisque import NumpyBRISQUE
+            self.brisque = NumpyBRISQUE(BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH)
+        else:
+            raise ValueError(f'unknown brisque backend: {brisque_backend}')
+        self.brisque_backend = brisque_backend
+        self.thresholds = {
+            'sharpness_threshold': sharpness_threshold,
+            'brightness_threshold': brightness_threshold,
+            'darkness_threshold': darkness_threshold,
+            'brisque_threshold': brisque_threshold,
+        }
+        if sorted(stage_order) != sorted(CASCADE_STAGES):
+            raise ValueError(f'stage_order must be a permutation of {CASCADE_STAGES}, got {stage_order}')
+        self.cascade = cascade
+        self.stage_order = list(stage_order)
+        self.adaptive = adaptive
+        self.cascade_stats = CascadeStats(stats_stages(jpeg_quality_threshold))
+        self.last_stage_times = {}
+        self.last_rejected_stage = None
+        self.max_pixels = max_pixels
+        self.reference_pixels = reference_pixels
+        # JPEGs whose quantization tables say they were saved below this quality are rejected
+        # from their header, before any pixel is decoded
+        self.jpeg_quality_threshold = jpeg_quality_threshold
+        self.last_jpeg_info = None
+
+    def prescreen(self, head: bytes, stage_times: tp.Dict[str, float]) -> bool:
+        # True when the image goes on to be decoded and scored
+        if self.jpeg_quality_threshold is None:
+            return True
+        from imageprep.src.quality.jpeg_prescreen import parse_jpeg_header, passes_prescreen
+        with StageClock(stage_times, PRESCREEN_STAGE):
+            self.last_jpeg_info = parse_jpeg_header(head)
+            return passes_prescreen(self.last_jpeg_info, self.jpeg_quality_threshold)
+
+    def prescreen_path(self, img_path: str, stage_times: tp.Dict[str, float]) -> bool:
+        if self.jpeg_quality_threshold is None:
+            return True
+        from imageprep.src.quality.jpeg_prescreen import read_head
+        return self.prescreen(read_head(img_path), stage_times)
+
+    def reduced_factor(self, size: tp.Optional[tp.Tuple[int, int]]) -> int:
+        # largest DCT scale within the budget that still covers the reference resolution
+        factor = 1
+        if size is not None:
+            w, h = size
+            floor = min(w * h, self.reference_pixels)
+            while (
+                factor < 8
+                and (w // factor) * (h // factor) > self.max_pixels
+                and (w // (factor * 2)) * (h // (factor * 2)) >= floor
+            ):
+                factor *= 2
+        return factor
+
+    def read_image(self, img_path: str) -> tp.Tuple[tp.Optional[cv2.typing.MatLike], float]:
+        # returns the image to score and the linear scale from it up to the reference resolution
+        if self.max_pixels is None:
+            return cv2.imread(img_path), 1.
+        size = read_image_size(img_path)
+        img = cv2.imread(img_path, REDUCED_READ_FLAGS[self.reduced_factor(size)])
+        if img is None:
+            return None, 1.
+        original_pixels = size[0] * size[1] if size is not None else img.shape[0] * img.shape[1]
+        return self.fit_budget(img, original_pixels)
+
+    def decode_image(self, data: bytes) -> tp.Tuple[tp.Optional[cv2.typing.MatLike], float]:
+        # read_image for bytes still in memory, e.g. a download that isn't saved yet
+        from imageprep.src.collection.header_sniff import SNIFF_LIMIT, parse_image_size
+        buf = np.frombuffer(data, dtype=np.uint8)
+        if self.max_pixels is None:
+            return cv2.imdecode(buf, cv2.IMREAD_COLOR), 1.
+        parsed = parse_image_size(data[:SNIFF_LIMIT])
+        size = parsed[1:] if parsed is not None else None
+        img = cv2.imdecode(buf, REDUCED_READ_FLAGS[self.reduced_factor(size)])
+        if img is None:
+            return None, 1.
+        original_pixels = size[0] * size[1] if size is not None else img.shape[0] * img.shape[1]
+        return self.fit_budget(img, original_pixels)
+
+    def fit_budget(self, img: cv2.typing.MatLike, original_pixels: int) -> tp.Tuple[cv2.typing.MatLike, float]:
+        h, w = img.shape[:2]
+        # only needed past what 1/8 DCT scaling reaches, or when the header couldn't be read.
+        # Halve in integer steps: a non-integer resample blurs and skews the Laplacian variance
+        floor = min(original_pixels, self.reference_pixels)
+        while h * w > self.max_pixels and (h // 2) * (w // 2) >= floor and h >= 2 and w >= 2:
+            img = cv2.resize(img, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+            h, w = img.shape[:2]
+        # images natively below the reference are normalized to their own size, i.e. not at all
+        ref_scale = math.sqrt(min(original_pixels, self.reference_pixels) / (h * w))
+        return img, ref_scale
+
+    def laplacian_variance(self, gray: cv2.typing.MatLike) -> float:
         # Compute the Laplacian of the image
-        laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-        # Compute the variance of the Laplacian
-        variance = laplacian.var()
+        laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+        # Compute the variance of the Laplacian, accumulated in double without a float64 copy
+        _, std = cv2.meanStdDev(laplacian)
+        return float(std[0, 0]) ** 2
+
+    def calculate_sharpness(self, gray: cv2.typing.MatLike, ref_scale: float = 1.) -> float:
+        variance = self.laplacian_variance(gray)
+        h, w = gray.shape[:2]
+        if abs(ref_scale - 1.) > 1e-3 and h >= 16 and w >= 16:
+            # Laplacian variance follows scale**k with a content dependent k; measure k between
+            # this scale and half of it and extrapolate to the reference resolution
+            half = cv2.resize(gray, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+            half_variance = self.laplacian_variance(half)
+            if variance > 0 and half_variance > 0:
+                k = math.log(variance / half_variance) / math.log(2)
+                variance *= ref_scale ** k
         return variance
 
     def calculate_brightness(self, gray: cv2.typing.MatLike) -> float:
@@ -29,35 +324,140 @@ class CVQuality:
         mean_brightness = gray.mean()
         return mean_brightness
 
-    def calculate_brisque(self, image: cv2.typing.MatLike) -> float:
-        scores = self.brisque.compute(
-            image,
-            model_file_path=BRISQUE_MODEL_PATH,
-            range_file_path=BRISQUE_RANGE_PATH
-        )
+    def calculate_brisque(self, image: cv2.typing.MatLike, ref_scale: float = 1.) -> float:
+        # at the reference resolution, so budget scores compare with each other whatever the decode
+        if ref_scale < 1. - 1e-3:
+            h, w = image.shape[:2]
+            size = (max(1, round(w * ref_scale)), max(1, round(h * ref_scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if self.brisque_backend == 'numpy':
+            return self.brisque.score(image)
+        scores = self.brisque.compute(image)
         return scores[0]
 
-    def calculate_quality(self, img_path: str) -> tp.Tuple[float, float, float, bool]:
-        try:
-            img = cv2.imread(img_path)
+    def image_metrics(
+        self,
+        img: cv2.typing.MatLike,
+        ref_scale: float,
+        stage_times: tp.Dict[str, float],
+    ) -> tp.Tuple[float, float, float]:
+        with StageClock(stage_times, 'sharpness'):
             gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            sharpness = self.calculate_sharpness(gray)
+            sharpness = self.calculate_sharpness(gray, ref_scale)
+        with StageClock(stage_times, 'brightness'):
             brightness = self.calculate_brightness(gray)
-            brisque = self.calculate_brisque(img)
+        with StageClock(stage_times, 'brisque'):
+            brisque = self.calculate_brisque(img, ref_scale)
+        return sharpness, brightness, brisque
+
+    def calculate_metrics(self, img_path: str) -> tp.Tuple[tp.Optional[float], tp.Optional[float], tp.Optional[float]]:
+        # all None when the JPEG pre-screen rejected the file undecoded
+        stage_times = {}
+        try:
+            if not self.prescreen_path(img_path, stage_times):
+                self.last_stage_times = stage_times
+                return None, None, None
+            with StageClock(stage_times, 'read'):
+                img, ref_scale = self.read_image(img_path)
+            sharpness, brightness, brisque = self.image_metrics(img, ref_scale, stage_times)
         except Exception as e:
             raise type(e)(f"{str(e)} (file: {img_path})") from e
-        sharpness_condition = sharpness >= SHARPNESS_THRESHOLD
-        bright_condition = brightness < BRIGHTNESS_THRESHOLD
-        dark_condition = brightness > DARKNESS_THRESHOLD
-        brisque_condition = brisque < BRISQUE_THRESHOLD
-        quality = all([
-            sharpness_condition,
-            bright_condition,
-            dark_condition,
-            brisque_condition
-        ])
+        self.last_stage_times = stage_times
+        return sharpness, brightness, brisque
+
+    def run_cascade(
+        self,
+        img: cv2.typing.MatLike,
+        ref_scale: float = 1.
+    ) -> tp.Tuple[tp.Dict[str, float], tp.Dict[str, float], tp.Optional[str]]:
+        metrics = {}
+        stage_times = {}
+        gray = None
+        for stage in self.stage_order:
+            with StageClock(stage_times, stage):
+                if stage == 'brisque':
+                    value = self.calculate_brisque(img, ref_scale)
+                    passed = value < self.thresholds['brisque_threshold']
+                else:
+                    # the grayscale conversion is shared, charge it to whichever gray stage runs first
+                    if gray is None:
+                        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                    if stage == 'brightness':
+                        value = self.calculate_brightness(gray)
+                        passed = self.thresholds['darkness_threshold'] < value < self.thresholds['brightness_threshold']
+                    else:
+                        value = self.calculate_sharpness(gray, ref_scale)
+                        passed = value >= self.thresholds['sharpness_threshold']
+            metrics[stage] = value
+            if not passed:
+                return metrics, stage_times, stage
+        return metrics, stage_times, None
+
+    def calculate_quality_cascade(
+        self,
+        img_path: str
+    ) -> tp.Tuple[tp.Optional[float], tp.Optional[float], tp.Optional[float], bool]:
+        # metrics of stages skipped after an earlier rejection are None
+        read_times = {}
+        try:
+            if not self.prescreen_path(img_path, read_times):
+                return self.finish_cascade({}, read_times, PRESCREEN_STAGE)
+            with StageClock(read_times, 'read'):
+                img, ref_scale = self.read_image(img_path)
+            if img is None:
+                raise ValueError('could not decode image')
+            metrics, stage_times, rejected_stage = self.run_cascade(img, ref_scale)
+        except Exception as e:
+            raise type(e)(f"{str(e)} (file: {img_path})") from e
+        return self.finish_cascade(metrics, dict(read_times, **stage_times), rejected_stage)
+
+    def finish_cascade(
+        self,
+        metrics: tp.Dict[str, float],
+        stage_times: tp.Dict[str, float],
+        rejected_stage: tp.Optional[str],
+    ) -> tp.Tuple[tp.Optional[float], tp.Optional[float], tp.Optional[float], bool]:
+        self.cascade_stats.record(stage_times, rejected_stage)
+        self.last_stage_times = stage_times
+        self.last_rejected_stage = rejected_stage
+        if self.adaptive and self.cascade_stats.n_images % ADAPT_EVERY == 0:
+            self.stage_order = self.cascade_stats.best_order(self.stage_order)
+        return (
+            metrics.get('sharpness'),
+            metrics.get('brightness'),
+            metrics.get('brisque'),
+            rejected_stage is None
+        )
+
+    def calculate_quality(self, img_path: str) -> tp.Tuple[float, float, float, bool]:
+        if self.cascade:
+            return self.calculate_quality_cascade(img_path)
+        sharpness, brightness, brisque = self.calculate_metrics(img_path)
+        if sharpness is None:
+            return None, None, None, False
+        quality = is_good_quality(sharpness, brightness, brisque, **self.thresholds)
         return sharpness, brightness, brisque, quality
 
+    def calculate_quality_bytes(self, data: bytes) -> tp.Tuple[tp.Optional[float], tp.Optional[float], tp.Optional[float], bool]:
+        # calculate_quality on an encoded image in memory, decoded with cv2.imdecode
+        stage_times = {}
+        # the header parse stops at the first scan, the whole body can be handed over
+        if not self.prescreen(data, stage_times):
+            if self.cascade:
+                return self.finish_cascade({}, stage_times, PRESCREEN_STAGE)
+            self.last_stage_times = stage_times
+            return None, None, None, False
+        with StageClock(stage_times, 'read'):
+            img, ref_scale = self.decode_image(data)
+        if img is None:
+            raise ValueError('could not decode image')
+        if self.cascade:
+            metrics, cascade_times, rejected_stage = self.run_cascade(img, ref_scale)
+            return self.finish_cascade(metrics, dict(stage_times, **cascade_times), rejected_stage)
+        sharpness, brightness, brisque = self.image_metrics(img, ref_scale, stage_times)
+        self.last_stage_times = stage_times
+        quality = is_good_quality(sharpness, brightness, brisque, **self.thresholds)
+        return sharpness, brightness, brisque, quality
 
 
 if __name__ == '__main__':
@@ -73,10 +473,15 @@ if __name__ == '__main__':
     good_png_path = os.path.join(local_dir, 'good_png_image.png')
     with open(good_png_path, 'wb') as f:
         f.write(good_png_image.content)
+    from imageprep.src.quality.jpeg_prescreen import parse_jpeg_header, read_head
     cvq = CVQuality()
     for img_path in [jpeg_compressed_path, good_png_path]:
         sharpness, brightness, brisque, quality = cvq.calculate_quality(img_path)
         print(os.path.basename(img_path))
+        # what the pre-screen reads from the header alone
+        jpeg_info = parse_jpeg_header(read_head(img_path))
+        if jpeg_info is not None and jpeg_info.quality is not None:
+            print(f'jpeg quality: {round(jpeg_info.quality)} ({jpeg_info.subsampling})')
         print(f'sharpness: {round(sharpness, 2)}')
         print(f'brightness: {round(brightness, 2)}')
         print(f'brisque: {round(brisque, 2)}')
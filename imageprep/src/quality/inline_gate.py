@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import threading
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+from imageprep.src.utils.metrics import METRICS
+
+# quality gate in the download path: a finished response body is decoded with cv2.imdecode and
+# scored while still in memory, and only images that pass are written, with their scores appended
+# to the gallery's scores.jsonl (batch_quality's format, so shards/buckets/index read it as is).
+# Rejects, most of what we scrape, never cost a write and a later re-read.
+# example run, how many of a folder would pass the gate:
+# python -m imageprep.src.quality.inline_gate data/test/drazenpn.5832241/imgs --workers 8
+
+SCORES_NAME = 'scores.jsonl'
+
+
+class GateResult(tp.NamedTuple):
+    passed: bool
+    sharpness: tp.Optional[float]
+    brightness: tp.Optional[float]
+    brisque: tp.Optional[float]
+    error: tp.Optional[str] = None
+
+    @property
+    def scores(self) -> tp.Tuple[tp.Optional[float], tp.Optional[float], tp.Optional[float]]:
+        return self.sharpness, self.brightness, self.brisque
+
+
+class InlineGate:
+    def __init__(
+        self,
+        n_workers: int = None,
+        thresholds: tp.Dict[str, float] = None,
+        cascade: bool = True,
+        max_pixels: int = None,
+        brisque_backend: str = 'opencv',
+        jpeg_quality_threshold: float = None,
+    ):
+        # cascade by default: the cheap checks reject most images before BRISQUE runs
+        self.cvq_kwargs = dict(
+            thresholds or {},
+            cascade=cascade,
+            max_pixels=max_pixels,
+            brisque_backend=brisque_backend,
+            jpeg_quality_threshold=jpeg_quality_threshold,
+        )
+        # the download threads only wait here; this pool bounds how many images are decoded at once.
+        # OpenCV releases the GIL while decoding and scoring, so threads keep every core busy
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix='gate')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.n_passed = 0
+        self.n_rejected = 0
+        self.n_errors = 0
+        self.bytes_rejected = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def cvq(self):
+        # one CVQuality (and BRISQUE model) per gate thread
+        if not hasattr(self.local, 'cvq'):
+            from imageprep.src.quality.cv_quality import CVQuality
+            self.local.cvq = CVQuality(**self.cvq_kwargs)
+        return self.local.cvq
+
+    def score(self, data: bytes) -> GateResult:
+        try:
+            sharpness, brightness, brisque, quality = self.cvq().calculate_quality_bytes(data)
+            result = GateResult(
+                bool(quality),
+                *(None if m is None else float(m) for m in (sharpness, brightness, brisque)),
+            )
+        except Exception as e:
+            result = GateResult(False, None, None, None, str(e))
+        with self.lock:
+            if result.error is not None:
+                self.n_errors += 1
+            elif result.passed:
+                self.n_passed += 1
+            else:
+                self.n_rejected += 1
+            if not result.passed:
+                self.bytes_rejected += len(data)
+        outcome = 'error' if result.error is not None else 'passed' if result.passed else 'rejected'
+        METRICS.count('gate_images', outcome=outcome)
+        return result
+
+    def check(self, data: bytes) -> GateResult:
+        # called from a download thread, blocks until a gate thread has scored the body
+        return self.executor.submit(self.score, data).result()
+
+    def summary(self) -> str:
+        return (
+            f'quality gate: {self.n_passed} passed, {self.n_rejected} rejected, {self.n_errors} undecodable; '
+            f'{self.bytes_rejected / 2**20:.1f}MB never written'
+        )
+
+
+def append_scores(scores_path: str, rows: tp.Iterable[tp.Tuple[str, GateResult]]):
+    # (final path, gate result) of kept images, as batch_quality result rows
+    lines = [
+        json.dumps({
+            'path': path,
+            'sharpness': result.sharpness,
+            'brightness': result.brightness,
+            'brisque': result.brisque,
+            'quality': result.passed,
+            'error': result.error,
+        })
+        for path, result in rows
+    ]
+    if not lines:
+        return
+    with open(scores_path, 'a') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def add_gate_args(args: argparse.ArgumentParser):
+    args.add_argument('--quality_gate', action='store_true', default=False,
+                      help='score downloads in memory and only save the ones that pass')
+    args.add_argument('--gate_workers', type=int, required=False, default=None)
+    args.add_argument('--gate_max_pixels', type=int, required=False, default=None, help='decode budget per image')
+    args.add_argument('--jpeg_quality_threshold', type=float, required=False, default=None,
+                      help='cancel downloads of JPEGs saved below this quality (e.g. 60) after their header')
+
+
+def gate_from_args(args: argparse.Namespace) -> tp.Optional[InlineGate]:
+    if not args.quality_gate:
+        return None
+    return InlineGate(
+        n_workers=args.gate_workers,
+        max_pixels=args.gate_max_pixels,
+        jpeg_quality_threshold=args.jpeg_quality_threshold,
+    )
+
+
+if __name__ == '__main__':
+    from imageprep.src.utils.paths import iter_image_paths
+
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='+', help='image directories and/or image paths')
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--full', action='store_true', default=False, help='every check on every image, no cascade')
+    args.add_argument('--max_pixels', type=int, required=False, default=None)
+    args = args.parse_args()
+    start = time.time()
+    with InlineGate(n_workers=args.workers, cascade=not args.full, max_pixels=args.max_pixels) as gate:
+        futures = []
+        for path in iter_image_paths(args.inputs):
+            with open(path, 'rb') as f:
+                futures.append((path, gate.executor.submit(gate.score, f.read())))
+            # keep at most a few bodies per worker in memory, like the download threads would
+            while len(futures) >= gate.n_workers * 4:
+                path, future = futures.pop(0)
+                print(f'{path}\t{future.result()}')
+        for path, future in futures:
+            print(f'{path}\t{future.result()}')
+    print(f'{gate.summary()} in {time.time() - start:.1f}s')
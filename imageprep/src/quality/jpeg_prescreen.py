@@ -0,0 +1,202 @@
+import argparse
+import struct
+import typing as tp
+
+from imageprep.src.collection.header_sniff import JPEG_SOF_MARKERS, JPEG_STANDALONE_MARKERS, image_format
+
+# decode-free JPEG pre-screen: the encoder's quality factor is recovered from the quantization tables
+# (DQT) by comparing them with the IJG base tables libjpeg scales from, and the frame header (SOF)
+# tells progressive and chroma subsampled files apart. Heavily recompressed reposts, what BRISQUE only
+# catches after a full decode, are rejected from the first few KB of the file.
+# Encoders with their own tables (Photoshop, some phones) get a comparable but rougher estimate.
+# example run:
+# python -m imageprep.src.quality.jpeg_prescreen data/test/drazenpn.5832241/imgs --threshold 60
+
+# enough for the DQT and SOF segments of nearly every JPEG, EXIF thumbnail included
+PRESCREEN_BYTES = 64*1024
+JPEG_QUALITY_THRESHOLD = 60.
+PROGRESSIVE_SOF_MARKERS = {0xC2, 0xC6, 0xCA, 0xCE}
+DQT_MARKER = 0xDB
+SOS_MARKER = 0xDA
+# IJG base luma table (JPEG spec annex K) in natural order
+IJG_LUMA_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+# DQT stores its 64 entries in zigzag order
+ZIGZAG = (
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+)
+IJG_LUMA_ZIGZAG = tuple(IJG_LUMA_TABLE[i] for i in ZIGZAG)
+# luma (h, v) sampling factors over chroma's -> the usual name
+SUBSAMPLING_NAMES = {
+    (1, 1): '4:4:4',
+    (2, 1): '4:2:2',
+    (1, 2): '4:4:0',
+    (2, 2): '4:2:0',
+    (4, 1): '4:1:1',
+}
+
+
+class JpegInfo(tp.NamedTuple):
+    width: int
+    height: int
+    # estimated IJG quality factor 1-100, None when the luma table wasn't found
+    quality: tp.Optional[float]
+    progressive: bool
+    # '4:2:0' etc., 'gray' for single component files
+    subsampling: str
+
+    @property
+    def subsampled(self) -> bool:
+        return self.subsampling not in ('4:4:4', 'gray')
+
+
+def ijg_table(quality: int, base: tp.Sequence[int] = IJG_LUMA_ZIGZAG) -> tp.Tuple[int, ...]:
+    # the table libjpeg's jpeg_set_quality writes for this quality (baseline, clamped to 1..255)
+    scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+    return tuple(min(255, max(1, (b * scale + 50) // 100)) for b in base)
+
+
+# libjpeg luma table -> the quality that wrote it, every quality writes a different one
+IJG_QUALITIES = {ijg_table(q): q for q in range(1, 101)}
+
+
+def estimate_quality(table: tp.Sequence[int], base: tp.Sequence[int] = IJG_LUMA_ZIGZAG) -> float:
+    # libjpeg: table = base * scale / 100 with scale = 5000 / q below 50 and 200 - 2q above, clamped
+    # to 1..255; clamped entries say nothing about the scale, so they are left out when others remain
+    pairs = [(t, b) for t, b in zip(table, base) if 1 < t < 255] or list(zip(table, base))
+    scale = 100. * sum(t for t, _ in pairs) / sum(b for _, b in pairs)
+    quality = max(1., min(100., (200. - scale) / 2. if scale <= 100. else 5000. / scale))
+    # the rounding of the scaled entries leaves the ratio up to a third off (more when most entries
+    # are clamped); a libjpeg table is looked up exactly, other encoders' tables keep the estimate
+    if base is IJG_LUMA_ZIGZAG:
+        return float(IJG_QUALITIES.get(tuple(table), quality))
+    return quality
+
+
+def parse_dqt(segment: bytes, tables: tp.Dict[int, tp.Tuple[int, ...]]):
+    pos = 0
+    while pos < len(segment):
+        precision, table_id = segment[pos] >> 4, segment[pos] & 0x0F
+        n = 128 if precision else 64
+        values = segment[pos + 1:pos + 1 + n]
+        if len(values) < n:
+            return
+        tables[table_id] = struct.unpack('>64H', values) if precision else tuple(values)
+        pos += 1 + n
+
+
+def parse_jpeg_header(data: bytes) -> tp.Optional[JpegInfo]:
+    # None if not a JPEG or the first scan isn't within data yet; every table the first scan
+    # uses and the frame header come before it
+    if image_format(data) != 'jpeg':
+        return None
+    tables = {}
+    frame = None
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker == SOS_MARKER:
+            break
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segment = data[pos + 4:pos + 2 + length]
+        if len(segment) < length - 2:
+            return None
+        if marker == DQT_MARKER:
+            parse_dqt(segment, tables)
+        elif marker in JPEG_SOF_MARKERS:
+            frame = marker, segment
+        pos += 2 + length
+    if frame is None:
+        return None
+    marker, segment = frame
+    if len(segment) < 9:
+        return None
+    height, width = struct.unpack('>HH', segment[1:5])
+    # (h, v, table id) per component, luma first
+    components = [
+        (segment[i + 1] >> 4, segment[i + 1] & 0x0F, segment[i + 2])
+        for i in range(6, min(6 + 3 * segment[5], len(segment) - 2), 3)
+    ]
+    if len(components) < 2:
+        subsampling = 'gray'
+    else:
+        (h, v, _), (ch, cv, _) = components[0], components[1]
+        ratio = (h // max(ch, 1), v // max(cv, 1))
+        subsampling = SUBSAMPLING_NAMES.get(ratio, f'{h}x{v}')
+    luma_table = tables.get(components[0][2]) if components else None
+    return JpegInfo(
+        width,
+        height,
+        estimate_quality(luma_table) if luma_table is not None else None,
+        marker in PROGRESSIVE_SOF_MARKERS,
+        subsampling,
+    )
+
+
+def read_head(img_path: str, n_bytes: int = PRESCREEN_BYTES) -> bytes:
+    with open(img_path, 'rb') as f:
+        return f.read(n_bytes)
+
+
+def passes_prescreen(info: tp.Optional[JpegInfo], threshold: float = JPEG_QUALITY_THRESHOLD) -> bool:
+    # anything we couldn't estimate goes on to the decode
+    return info is None or info.quality is None or info.quality >= threshold
+
+
+def header_check(threshold: float = JPEG_QUALITY_THRESHOLD) -> tp.Callable[[bytes], tp.Optional[bool]]:
+    # accept_header for the download engine: a low quality JPEG is cancelled once its first scan
+    # starts; None asks for more of the body while the tables may still be ahead
+    def check(head: bytes) -> tp.Optional[bool]:
+        if image_format(head) != 'jpeg':
+            return True
+        info = parse_jpeg_header(head)
+        if info is None:
+            return None
+        return passes_prescreen(info, threshold)
+
+    return check
+
+
+if __name__ == '__main__':
+    from imageprep.src.utils.paths import iter_image_paths
+
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='+', help='image directories and/or image paths')
+    args.add_argument('--threshold', type=float, default=JPEG_QUALITY_THRESHOLD)
+    args = args.parse_args()
+    n_jpegs, n_rejected, n_progressive, n_subsampled = 0, 0, 0, 0
+    for path in iter_image_paths(args.inputs):
+        info = parse_jpeg_header(read_head(path))
+        if info is None:
+            continue
+        n_jpegs += 1
+        passed = passes_prescreen(info, args.threshold)
+        n_rejected += int(not passed)
+        n_progressive += int(info.progressive)
+        n_subsampled += int(info.subsampled)
+        quality = 'unknown' if info.quality is None else f'{info.quality:.0f}'
+        print(
+            f"{path}\tq={quality}\t{info.subsampling}{' progressive' if info.progressive else ''}"
+            f"{'' if passed else ' REJECT'}"
+        )
+    print(f'{n_jpegs} jpegs, {n_rejected} below quality {args.threshold:g}, {n_progressive} progressive, {n_subsampled} subsampled')
@@ -0,0 +1,357 @@
+import argparse
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import tqdm
+
+from imageprep.src.utils.paths import iter_image_paths
+from imageprep.src.quality.quality_cache import QualityCache
+
+# near-duplicate finder: perceptual hashes of every image, a multi-index hash table for
+# Hamming radius lookups, and one survivor per cluster (the best BRISQUE, i.e. the lowest score)
+# example run:
+# python -m imageprep.src.quality.near_dup data/test --db data/near_dup.sqlite --radius 8 --output data/test/near_dups.jsonl
+
+DEFAULT_DB_PATH = 'data/near_dup.sqlite'
+HASH_KINDS = ('phash', 'dhash')
+# 8x8 bits = one uint64 per hash
+HASH_SIZE = 8
+# pHash keeps the lowest 8x8 frequencies of a 32x32 DCT
+PHASH_SIZE = 32
+RADIUS = 8
+# 64 bit hashes split into 4 16-bit chunks; a match within radius r has at least one chunk within r // 4
+N_CHUNKS = 4
+BATCH_SIZE = 256
+# JPEGs are decoded at 1/4 scale straight from the DCT, plenty for a 32x32 thumbnail
+THUMB_READ_FLAG = cv2.IMREAD_REDUCED_GRAYSCALE_4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL,
+    brisque REAL
+);
+"""
+
+_POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    # per-element set bits of a uint64 array
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT_8[x.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.int64).reshape(x.shape)
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    # (N, 64) bool -> (N,) uint64, first bit is the most significant
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2. / n)
+    d[0] /= np.sqrt(2.)
+    return d.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def phash_batch(thumbs: np.ndarray) -> np.ndarray:
+    # thumbs is (N, 32, 32) float32; 2D DCT of the whole batch as two matmuls
+    coeffs = _DCT @ thumbs @ _DCT.T
+    low = coeffs[:, :HASH_SIZE, :HASH_SIZE].reshape(len(thumbs), -1)
+    return pack_bits(low > np.median(low, axis=1, keepdims=True))
+
+
+def dhash_batch(thumbs: np.ndarray) -> np.ndarray:
+    # thumbs is (N, 8, 9) float32; one bit per horizontal gradient sign
+    return pack_bits((thumbs[:, :, 1:] > thumbs[:, :, :-1]).reshape(len(thumbs), -1))
+
+
+def load_thumbs(img_path: str) -> tp.Optional[tp.Tuple[np.ndarray, np.ndarray]]:
+    gray = cv2.imread(img_path, THUMB_READ_FLAG)
+    if gray is None:
+        return None
+    phash_thumb = cv2.resize(gray, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    dhash_thumb = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return phash_thumb.astype(np.float32), dhash_thumb.astype(np.float32)
+
+
+def to_signed(h: np.ndarray) -> np.ndarray:
+    # sqlite integers are signed 64 bit
+    return np.asarray(h, dtype=np.uint64).view(np.int64)
+
+
+class MultiIndexHash:
+    def __init__(self, hashes: np.ndarray, n_chunks: int = N_CHUNKS):
+        # one sorted table per chunk; lookups are binary searches, so a query costs
+        # O(n_chunks * neighbours * log N) plus the candidates it returns instead of O(N)
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.n_chunks = n_chunks
+        self.chunk_bits = 64 // n_chunks
+        self.mask = np.uint64((1 << self.chunk_bits) - 1)
+        self.orders = []
+        self.sorted_chunks = []
+        for k in range(n_chunks):
+            chunk = self.chunk(self.hashes, k)
+            order = np.argsort(chunk, kind='stable')
+            self.orders.append(order)
+            self.sorted_chunks.append(chunk[order])
+        self.flip_masks: tp.Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def chunk(self, hashes: np.ndarray, k: int) -> np.ndarray:
+        shift = np.uint64(64 - (k + 1) * self.chunk_bits)
+        return (hashes >> shift) & self.mask
+
+    def flips(self, radius: int) -> np.ndarray:
+        # every chunk value within radius bits of 0
+        if radius not in self.flip_masks:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for bits in itertools.combinations(range(self.chunk_bits), r):
+                    masks.append(sum(1 << b for b in bits))
+            self.flip_masks[radius] = np.array(masks, dtype=np.uint64)
+        return self.flip_masks[radius]
+
+    def candidates(self, h: np.uint64, radius: int) -> np.ndarray:
+        flips = self.flips(radius // self.n_chunks)
+        found = []
+        for k in range(self.n_chunks):
+            values = np.sort(self.chunk(np.uint64(h), k) ^ flips)
+            lo = np.searchsorted(self.sorted_chunks[k], values, side='left')
+            hi = np.searchsorted(self.sorted_chunks[k], values, side='right')
+            for a, b in zip(lo[hi > lo], hi[hi > lo]):
+                found.append(self.orders[k][a:b])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def query(self, h: np.uint64, radius: int = RADIUS) -> tp.Tuple[np.ndarray, np.ndarray]:
+        # (indices, distances) of every hash within radius
+        candidates = self.candidates(h, radius)
+        distances = popcount(self.hashes[candidates] ^ np.uint64(h))
+        keep = distances <= radius
+        return candidates[keep], distances[keep]
+
+
+class UnionFind:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i: int, j: int):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+class NearDupIndex:
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, n_workers: int = None):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.n_workers = n_workers or min(8, os.cpu_count() or 1)
+        self.paths: tp.List[str] = []
+        self.mih: tp.Dict[str, MultiIndexHash] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def is_current(self, img_path: str, stat: os.stat_result) -> bool:
+        row = self.conn.execute('SELECT size, mtime_ns FROM images WHERE path = ?', (img_path,)).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns
+
+    def add(self, paths: tp.Iterable[str]) -> int:
+        # hashes new or changed images in batches; returns how many were hashed
+        n_added = 0
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            batch = []
+            for img_path in tqdm.tqdm(paths, desc='hashing'):
+                stat = os.stat(img_path)
+                if self.is_current(img_path, stat):
+                    continue
+                batch.append((img_path, stat))
+                if len(batch) == BATCH_SIZE:
+                    n_added += self.add_batch(batch, executor)
+                    batch = []
+            if batch:
+                n_added += self.add_batch(batch, executor)
+        self.conn.commit()
+        self.mih = {}
+        return n_added
+
+    def add_batch(self, batch: tp.List[tp.Tuple[str, os.stat_result]], executor: ThreadPoolExecutor) -> int:
+        # decoding runs on the pool (cv2 releases the GIL), hashing is one vectorized pass
+        thumbs = list(executor.map(load_thumbs, [img_path for img_path, _ in batch]))
+        ok = [i for i, t in enumerate(thumbs) if t is not None]
+        if not ok:
+            return 0
+        phashes = to_signed(phash_batch(np.stack([thumbs[i][0] for i in ok])))
+        dhashes = to_signed(dhash_batch(np.stack([thumbs[i][1] for i in ok])))
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO images (path, size, mtime_ns, phash, dhash, brisque) VALUES (?, ?, ?, ?, ?, NULL)',
+            [
+                (batch[i][0], batch[i][1].st_size, batch[i][1].st_mtime_ns, int(p), int(d))
+                for i, p, d in zip(ok, phashes, dhashes)
+            ]
+        )
+        return len(ok)
+
+    def prune(self) -> int:
+        # drops images deleted or moved since they were hashed; returns how many
+        stale = [
+            (img_path,) for img_path, in self.conn.execute('SELECT path FROM images')
+            if not os.path.exists(img_path)
+        ]
+        if stale:
+            self.conn.executemany('DELETE FROM images WHERE path = ?', stale)
+            self.conn.commit()
+            self.mih = {}
+        return len(stale)
+
+    def load(self, hash_kind: str = 'phash') -> MultiIndexHash:
+        if hash_kind not in HASH_KINDS:
+            raise ValueError(f'unknown hash kind {hash_kind}')
+        if hash_kind not in self.mih:
+            rows = self.conn.execute(f'SELECT path, {hash_kind} FROM images ORDER BY path').fetchall()
+            self.paths = [row[0] for row in rows]
+            hashes = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)
+            self.mih = {hash_kind: MultiIndexHash(hashes)}
+        return self.mih[hash_kind]
+
+    def query(self, img_path: str, radius: int = RADIUS, hash_kind: str = 'phash') -> tp.List[tp.Tuple[str, int]]:
+        # (path, distance) of every indexed image within radius of img_path, which needn't be indexed
+        thumbs = load_thumbs(img_path)
+        if thumbs is None:
+            raise ValueError(f'cannot read {img_path}')
+        if hash_kind == 'phash':
+            h = phash_batch(thumbs[0][None])[0]
+        else:
+            h = dhash_batch(thumbs[1][None])[0]
+        indices, distances = self.load(hash_kind).query(h, radius)
+        return [(self.paths[i], int(d)) for i, d in zip(indices, distances)]
+
+    def clusters(self, radius: int = RADIUS, hash_kind: str = 'phash') -> tp.List[tp.List[str]]:
+        # connected components of the "within radius" graph, singletons left out
+        n_stale = self.prune()
+        if n_stale:
+            print(f'dropped {n_stale} images that no longer exist from the index', file=sys.stderr)
+        mih = self.load(hash_kind)
+        uf = UnionFind(len(mih))
+        for i in tqdm.tqdm(range(len(mih)), desc='clustering'):
+            indices, _ = mih.query(mih.hashes[i], radius)
+            for j in indices:
+                if j > i:
+                    uf.union(i, j)
+        groups: tp.Dict[int, tp.List[str]] = {}
+        for i in range(len(mih)):
+            groups.setdefault(uf.find(i), []).append(self.paths[i])
+        return [group for group in groups.values() if len(group) > 1]
+
+    def brisque(self, img_path: str, cache: QualityCache = None, cvq=None) -> float:
+        # stored score, else the quality cache, else scored now; unreadable images rank last
+        row = self.conn.execute('SELECT brisque FROM images WHERE path = ?', (img_path,)).fetchone()
+        if row is not None and row[0] is not None:
+            return row[0]
+        score = None
+        if cache is not None:
+            try:
+                cached = cache.get(cache.content_key(img_path))
+            except OSError:
+                # gone since the clusters were built
+                return float('inf')
+            if cached is not None:
+                score = cached[2]
+        if score is None:
+            if cvq is None:
+                from imageprep.src.quality.cv_quality import CVQuality
+                cvq = CVQuality()
+            img, _ = cvq.read_image(img_path)
+            if img is None:
+                return float('inf')
+            score = cvq.calculate_brisque(img)
+        self.conn.execute('UPDATE images SET brisque = ? WHERE path = ?', (score, img_path))
+        return score
+
+    def pick_best(self, clusters: tp.List[tp.List[str]], cache: QualityCache = None) -> tp.Iterator[dict]:
+        # BRISQUE is lower-is-better; only members of multi-image clusters are ever scored
+        from imageprep.src.quality.cv_quality import CVQuality
+        cvq = CVQuality()
+        for cluster in tqdm.tqdm(clusters, desc='ranking'):
+            scores = {img_path: self.brisque(img_path, cache, cvq) for img_path in cluster}
+            keep = min(cluster, key=lambda p: (scores[p], p))
+            yield {
+                'keep': keep,
+                'drop': sorted(p for p in cluster if p != keep),
+                'brisque': {p: scores[p] for p in sorted(cluster)},
+            }
+        self.conn.commit()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('inputs', type=str, nargs='*', help='image directories and/or image paths to add to the index')
+    args.add_argument('--db', type=str, required=False, default=DEFAULT_DB_PATH)
+    args.add_argument('--radius', type=int, required=False, default=RADIUS, help='max Hamming distance of near duplicates')
+    args.add_argument('--hash', type=str, choices=HASH_KINDS, default='phash')
+    args.add_argument('--workers', type=int, required=False, default=None)
+    args.add_argument('--cache', type=str, required=False, default=None, help='sqlite quality cache to reuse BRISQUE scores from')
+    args.add_argument('--query', type=str, required=False, default=None, help='only list near duplicates of this image')
+    args.add_argument('--output', type=str, required=False, default=None, help='clusters as jsonl, defaults to stdout')
+    args = args.parse_args()
+    with NearDupIndex(args.db, n_workers=args.workers) as index:
+        if args.inputs:
+            n_added = index.add(iter_image_paths(args.inputs))
+            print(f'hashed {n_added} new images', file=sys.stderr)
+        if args.query:
+            for img_path, distance in sorted(index.query(args.query, args.radius, args.hash), key=lambda x: x[1]):
+                print(f'{distance}\t{img_path}')
+            raise SystemExit(0)
+        cache = QualityCache(args.cache) if args.cache else None
+        output_f = open(args.output, 'w') if args.output else sys.stdout
+        n_clusters = 0
+        n_dropped = 0
+        try:
+            for cluster in index.pick_best(index.clusters(args.radius, args.hash), cache):
+                output_f.write(json.dumps(cluster) + '\n')
+                n_clusters += 1
+                n_dropped += len(cluster['drop'])
+        finally:
+            if cache is not None:
+                cache.close()
+            if output_f is not sys.stdout:
+                output_f.close()
+        print(f'{n_clusters} near-duplicate clusters, {n_dropped} images to drop', file=sys.stderr)
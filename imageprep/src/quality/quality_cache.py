@@ -0,0 +1,258 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+import typing as tp
+
+from imageprep.src.quality.cv_quality import (
+    BRIGHTNESS_THRESHOLD,
+    BRISQUE_MODEL_PATH,
+    BRISQUE_RANGE_PATH,
+    BRISQUE_THRESHOLD,
+    DARKNESS_THRESHOLD,
+    REFERENCE_PIXELS,
+    SHARPNESS_THRESHOLD,
+)
+
+# example run, re-filter everything already scored under new thresholds without decoding a single image:
+# python -m imageprep.src.quality.quality_cache data/quality_cache.sqlite --brisque_threshold 25 --sharpness_threshold 100
+
+DEFAULT_CACHE_PATH = 'data/quality_cache.sqlite'
+HASH_CHUNK_SIZE = 1024*1024
+COMMIT_EVERY = 256
+# metrics scored at full resolution with the OpenCV BRISQUE; anything else gets its own profile,
+# see scoring_profile
+DEFAULT_PROFILE = 'full_resolution'
+DEFAULT_BRISQUE_BACKEND = 'opencv'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash);
+CREATE TABLE IF NOT EXISTS metrics (
+    content_hash TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    sharpness REAL,
+    brightness REAL,
+    brisque REAL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (content_hash, profile)
+);
+CREATE INDEX IF NOT EXISTS metrics_last_access ON metrics (last_access);
+"""
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scoring_profile(
+    max_pixels: int = None,
+    reference_pixels: int = REFERENCE_PIXELS,
+    brisque_backend: str = DEFAULT_BRISQUE_BACKEND,
+) -> str:
+    # metrics are only comparable under the same decode budget and BRISQUE implementation.
+    # The cascade needs no part in it, only complete rows are ever stored
+    parts = [DEFAULT_PROFILE] if max_pixels is None else [f'max_pixels={max_pixels}', f'reference_pixels={reference_pixels}']
+    if brisque_backend != DEFAULT_BRISQUE_BACKEND:
+        parts.append(f'brisque_backend={brisque_backend}')
+    return ','.join(parts)
+
+
+def model_fingerprint(model_paths: tp.Sequence[str]) -> str:
+    h = hashlib.sha256()
+    for path in model_paths:
+        h.update(hash_file(path).encode())
+    return h.hexdigest()
+
+
+class QualityCache:
+    def __init__(
+        self,
+        db_path: str = DEFAULT_CACHE_PATH,
+        max_entries: int = None,
+        model_paths: tp.Sequence[str] = (BRISQUE_MODEL_PATH, BRISQUE_RANGE_PATH),
+        profile: str = DEFAULT_PROFILE,
+        on_invalidate: tp.Sequence[tp.Callable[[str], None]] = (),
+    ):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.n_uncommitted = 0
+        # called with the reason whenever cached metrics are dropped, including by the checks below
+        self.on_invalidate: tp.List[tp.Callable[[str], None]] = list(on_invalidate)
+        # (device, inode, size, mtime) -> hash; gallery files hard linked to the same blob store
+        # entry share an inode, so a repost under a new path isn't read and hashed again
+        self.inode_hashes: tp.Dict[tp.Tuple[int, int, int, int], str] = {}
+        self.check_model(model_paths)
+        # every scoring profile keeps its own metrics, switching --max_pixels back and forth clears nothing
+        self.profile = profile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+    def maybe_commit(self):
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= COMMIT_EVERY:
+            self.conn.commit()
+            self.n_uncommitted = 0
+            self.evict()
+
+    def check_model(self, model_paths: tp.Sequence[str]):
+        # BRISQUE scores are only comparable under the same model, so drop them when the model files change
+        fingerprint = model_fingerprint(model_paths)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'brisque_model'").fetchone()
+        if row is not None and row[0] != fingerprint:
+            self.invalidate_brisque(reason='brisque model changed')
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('brisque_model', ?)",
+            (fingerprint,)
+        )
+        self.conn.commit()
+
+    def invalidate_brisque(self, reason: str = 'manual'):
+        # sharpness and brightness don't depend on the model, but get() and query() only use
+        # complete rows, so these images are scored again in full the next time they're seen
+        self.conn.execute('UPDATE metrics SET brisque = NULL')
+        self.conn.commit()
+        print(f'quality cache: invalidated brisque scores ({reason})')
+        for callback in self.on_invalidate:
+            callback(reason)
+
+    def content_key(self, path: str) -> str:
+        # trust the stored hash while size and mtime match, only re-hash new or changed files
+        stat = os.stat(path)
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, content_hash FROM files WHERE path = ?',
+            (path,)
+        ).fetchone()
+        inode_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            self.inode_hashes[inode_key] = row[2]
+            return row[2]
+        content_hash = self.inode_hashes.get(inode_key)
+        if content_hash is None:
+            content_hash = hash_file(path)
+            self.inode_hashes[inode_key] = content_hash
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime_ns, content_hash)
+        )
+        self.maybe_commit()
+        return content_hash
+
+    def get(self, content_hash: str) -> tp.Optional[tp.Tuple[float, float, float]]:
+        row = self.conn.execute(
+            'SELECT sharpness, brightness, brisque FROM metrics WHERE content_hash = ? AND profile = ?',
+            (content_hash, self.profile)
+        ).fetchone()
+        if row is None or None in row:
+            return None
+        self.conn.execute(
+            'UPDATE metrics SET last_access = ? WHERE content_hash = ? AND profile = ?',
+            (time.time(), content_hash, self.profile)
+        )
+        self.maybe_commit()
+        return row
+
+    def put(self, content_hash: str, sharpness: float, brightness: float, brisque: float):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO metrics (content_hash, profile, sharpness, brightness, brisque, last_access) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (content_hash, self.profile, sharpness, brightness, brisque, time.time())
+        )
+        self.maybe_commit()
+
+    def evict(self):
+        if self.max_entries is None:
+            return
+        n_entries = self.conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0]
+        n_evict = n_entries - self.max_entries
+        if n_evict <= 0:
+            return
+        evicted = self.conn.execute(
+            'SELECT content_hash, profile FROM metrics ORDER BY last_access ASC LIMIT ?',
+            (n_evict,)
+        ).fetchall()
+        self.conn.executemany('DELETE FROM metrics WHERE content_hash = ? AND profile = ?', evicted)
+        # only the paths of what was just evicted and isn't cached under another profile; files of
+        # images still being scored have no metrics row yet and must keep theirs
+        self.conn.executemany(
+            'DELETE FROM files WHERE content_hash = ? '
+            'AND NOT EXISTS (SELECT 1 FROM metrics WHERE metrics.content_hash = files.content_hash)',
+            [(content_hash,) for content_hash, _ in evicted]
+        )
+        self.conn.commit()
+
+    def query(
+        self,
+        sharpness_threshold: float = SHARPNESS_THRESHOLD,
+        brightness_threshold: float = BRIGHTNESS_THRESHOLD,
+        darkness_threshold: float = DARKNESS_THRESHOLD,
+        brisque_threshold: float = BRISQUE_THRESHOLD,
+    ) -> tp.Iterator[tp.Tuple[str, float, float, float]]:
+        # same conditions as cv_quality.is_good_quality
+        return self.conn.execute(
+            'SELECT files.path, metrics.sharpness, metrics.brightness, metrics.brisque '
+            'FROM files JOIN metrics ON files.content_hash = metrics.content_hash '
+            'WHERE metrics.profile = ? AND metrics.sharpness >= ? AND metrics.brightness < ? '
+            'AND metrics.brightness > ? AND metrics.brisque < ? ORDER BY files.path',
+            (self.profile, sharpness_threshold, brightness_threshold, darkness_threshold, brisque_threshold)
+        )
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('db_path', type=str, nargs='?', default=DEFAULT_CACHE_PATH)
+    args.add_argument('--sharpness_threshold', type=float, default=SHARPNESS_THRESHOLD)
+    args.add_argument('--brightness_threshold', type=float, default=BRIGHTNESS_THRESHOLD)
+    args.add_argument('--darkness_threshold', type=float, default=DARKNESS_THRESHOLD)
+    args.add_argument('--brisque_threshold', type=float, default=BRISQUE_THRESHOLD)
+    args.add_argument('--only_existing', action='store_true', default=False)
+    args.add_argument('--max_pixels', type=int, required=False, default=None,
+                      help='query the metrics scored under this decode budget')
+    args.add_argument('--brisque_backend', type=str, choices=['opencv', 'numpy'], default=DEFAULT_BRISQUE_BACKEND,
+                      help='query the metrics scored with this BRISQUE')
+    args = args.parse_args()
+    profile = scoring_profile(args.max_pixels, brisque_backend=args.brisque_backend)
+    with QualityCache(args.db_path, profile=profile) as cache:
+        rows = cache.query(
+            sharpness_threshold=args.sharpness_threshold,
+            brightness_threshold=args.brightness_threshold,
+            darkness_threshold=args.darkness_threshold,
+            brisque_threshold=args.brisque_threshold,
+        )
+        for path, sharpness, brightness, brisque in rows:
+            if args.only_existing and not os.path.exists(path):
+                continue
+            print(path)
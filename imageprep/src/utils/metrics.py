@@ -0,0 +1,313 @@
+import argparse
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import typing as tp
+
+# per-stage latency histograms, counters and gauges shared by the collectors and the quality scorer.
+# Off by default: a disabled timer is one attribute check and a shared no-op context manager.
+# Turn on with METRICS.enable() (the CLIs' --metrics_json/--metrics_prom) or IMAGEPREP_METRICS=1.
+# example run, print a saved snapshot:
+# python -m imageprep.src.utils.metrics data/test/metrics.json
+
+# latency bucket upper bounds in seconds, 1ms to 1min
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+PROFILERS = ('cprofile', 'pyinstrument')
+PROM_PREFIX = 'imageprep'
+NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, bounds: tp.Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last bucket is everything above the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-quantile, the max for the overflow bucket
+        target = q * self.n
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'n': self.n,
+            'total': self.total,
+            'mean': self.total / self.n if self.n else 0.,
+            'p50': self.quantile(.5),
+            'p90': self.quantile(.9),
+            'p99': self.quantile(.99),
+            'max': self.max,
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['inf'], self.counts)),
+        }
+
+
+class StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics: 'Metrics', stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class ProfiledTimer(StageTimer):
+    __slots__ = ('profiler', 'lock')
+
+    def __enter__(self):
+        # one thread profiles a stage at a time, the others are only timed
+        self.profiler, self.lock = self.metrics.stage_profiler(self.stage)
+        if not self.lock.acquire(blocking=False):
+            self.profiler = None
+        elif self.metrics.profiler == 'cprofile':
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        if self.profiler is None:
+            return
+        if self.metrics.profiler == 'cprofile':
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        self.lock.release()
+
+
+def label_key(labels: tp.Dict[str, str]) -> tp.Tuple[tp.Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: tp.Tuple[tp.Tuple[str, str], ...]) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}'
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms: tp.Dict[str, Histogram] = {}
+        self.counters: tp.Dict[tp.Tuple[str, tp.Tuple], float] = {}
+        # name -> [last value, max value]
+        self.gauges: tp.Dict[str, tp.List[float]] = {}
+        self.started = time.time()
+        self.profiler = None
+        self.profile_stages: tp.Set[str] = set()
+        self.profilers: tp.Dict[str, tp.Tuple[tp.Any, threading.Lock]] = {}
+
+    def enable(self, profile_stages: tp.Iterable[str] = (), profiler: str = 'cprofile'):
+        if profiler not in PROFILERS:
+            raise ValueError(f'unknown profiler {profiler}, expected one of {PROFILERS}')
+        self.enabled = True
+        self.started = time.time()
+        self.profiler = profiler
+        self.profile_stages = set(profile_stages)
+
+    def timer(self, stage: str):
+        # with METRICS.timer('page_load'): ...
+        if not self.enabled:
+            return NULL_TIMER
+        if stage in self.profile_stages:
+            return ProfiledTimer(self, stage)
+        return StageTimer(self, stage)
+
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, n: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name: str, value: float):
+        # queue depths and the like: the last value and the highest seen
+        if not self.enabled:
+            return
+        with self.lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+
+    def stage_profiler(self, stage: str) -> tp.Tuple[tp.Any, threading.Lock]:
+        with self.lock:
+            if stage not in self.profilers:
+                if self.profiler == 'cprofile':
+                    import cProfile
+                    profiler = cProfile.Profile()
+                else:
+                    # optional dependency, only needed when asked for
+                    from pyinstrument import Profiler
+                    profiler = Profiler()
+                self.profilers[stage] = (profiler, threading.Lock())
+            return self.profilers[stage]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            counters = {}
+            rates = {}
+            for (name, key), value in sorted(self.counters.items()):
+                counters[name + format_labels(key)] = value
+                # per second over the whole run, e.g. bytes/s and images/s
+                rates[name] = rates.get(name, 0.) + value / elapsed
+            return {
+                'elapsed': elapsed,
+                'stages': {stage: h.to_dict() for stage, h in sorted(self.histograms.items())},
+                'counters': counters,
+                'rates_per_s': rates,
+                'gauges': {name: {'value': v, 'max': m} for name, (v, m) in sorted(self.gauges.items())},
+            }
+
+    def prometheus(self) -> str:
+        # text exposition format, for node_exporter's textfile collector
+        with self.lock:
+            lines = [
+                f'# TYPE {PROM_PREFIX}_stage_seconds histogram',
+            ]
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(h.bounds) + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f'{PROM_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PROM_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {h.total}')
+                lines.append(f'{PROM_PREFIX}_stage_seconds_count{{stage="{stage}"}} {h.n}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {PROM_PREFIX}_{name}_total counter')
+                for (counter, key), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{PROM_PREFIX}_{name}_total{format_labels(key)} {value}')
+            for name, (value, max_value) in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {PROM_PREFIX}_{name} gauge')
+                lines.append(f'{PROM_PREFIX}_{name} {value}')
+                lines.append(f'{PROM_PREFIX}_{name}_max {max_value}')
+            return '\n'.join(lines) + '\n'
+
+    def write_json(self, path: str):
+        write_atomic(path, json.dumps(self.snapshot(), indent=2))
+
+    def write_prometheus(self, path: str):
+        write_atomic(path, self.prometheus())
+
+    def write_profiles(self, profile_dir: str):
+        # {stage}.prof for cProfile (snakeviz, pstats), {stage}.html for pyinstrument
+        os.makedirs(profile_dir, exist_ok=True)
+        for stage, (profiler, lock) in self.profilers.items():
+            with lock:
+                if self.profiler == 'cprofile':
+                    profiler.dump_stats(os.path.join(profile_dir, f'{stage}.prof'))
+                else:
+                    with open(os.path.join(profile_dir, f'{stage}.html'), 'w') as f:
+                        f.write(profiler.output_html())
+
+    def export(self, json_path: str = None, prom_path: str = None, profile_dir: str = None):
+        if json_path:
+            self.write_json(json_path)
+        if prom_path:
+            self.write_prometheus(prom_path)
+        if profile_dir and self.profilers:
+            self.write_profiles(profile_dir)
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"metrics over {snapshot['elapsed']:.1f}s"]
+        for stage, h in snapshot['stages'].items():
+            lines.append(
+                f"  {stage}: n {h['n']}, mean {h['mean']*1000:.1f}ms, p90 <={h['p90']*1000:.0f}ms, "
+                f"total {h['total']:.1f}s"
+            )
+        for name, value in snapshot['counters'].items():
+            lines.append(f'  {name}: {value:g}')
+        for name, rate in snapshot['rates_per_s'].items():
+            lines.append(f'  {name}/s: {rate:.2f}')
+        for name, gauge in snapshot['gauges'].items():
+            lines.append(f"  {name}: {gauge['value']:g} (max {gauge['max']:g})")
+        return '\n'.join(lines)
+
+
+def write_atomic(path: str, text: str):
+    # scrapers never see a half written file
+    out_dir = os.path.dirname(path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(path + '.part', 'w') as f:
+        f.write(text)
+    os.replace(path + '.part', path)
+
+
+def add_metrics_args(args: argparse.ArgumentParser):
+    args.add_argument('--metrics_json', type=str, required=False, default=None, help='write stage timings and counts here')
+    args.add_argument('--metrics_prom', type=str, required=False, default=None, help='same, as a prometheus textfile')
+    args.add_argument('--profile_stages', type=str, required=False, default=None, help='comma separated stages to profile')
+    args.add_argument('--profiler', type=str, choices=PROFILERS, default='cprofile')
+    args.add_argument('--profile_dir', type=str, required=False, default='data/profiles')
+
+
+def enable_from_args(args: argparse.Namespace):
+    if args.metrics_json or args.metrics_prom or args.profile_stages:
+        METRICS.enable(
+            profile_stages=args.profile_stages.split(',') if args.profile_stages else (),
+            profiler=args.profiler,
+        )
+
+
+def export_from_args(args: argparse.Namespace):
+    if not METRICS.enabled:
+        return
+    # stderr, stdout may be carrying results
+    print(METRICS.summary(), file=sys.stderr)
+    METRICS.export(args.metrics_json, args.metrics_prom, args.profile_dir)
+
+
+# the process-wide registry every module records into
+METRICS = Metrics(enabled=os.environ.get('IMAGEPREP_METRICS') == '1')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('snapshot', type=str, help='json written by --metrics_json')
+    args = args.parse_args()
+    with open(args.snapshot, 'r') as f:
+        snapshot = json.load(f)
+    print(f"{snapshot['elapsed']:.1f}s")
+    for stage, h in snapshot['stages'].items():
+        print(f"{stage}\tn {h['n']}\tmean {h['mean']*1000:.1f}ms\tp50 {h['p50']*1000:.0f}ms\tp99 {h['p99']*1000:.0f}ms\ttotal {h['total']:.1f}s")
+    for name, value in snapshot['counters'].items():
+        print(f'{name}\t{value:g}')
@@ -0,0 +1,35 @@
+import hashlib
+import os
+import typing as tp
+
+# image inputs for every stage that takes folders or path lists; kept free of cv2 and numpy
+# so the quick CLI commands can import it
+
+IMG_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+PATH_DIGEST_CHARS = 10
+
+
+def iter_image_paths(inputs: tp.Iterable[str]) -> tp.Iterator[str]:
+    # lazily walk directories so huge folders never get listed into memory all at once
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMG_EXTS):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def read_path_list(list_path: str) -> tp.Iterator[str]:
+    with open(list_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def path_digest(img_path: str) -> str:
+    # short hash of the absolute path, for names built from parts of it that can repeat
+    return hashlib.sha1(os.path.abspath(img_path).encode()).hexdigest()[:PATH_DIGEST_CHARS]
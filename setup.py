@@ -1,11 +1,15 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_namespace_packages
 
 setup(
     name="imageprep",
     version="0.1.0",
-    packages=find_packages(),
+    # the source folders have no __init__.py
+    packages=find_namespace_packages(include=['imageprep', 'imageprep.*'], exclude=['*.__pycache__']),
     install_requires=[],
     package_data={},
+    entry_points={
+        'console_scripts': ['imageprep=imageprep.src.cli:main'],
+    },
     description="Image collection and processing for Text2Image models",
     author="pmuaib",
     author_email="",
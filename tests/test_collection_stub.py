@@ -0,0 +1,180 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from imageprep.src.collection import lpsg
+from imageprep.src.collection.download_engine import BodyTooLarge, CappedBuffer, DownloadEngine
+from imageprep.src.collection.rate_limit import DECREASE, INCREASE, INITIAL_RATE, RateLimiter
+from imageprep.src.collection.stub_server import StubServer, record_page
+from imageprep.src.quality.inline_gate import GateResult
+
+# the collection path against the local stub server: the limiter backs off on 429s and honours
+# Retry-After, the engine retries transient failures, and http page fetches fall back to the browser
+# run from the repo root:
+# python -m pytest -q tests
+
+JPEG = cv2.imencode('.jpg', np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8))[1].tobytes()
+
+
+def make_engine(**kwargs) -> DownloadEngine:
+    # no backoff sleeps, the tests time the limiter alone
+    return DownloadEngine(backoff=0., limiter=RateLimiter(verbose=False), **kwargs)
+
+
+def test_rate_drops_after_429(tmp_path):
+    with StubServer({'/a.jpg': JPEG}, fail_first=1, fail_status=429) as srv, make_engine() as engine:
+        url = srv.url('/a.jpg')
+        response = engine.request(url)
+        bucket = engine.limiter.bucket(url)
+        assert response.status_code == 200
+        assert srv.hits['/a.jpg'] == 2
+        assert bucket.n_throttled == 1
+        # halved by the 429, then one step back up for the 200 of the retry
+        assert bucket.rate == pytest.approx(INITIAL_RATE * DECREASE + INCREASE)
+        # no Retry-After, no pause
+        assert bucket.paused_until == 0.
+
+
+def test_pause_lasts_retry_after(tmp_path):
+    # the stub takes one request/s, so the second request back to back gets a 429 with Retry-After: 1
+    with StubServer({'/a.jpg': JPEG}, max_rate=1., retry_after=1) as srv, make_engine() as engine:
+        url = srv.url('/a.jpg')
+        assert engine.request(url).status_code == 200
+        start = time.time()
+        assert engine.request(url).status_code == 200
+        elapsed = time.time() - start
+        bucket = engine.limiter.bucket(url)
+        assert srv.n_throttled == 1
+        assert bucket.n_throttled == 1
+        # the retry waited out the pause instead of hammering the host
+        assert bucket.waited >= .9
+        assert .9 <= elapsed < 3.
+
+
+def test_retry_after_on_success_is_not_throttling():
+    limiter = RateLimiter(verbose=False)
+    url = 'http://example.com/a.jpg'
+    limiter.observe(url, 200, .1, '120')
+    bucket = limiter.bucket(url)
+    assert bucket.n_throttled == 0
+    assert bucket.paused_until == 0.
+    assert bucket.rate == pytest.approx(INITIAL_RATE + INCREASE)
+    # the same header on a 503 pauses the host
+    limiter.observe(url, 503, .1, '120')
+    assert bucket.n_throttled == 1
+    assert bucket.paused_until > time.monotonic() + 100
+
+
+def test_download_retries_5xx(tmp_path):
+    with StubServer({'/a.jpg': JPEG}, fail_first=2) as srv, make_engine(retries=3) as engine:
+        result = engine.download(srv.url('/a.jpg'), str(tmp_path / 'a.jpg'))
+        assert result.ok
+        assert result.attempts == 3
+        assert (tmp_path / 'a.jpg').read_bytes() == JPEG
+
+
+def test_download_gives_up_after_retries(tmp_path):
+    with StubServer({'/a.jpg': JPEG}, fail_first=10) as srv, make_engine(retries=2) as engine:
+        result = engine.download(srv.url('/a.jpg'), str(tmp_path / 'a.jpg'))
+        assert not result.ok
+        assert result.attempts == 3
+        assert srv.hits['/a.jpg'] == 3
+        assert not (tmp_path / 'a.jpg').exists()
+
+
+def test_download_passes_through_404(tmp_path):
+    with StubServer({}) as srv, make_engine(retries=2) as engine:
+        result = engine.download(srv.url('/missing.jpg'), str(tmp_path / 'missing.jpg'))
+        assert not result.ok
+        assert result.status == 404
+        assert result.attempts == 1
+
+
+class PassingGate:
+    # stands in for InlineGate without the BRISQUE model, every body passes
+    def __init__(self):
+        self.checked = []
+
+    def check(self, data: bytes) -> GateResult:
+        self.checked.append(len(data))
+        return GateResult(True, 100., 100., 10.)
+
+
+def test_gate_keeps_body_under_limit(tmp_path):
+    gate = PassingGate()
+    with StubServer({'/a.jpg': JPEG}) as srv, make_engine(gate=gate, gate_max_bytes=len(JPEG)) as engine:
+        result = engine.download(srv.url('/a.jpg'), str(tmp_path / 'a.jpg'))
+        assert result.ok
+        assert gate.checked == [len(JPEG)]
+        assert (tmp_path / 'a.jpg').read_bytes() == JPEG
+
+
+def test_gate_drops_body_over_limit(tmp_path):
+    gate = PassingGate()
+    with StubServer({'/a.jpg': JPEG}) as srv, make_engine(gate=gate, gate_max_bytes=len(JPEG) - 1) as engine:
+        result = engine.download(srv.url('/a.jpg'), str(tmp_path / 'a.jpg'))
+        assert not result.ok
+        assert 'gate limit' in result.error
+        # no retries for a body that will be as large the next time
+        assert result.attempts == 1
+        assert gate.checked == []
+        assert not (tmp_path / 'a.jpg').exists()
+
+
+def test_capped_buffer_refuses_past_limit():
+    # bodies without a Content-Length are stopped by the sink
+    buffer = CappedBuffer(10)
+    buffer.write(b'x' * 6)
+    with pytest.raises(BodyTooLarge):
+        buffer.write(b'x' * 6)
+    assert buffer.getvalue() == b'x' * 6
+
+
+class FakeDriver:
+    # stands in for selenium: serves the thread's pages without a challenge
+    def __init__(self, pages: dict):
+        self.pages = pages
+        self.gets = []
+        self.url = None
+
+    def get(self, url: str):
+        self.gets.append(url)
+        self.url = url
+
+    @property
+    def page_source(self) -> str:
+        return self.pages[self.url]
+
+    def get_cookies(self):
+        return [{'name': 'xf_session', 'value': 'abc', 'domain': '127.0.0.1'}]
+
+    def execute_script(self, script: str):
+        return 'ua-test'
+
+    def close(self):
+        pass
+
+
+def test_challenge_page_falls_back_to_browser(tmp_path):
+    root = tmp_path / 'pages'
+    with StubServer({}, root=str(root)) as srv:
+        thread_url = srv.url('/threads/x.1/')
+        page_urls = [thread_url, thread_url + 'page-2', thread_url + 'page-3']
+        pages = {url: f'<p>page {p}</p>' for p, url in enumerate(page_urls, start=1)}
+        for url, html in pages.items():
+            # page 2 is behind a challenge for plain http clients
+            record_page(str(root), url, 'Just a moment...' if url.endswith('page-2') else html)
+        engine = make_engine()
+        L = lpsg.LPSG(thread_url, str(tmp_path / 'out'), engine=engine, fetch_mode='http', max_pages=3)
+        L.driver = FakeDriver(pages)
+        try:
+            fetched = list(L.iter_pages(1))
+        finally:
+            L.cleanup(failed=False)
+    assert [html for _, _, html in fetched] == [pages[url] for url in page_urls]
+    assert L.driver.gets == [page_urls[1]]
+    assert L.n_fallbacks == 1
+    # the browser load of the challenge page still went through the engine's limiter
+    assert engine.limiter.bucket(thread_url).n_requests == 4
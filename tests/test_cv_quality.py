@@ -0,0 +1,42 @@
+import math
+
+import cv2
+import numpy as np
+import pytest
+
+from imageprep.src.quality.cv_quality import REFERENCE_PIXELS, CVQuality
+
+# scoring under a pixel budget: metrics are reported as if scored at the reference resolution
+# run from the repo root:
+# python -m pytest -q tests
+
+
+@pytest.fixture(scope='module')
+def photo(tmp_path_factory) -> str:
+    # 6MP, smooth enough that its statistics survive the DCT-scaled decode
+    small = np.random.default_rng(1).integers(0, 255, (300, 200, 3), dtype=np.uint8)
+    path = str(tmp_path_factory.mktemp('img') / 'photo.jpg')
+    cv2.imwrite(path, cv2.resize(small, (2000, 3000), interpolation=cv2.INTER_CUBIC), [cv2.IMWRITE_JPEG_QUALITY, 92])
+    return path
+
+
+def reference_copy(path: str) -> str:
+    img = cv2.imread(path)
+    h, w = img.shape[:2]
+    scale = math.sqrt(REFERENCE_PIXELS / (h * w))
+    ref_path = path[:-len('.jpg')] + '_ref.png'
+    cv2.imwrite(ref_path, cv2.resize(img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA))
+    return ref_path
+
+
+@pytest.mark.parametrize('max_pixels', [256 * 1024, REFERENCE_PIXELS, 2 * REFERENCE_PIXELS])
+def test_budget_brisque_matches_the_reference(photo, max_pixels):
+    _, _, reference_brisque = CVQuality().calculate_metrics(reference_copy(photo))
+    _, _, brisque = CVQuality(max_pixels=max_pixels).calculate_metrics(photo)
+    assert brisque == pytest.approx(reference_brisque, abs=2.)
+
+
+def test_model_loads_outside_the_repo_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    CVQuality()
+    CVQuality(brisque_backend='numpy')
@@ -0,0 +1,84 @@
+import io
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+from imageprep.src.collection.header_sniff import CHUNK_SIZE, SniffStats, stream_to
+from imageprep.src.quality.jpeg_prescreen import header_check, parse_jpeg_header
+
+# the decode-free JPEG quality pre-screen, on its own and in the download path's header sniff
+# run from the repo root:
+# python -m pytest -q tests
+
+IMG = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 255, (512, 512, 3), dtype=np.uint8), (5, 5), 0)
+
+
+def encode(quality: int) -> bytes:
+    return cv2.imencode('.jpg', IMG, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def split_header(data: bytes) -> bytes:
+    # a comment segment right after the frame header, so the SOF sits in the first chunk
+    # and the first scan (with the tables the check needs done) only starts in the second
+    pos = 2
+    while data[pos + 1] not in (0xC0, 0xC2):
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    comment = b'\xff\xfe' + struct.pack('>H', CHUNK_SIZE + 2) + bytes(CHUNK_SIZE)
+    return data[:pos] + comment + data[pos:]
+
+
+class FakeResponse:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.headers = {'Content-Length': str(len(data))}
+        self.closed = False
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+def sniff(data: bytes, threshold: float) -> tuple:
+    stats = SniffStats()
+    sink = io.BytesIO()
+    ok = stream_to(FakeResponse(data), lambda: sink, None, stats, header_check(threshold))
+    return ok, sink.getvalue(), stats
+
+
+@pytest.mark.parametrize('quality', range(1, 101))
+def test_estimate_matches_libjpeg(quality):
+    assert parse_jpeg_header(encode(quality)).quality == quality
+
+
+def test_incomplete_header_asks_for_more():
+    data = split_header(encode(20))
+    check = header_check(60.)
+    assert check(data[:CHUNK_SIZE]) is None
+    assert check(data) is False
+    assert header_check(10.)(data) is True
+    # not a JPEG, nothing to screen
+    assert check(b'\x89PNG\r\n\x1a\n' + bytes(32)) is True
+
+
+def test_split_header_low_quality_is_cancelled():
+    data = split_header(encode(20))
+    ok, written, stats = sniff(data, 60.)
+    assert not ok
+    assert written == b''
+    assert stats.n_low_quality == 1
+    # cancelled after the chunk with the first scan, not at the end of the body
+    assert stats.bytes_read < len(data)
+
+
+def test_split_header_good_quality_is_kept():
+    data = split_header(encode(90))
+    ok, written, stats = sniff(data, 60.)
+    assert ok
+    assert written == data
+    assert stats.n_complete == 1
@@ -0,0 +1,58 @@
+import pytest
+
+from imageprep.src.quality.batch_quality import BatchQuality
+from imageprep.src.quality.quality_cache import DEFAULT_PROFILE, QualityCache, scoring_profile
+
+# metrics are cached per scoring profile (decode budget, BRISQUE backend), files by content hash
+# run from the repo root:
+# python -m pytest -q tests
+
+
+def test_profiles_tell_scoring_setups_apart():
+    profiles = {
+        scoring_profile(),
+        scoring_profile(brisque_backend='numpy'),
+        scoring_profile(max_pixels=2**20),
+        scoring_profile(max_pixels=2**20, brisque_backend='numpy'),
+        scoring_profile(max_pixels=2**21),
+    }
+    assert len(profiles) == 5
+    assert scoring_profile() == DEFAULT_PROFILE
+
+
+def test_hits_only_within_a_profile(tmp_path):
+    db_path = str(tmp_path / 'cache.sqlite')
+    with QualityCache(db_path) as cache:
+        cache.put('abc', 100., 120., 20.)
+        assert cache.get('abc') == (100., 120., 20.)
+    with QualityCache(db_path, profile=scoring_profile(brisque_backend='numpy')) as cache:
+        assert cache.get('abc') is None
+        cache.put('abc', 100., 120., 21.)
+    # switching back and forth keeps both
+    with QualityCache(db_path) as cache:
+        assert cache.get('abc') == (100., 120., 20.)
+
+
+def test_batch_refuses_a_cache_of_another_profile(tmp_path):
+    with QualityCache(str(tmp_path / 'cache.sqlite')) as cache:
+        with pytest.raises(ValueError):
+            BatchQuality(n_workers=1, cache=cache, brisque_backend='numpy')
+        BatchQuality(n_workers=1, cache=cache)
+
+
+def test_evict_keeps_files_of_cached_and_unscored_images(tmp_path):
+    paths = []
+    for name in 'abc':
+        path = tmp_path / f'{name}.jpg'
+        path.write_bytes(name.encode() * 10)
+        paths.append(str(path))
+    with QualityCache(str(tmp_path / 'cache.sqlite'), max_entries=1) as cache:
+        hashes = [cache.content_key(path) for path in paths]
+        # a and b scored (a first, so it is the least recently used), c still in flight
+        cache.put(hashes[0], 1., 1., 1.)
+        cache.put(hashes[1], 2., 2., 2.)
+        cache.evict()
+        assert cache.get(hashes[0]) is None
+        assert cache.get(hashes[1]) == (2., 2., 2.)
+        files = {row[0] for row in cache.conn.execute('SELECT path FROM files')}
+    assert files == set(paths[1:])
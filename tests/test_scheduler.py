@@ -0,0 +1,115 @@
+import pytest
+
+from imageprep.src.collection import adonismale
+from imageprep.src.collection.scheduler import GalleryScheduler
+from imageprep.src.pipeline import PipelineStopped
+
+# gallery jobs on the scheduler: failures are retried from the queue, a stop error ends the run,
+# and process_gallery_url goes through the same path for its single gallery
+# run from the repo root:
+# python -m pytest -q tests
+
+
+class FakeSession:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def flaky_job(n_failures: int, runs: list):
+    def run_job(job, session):
+        runs.append(job.attempt)
+        if len(runs) <= n_failures:
+            raise RuntimeError('flaky')
+    return run_job
+
+
+def test_failed_job_is_retried():
+    runs = []
+    sessions = []
+    scheduler = GalleryScheduler(
+        flaky_job(2, runs), lambda site, worker_id: sessions.append(FakeSession()) or sessions[-1],
+        n_tries=3, retry_delay=.01,
+    )
+    scheduler.add('site', 'https://example.com/a')
+    assert scheduler.run() == []
+    assert runs == [0, 1, 2]
+    assert scheduler.n_retried == 2
+    assert all(session.closed for session in sessions)
+
+
+def test_gives_up_after_n_tries():
+    runs = []
+    scheduler = GalleryScheduler(flaky_job(10, runs), lambda site, worker_id: FakeSession(), n_tries=2, retry_delay=.01)
+    scheduler.add('site', 'https://example.com/a')
+    failed = scheduler.run()
+    assert [(job.url, error) for job, error in failed] == [('https://example.com/a', 'flaky')]
+    assert runs == [0, 1]
+
+
+def test_stop_error_ends_the_run():
+    runs = []
+
+    def run_job(job, session):
+        runs.append(job.url)
+        raise PipelineStopped()
+
+    session = FakeSession()
+    scheduler = GalleryScheduler(
+        run_job, lambda site, worker_id: session, stop_on=(PipelineStopped,), close_sessions=False
+    )
+    scheduler.add('site', 'https://example.com/a')
+    scheduler.add('site', 'https://example.com/b')
+    with pytest.raises(PipelineStopped):
+        scheduler.run()
+    # no retry and nothing after it
+    assert runs == ['https://example.com/a']
+    # the caller's session stays open
+    assert not session.closed
+
+
+class FakeAdonis:
+    # fails its first run, then finds one image url
+    runs = []
+
+    def __init__(self, gallery_url: str, top_dir: str, session=None, **kwargs):
+        self.url_txt = f'{top_dir}/url.txt'
+        self.gal_dir = top_dir
+        self.session = session
+
+    def run(self):
+        FakeAdonis.runs.append(self.session)
+        if len(FakeAdonis.runs) == 1:
+            raise RuntimeError('page did not load')
+        with open(self.url_txt, 'w') as f:
+            f.write('example.com/1.jpg\n')
+
+    def cleanup(self, failed: bool = True):
+        pass
+
+
+def test_process_gallery_url_retries_on_the_scheduler(tmp_path, monkeypatch):
+    downloads = []
+    monkeypatch.setattr(adonismale, 'Adonis', FakeAdonis)
+    monkeypatch.setattr(adonismale, 'download_images', lambda urls, **kwargs: downloads.append(urls))
+    monkeypatch.setattr(adonismale.time, 'sleep', lambda seconds: pytest.fail('blocking sleep'))
+    FakeAdonis.runs = []
+    session = FakeSession()
+    assert adonismale.process_gallery_url('https://example.com/g', str(tmp_path), session=session) == []
+    assert FakeAdonis.runs == [session, session]
+    assert downloads == [['example.com/1.jpg']]
+    assert not session.closed
+
+
+def test_process_gallery_url_lets_pipeline_stop_out(tmp_path, monkeypatch):
+    def stopped(urls, **kwargs):
+        raise PipelineStopped()
+
+    monkeypatch.setattr(adonismale, 'Adonis', FakeAdonis)
+    monkeypatch.setattr(adonismale, 'download_images', stopped)
+    FakeAdonis.runs = [None]
+    with pytest.raises(PipelineStopped):
+        adonismale.process_gallery_url('https://example.com/g', str(tmp_path), session=FakeSession())
+    assert len(FakeAdonis.runs) == 2
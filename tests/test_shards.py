@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from imageprep.src.collection.crawl_manifest import MANIFEST_NAME, CrawlManifest
+from imageprep.src.export.shards import INDEX_DTYPE, ShardReader, ShardWriter, SourceLookup, index_path, read_index
+
+# tar shard export: keys never collide, a killed run is repaired on reopen, and sources are found
+# in the crawl manifests whichever way their paths were written
+# run from the repo root:
+# python -m pytest -q tests
+
+
+def make_image(path, data: bytes = b'\xff\xd8\xff' + b'x' * 64) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_same_gallery_and_index_in_two_top_dirs(tmp_path):
+    paths = [make_image(tmp_path / top / 'gal' / 'imgs' / '1.jpg', top.encode() * 8) for top in ('a', 'b')]
+    with ShardWriter(str(tmp_path / 'shards')) as writer:
+        assert [writer.write_file(path, {'path': path}) for path in paths] == [True, True]
+        # the same file again is skipped
+        assert not writer.write_file(paths[0], {})
+        shard_path = writer.shard_path
+    with ShardReader(shard_path) as reader:
+        assert len(reader) == 2
+        assert {reader[i][2]['path'] for i in range(2)} == set(paths)
+
+
+def test_reopen_repairs_the_index_of_a_full_shard(tmp_path):
+    paths = [make_image(tmp_path / 'gal' / 'imgs' / f'{i}.jpg', bytes([i]) * 32) for i in range(2)]
+    writer = ShardWriter(str(tmp_path / 'shards'), max_count=2)
+    for path in paths:
+        writer.write_file(path, {})
+    # killed between the last sample and its index record, before the shard was closed
+    writer.f.flush()
+    shard_path = writer.shard_path
+    with open(index_path(shard_path), 'r+b') as f:
+        f.truncate(INDEX_DTYPE.itemsize)
+    assert len(read_index(shard_path)) == 1
+    with ShardWriter(str(tmp_path / 'shards'), max_count=2) as reopened:
+        assert len(read_index(shard_path)) == 2
+        assert not reopened.write_file(paths[1], {})
+    with ShardReader(shard_path) as reader:
+        assert bytes(reader[1][1]) == bytes([1]) * 32
+
+
+@pytest.mark.parametrize('manifest_absolute', [True, False])
+def test_source_lookup_across_absolute_and_relative_paths(tmp_path, monkeypatch, manifest_absolute):
+    monkeypatch.chdir(tmp_path)
+    rel_path = os.path.join('out', 'gal', 'imgs', '1.jpg')
+    make_image(tmp_path / rel_path)
+    abs_path = str(tmp_path / rel_path)
+    with CrawlManifest(os.path.join('out', MANIFEST_NAME)) as manifest:
+        manifest.mark_urls('gal', [
+            ('https://example.com/1.jpg', 'done', 67, abs_path if manifest_absolute else rel_path, 'hash1', None),
+        ])
+    query = rel_path if manifest_absolute else abs_path
+    # found next to the images, and through an explicitly given manifest
+    assert SourceLookup().get(query) == ('https://example.com/1.jpg', 'hash1')
+    assert SourceLookup([os.path.join('out', MANIFEST_NAME)]).get(query) == ('https://example.com/1.jpg', 'hash1')